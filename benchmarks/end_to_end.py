@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+"""
+End-to-end benchmark of bufferer across input sizes, event counts and modes.
+
+Synthesizes test inputs with lavfi (testsrc video and sine audio), runs every
+combination of resolution, duration, number of events and mode, and records
+the wall time, CPU time, peak RSS and bytes written to disk of each stage.
+
+The results are written as JSON. Pass a previous result file with --baseline
+to compare against it: cases whose wall or CPU time grew by more than the
+tolerance are reported, and the script exits with status 1.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+
+import bufferer
+
+FPS = 30
+
+RESOLUTIONS = {
+    "240p": "426x240",
+    "360p": "640x360",
+    "480p": "854x480",
+    "720p": "1280x720",
+    "1080p": "1920x1080",
+    "1440p": "2560x1440",
+    "2160p": "3840x2160",
+}
+
+MODES: dict[str, dict[str, Any]] = {
+    "spinner": {},
+    "disable-spinner": {"disable_spinner": True},
+    "skipping": {"skipping": True},
+    "black-frame": {"black_frame": True},
+    # only runs the audio stage, since inputs without video are not supported
+    "audio-only": {},
+}
+
+# metrics that are compared against the baseline
+COMPARED_METRICS = ("wall_time", "cpu_time")
+
+
+def create_input(path: str, duration: float, size: str) -> None:
+    subprocess.check_output(
+        [
+            "ffmpeg",
+            "-y",
+            "-f",
+            "lavfi",
+            "-i",
+            f"testsrc=duration={duration}:size={size}:rate={FPS},format=pix_fmts=yuv420p",
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=frequency=1000:sample_rate=48000:duration={duration}",
+            "-c:v",
+            "libx264",
+            "-preset",
+            "ultrafast",
+            "-c:a",
+            "aac",
+            path,
+        ],
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def get_ffmpeg_version() -> str:
+    output = subprocess.check_output(["ffmpeg", "-version"]).decode("utf-8")
+    return output.splitlines()[0]
+
+
+def get_buflist(num_events: int, duration: float) -> list[list[float]]:
+    # spread the events evenly, without letting neighbouring stalls overlap
+    spacing = duration / (num_events + 1)
+    stall_length = round(min(0.5, spacing / 2), 3)
+    return [[round(spacing * (i + 1), 3), stall_length] for i in range(num_events)]
+
+
+def get_case_id(resolution: str, duration: float, num_events: int, mode: str) -> str:
+    return f"{resolution}-{duration:g}s-{num_events}ev-{mode}"
+
+
+def run_case(
+    input_file: str, output_file: str, buflist: list[list[float]], mode: str
+) -> dict[str, Any]:
+    b = bufferer.Bufferer(
+        input_file=input_file,
+        output_file=output_file,
+        buflist=buflist,
+        force_overwrite=True,
+        **MODES[mode],
+    )
+
+    start_time = time.monotonic()
+    if mode == "audio-only":
+        b._prepare_processing()
+        b.insert_buf_audio()
+        os.remove(b._get_tmp_filename("audio"))
+        report = b.timing_report
+    else:
+        report = b.insert_buf_audiovisual()
+        if not os.path.isfile(output_file):
+            raise RuntimeError(f"no output written for mode {mode}")
+        os.remove(output_file)
+    wall_time = time.monotonic() - start_time
+
+    cpu_times = [stage.cpu_time for stage in report.stages if stage.cpu_time]
+    return {
+        "wall_time": round(wall_time, 3),
+        "cpu_time": round(sum(cpu_times), 3) if cpu_times else None,
+        "max_rss": report.get_max_rss(),
+        "disk_bytes": sum(stage.output_bytes or 0 for stage in report.stages),
+        "stages": report.to_dict()["stages"],
+    }
+
+
+def compare_to_baseline(
+    results: list[dict[str, Any]], baseline: list[dict[str, Any]], tolerance: float
+) -> list[str]:
+    baseline_cases = {result["case"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        baseline_result = baseline_cases.get(result["case"])
+        if baseline_result is None:
+            continue
+        for metric in COMPARED_METRICS:
+            value, baseline_value = result.get(metric), baseline_result.get(metric)
+            if not value or not baseline_value:
+                continue
+            ratio = value / baseline_value
+            if ratio > 1 + tolerance:
+                regressions.append(
+                    f"{result['case']}: {metric} {baseline_value:.3f} -> {value:.3f} "
+                    f"({(ratio - 1) * 100:+.0f}%)"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--resolutions",
+        default="240p,1080p,2160p",
+        help=f"comma-separated list of {', '.join(RESOLUTIONS)}",
+    )
+    parser.add_argument(
+        "--durations", default="30", help="comma-separated input durations"
+    )
+    parser.add_argument(
+        "--events", default="1,10,100", help="comma-separated event counts"
+    )
+    parser.add_argument(
+        "--modes",
+        default=",".join(MODES),
+        help=f"comma-separated list of {', '.join(MODES)}",
+    )
+    parser.add_argument("--json", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON result file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative slowdown against the baseline",
+    )
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for resolution in args.resolutions.split(","):
+            for duration in [float(d) for d in args.durations.split(",")]:
+                input_file = os.path.join(tmpdir, f"input_{resolution}.mp4")
+                output_file = os.path.join(tmpdir, "output.mkv")
+                create_input(input_file, duration, RESOLUTIONS[resolution])
+
+                for num_events in [int(n) for n in args.events.split(",")]:
+                    buflist = get_buflist(num_events, duration)
+                    for mode in args.modes.split(","):
+                        case = get_case_id(resolution, duration, num_events, mode)
+                        result: dict[str, Any] = {
+                            "case": case,
+                            "resolution": resolution,
+                            "duration": duration,
+                            "events": num_events,
+                            "mode": mode,
+                            **run_case(input_file, output_file, buflist, mode),
+                        }
+                        results.append(result)
+                        print(
+                            f"{case:>32}: {result['wall_time']:>8.3f}s wall, "
+                            f"{result['cpu_time'] or 0:>8.3f}s CPU, "
+                            f"{(result['max_rss'] or 0) / 1e6:>8.1f} MB RSS",
+                            file=sys.stderr,
+                        )
+
+                os.remove(input_file)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "environment": {
+                        "bufferer": bufferer.__version__,
+                        "ffmpeg": get_ffmpeg_version(),
+                        "python": platform.python_version(),
+                        "platform": platform.platform(),
+                        "cpu_count": os.cpu_count(),
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("no regressions against the baseline", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the video graph strategies against the number of buffering events.
+
+Synthesizes a test input with lavfi, inserts an increasing number of short
+stalls with the "loop" and "retime" strategies, and reports the throughput
+in output frames per second of wall time. With the "retime" strategy, the
+throughput should stay roughly flat as the number of events grows.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import bufferer
+from bufferer._bufferer import GRAPH_STRATEGIES
+
+FPS = 30
+
+
+def create_input(path: str, duration: float, size: str) -> None:
+    subprocess.check_output(
+        [
+            "ffmpeg",
+            "-y",
+            "-f",
+            "lavfi",
+            "-i",
+            f"testsrc=duration={duration}:size={size}:rate={FPS},format=pix_fmts=yuv420p",
+            "-c:v",
+            "libx264",
+            "-preset",
+            "ultrafast",
+            path,
+        ],
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def get_buflist(num_events: int, duration: float) -> list[list[float]]:
+    # spread the events evenly, each stall lasting a few frames
+    spacing = duration / (num_events + 1)
+    return [[round(spacing * (i + 1), 3), 0.1] for i in range(num_events)]
+
+
+def run_case(
+    input_file: str, output_file: str, buflist: list[list[float]], strategy: str
+) -> dict:
+    b = bufferer.Bufferer(
+        input_file=input_file,
+        output_file=output_file,
+        buflist=buflist,
+        disable_spinner=True,
+        audio_disable=True,
+        force_overwrite=True,
+        single_pass=True,
+        vcodec="rawvideo",
+        graph_strategy=strategy,
+    )
+
+    start_time = time.monotonic()
+    b.insert_buf_audiovisual()
+    wall_time = time.monotonic() - start_time
+
+    output_duration = b._get_duration_in_seconds() + sum(
+        buf_len for _, buf_len in buflist
+    )
+    output_frames = int(output_duration * FPS)
+
+    os.remove(output_file)
+
+    return {
+        "strategy": strategy,
+        "events": len(buflist),
+        "wall_time": round(wall_time, 3),
+        "frames_per_second": round(output_frames / wall_time, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", default="1,10,100,1000")
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--size", default="320x240")
+    parser.add_argument("--strategies", default=",".join(GRAPH_STRATEGIES))
+    parser.add_argument("--json", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_file = os.path.join(tmpdir, "input.mp4")
+        output_file = os.path.join(tmpdir, "output.nut")
+        create_input(input_file, args.duration, args.size)
+
+        for num_events in [int(n) for n in args.events.split(",")]:
+            buflist = get_buflist(num_events, args.duration)
+            for strategy in args.strategies.split(","):
+                result = run_case(input_file, output_file, buflist, strategy)
+                results.append(result)
+                print(
+                    f"{strategy:>8} {num_events:>6} events: "
+                    f"{result['wall_time']:>8.3f}s, {result['frames_per_second']:>8.1f} fps",
+                    file=sys.stderr,
+                )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
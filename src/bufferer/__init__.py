@@ -1,7 +1,27 @@
 import importlib.metadata
 
 from ._bufferer import Bufferer
+from ._plan import CostModel, get_plan, load_timing_reports
+from ._probe import MediaInfo, probe, probe_async
+from ._progress import Progress, StageTiming, TimingReport
+from ._server import JobServer, serve, submit_jobs
+from ._variants import insert_buf_variants
 
 __version__ = importlib.metadata.version("bufferer")
 
-__all__ = ["Bufferer"]
+__all__ = [
+    "Bufferer",
+    "CostModel",
+    "JobServer",
+    "MediaInfo",
+    "Progress",
+    "StageTiming",
+    "TimingReport",
+    "get_plan",
+    "insert_buf_variants",
+    "load_timing_reports",
+    "probe",
+    "probe_async",
+    "serve",
+    "submit_jobs",
+]
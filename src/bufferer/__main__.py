@@ -9,42 +9,114 @@ Usage:
     bufferer    [-hfne] -i <input> -b <buflist> -o <output>
                 [-v <vcodec>] [-a <acodec>]
                 [-x <pixfmt>]
-                [-s <spinner>] [--disable-spinner] [-p <speed>]
-                [-t <trim>]
+                [-s <spinner>] [--disable-spinner] [-p <speed>] [--spinner-cache]
+                [--start <start>] [-t <trim>]
+                [--output-format <format>] [--fragmented]
                 [-r <brightness>]
-                [-l <blur>]
+                [-l <blur>] [--blur-once]
                 [--audio-disable]
                 [--black-frame]
                 [--force-framerate]
                 [--skipping]
+                [--single-pass]
+                [--smart-render]
+                [--threads <threads>]
+                [--graph-strategy <strategy>]
+                [--audio-engine <engine>]
+                [--video-engine <engine>]
+                [--tmp-dir <tmpdir>] [--intermediate-codec <codec>]
                 [--ffmpeg-path <ffmpeg>]
+                [--ffprobe-path <ffprobe>]
+                [--probe-cache] [--cache-dir <cachedir>]
+                [--mezzanine-cache] [--mezzanine-cache-size <gb>]
+                [--result-cache] [--result-cache-size <gb>]
+                [--plan] [--calibration <reports>]
                 [--verbose] [--version]
+    bufferer    variants -i <input> <variants> [-fne]
+                [-v <vcodec>] [-a <acodec>]
+                [-x <pixfmt>]
+                [-s <spinner>] [--disable-spinner] [-p <speed>] [--spinner-cache]
+                [--start <start>] [-t <trim>]
+                [--output-format <format>] [--fragmented]
+                [-r <brightness>]
+                [-l <blur>] [--blur-once]
+                [--audio-disable]
+                [--black-frame]
+                [--force-framerate]
+                [--skipping]
+                [--threads <threads>]
+                [--graph-strategy <strategy>]
+                [--audio-engine <engine>]
+                [--ffmpeg-path <ffmpeg>]
+                [--ffprobe-path <ffprobe>]
+                [--probe-cache] [--cache-dir <cachedir>]
+                [--mezzanine-cache] [--mezzanine-cache-size <gb>]
+                [--verbose]
+    bufferer    batch <manifest> [-j <jobs>] [--cpu-budget <cpus>] [--report <report>]
+                [--ffmpeg-path <ffmpeg>] [--verbose]
+    bufferer    queue add <queue> <manifest> [--verbose]
+    bufferer    queue work <queue> [-j <jobs>] [--cpu-budget <cpus>] [--lease <seconds>]
+                [--ffmpeg-path <ffmpeg>] [--verbose]
+    bufferer    queue status <queue> [--verbose]
+    bufferer    queue retry <queue> [--verbose]
+    bufferer    serve <address> [-f] [-j <jobs>] [--cpu-budget <cpus>]
+                [--ffmpeg-path <ffmpeg>] [--cache-dir <cachedir>] [--verbose]
 
     -h --help                     show help message
     -f --force                    force overwrite output files
     -n --dry-run                  only print final command, do not run
     -i --input <input>            input video file
     -b --buflist <buflist>        list of buffering events in format "[[x1,y1], [x2,y2],...]" or
-                                  "[x1,y1], [x2,y2], ..." where x = position of event in seconds, y = duration of event
-    -o --output <output>          output video file
+                                  "[x1,y1], [x2,y2], ..." where x = position of event in seconds, y = duration of event, or a JSON or CSV file
+    -o --output <output>          output video file, "-" for stdout, or a named pipe
     -v --vcodec <vcodec>          video encoder to use (see `ffmpeg -encoders`) [default: ffv1]
     -a --acodec <acodec>          audio encoder to use (see `ffmpeg -encoders`) [default: pcm_s16le]
     -x --pixfmt <pixfmt>          set pixel format for output [default: yuv420p]
     -s --spinner <spinner>        path to spinner animated file or video [default: spinners/spinner-256-white.png]
     -e --disable-spinner          disable spinner, just show stopped video
     -p --speed <speed>            speed of the spinner, rounded to integer [default: 2]
-    -t --trim <trim>              trim video to length in seconds or "HH:MM:SS.msec" format
+    --spinner-cache               pre-render the spinner once and reuse it from the cache directory
+    --start <start>               start the output at this position of the input, in seconds or "HH:MM:SS.msec" format; only the needed part of the input is decoded, and <buflist> positions stay relative to the input
+    -t --trim <trim>              trim video to length in seconds or "HH:MM:SS.msec" format; only the part of the input needed for this length is decoded
+    --output-format <format>      output container format (see `ffmpeg -muxers`), required for stdout, named pipes and files without extension
+    --fragmented                  write fragmented MP4/MOV (always enabled when streaming to stdout or a pipe)
     -r --brightness <brightness>  change brightness during buffering, use values between -1.0 and 1.0 [default: 0.0]
     -l --blur <blur>              change blur during buffering, value specifies kernel size [default: 5]
+    --blur-once                   blur and darken each frozen frame once, instead of every repeated frame (requires --graph-strategy retime or --video-engine raw)
     -c --black-frame              start with a black frame if there is buffering at position 0.0
     --audio-disable               disable audio for the output, even if input contains audio
     --force-framerate             force output framerate to be the same as the input video file
     --skipping                    insert frame freezes with skipping (without indicator) at the <buflist> locations and durations
+    --single-pass                 process video and audio in a single ffmpeg run, without intermediate files
+    --graph-strategy <strategy>   how to freeze frames: "loop" (one loop filter per event) or "retime" (one filter for all events; with --skipping, skipped frames are dropped in the same pass) [default: loop]
+    --audio-engine <engine>       how to insert audio stalls: "loop" (loop and mute one sample per event) or "splice" (splice in generated silence, sample-exactly) [default: loop]
+    --video-engine <engine>       how to insert video stalls: "filter" (ffmpeg filter graph) or "raw" (pipe raw frames through Python, frame-exact; needs NumPy for the spinner) [default: filter]
+    --tmp-dir <tmpdir>            directory for intermediate files, e.g. /dev/shm (default: next to <output>)
+    --intermediate-codec <codec>  video encoder for intermediate files, e.g. rawvideo, utvideo or ffv1 (multi-sliced); the merge step then encodes with <vcodec> (default: <vcodec>)
+    --smart-render                only re-encode the GOPs with buffering events, stream-copy the rest (requires libx264 or libx265 for an input of that codec, and <pixfmt> to match the input)
+    --threads <threads>           number of ffmpeg threads; with 2 or more, the video and audio passes run concurrently and share them, with the default of 1 they run one after the other [default: 1]
     --ffmpeg-path <ffmpeg>        path to ffmpeg executable [default: ffmpeg]
+    --ffprobe-path <ffprobe>      path to ffprobe executable (default: ffprobe next to <ffmpeg>)
+    --probe-cache                 cache probe results of input files on disk
+    --cache-dir <cachedir>        base directory for caches (default: ~/.cache/bufferer)
+    --mezzanine-cache             decode the input once into a lossless intraframe mezzanine in the cache, and read from it in this and later runs
+    --mezzanine-cache-size <gb>   size limit of the mezzanine cache in GB; the least recently used mezzanines are removed [default: 50]
+    --result-cache                reuse the output of an earlier run with the same input and options from the cache instead of rendering it again; outputs are written with bitexact flags
+    --result-cache-size <gb>      size limit of the result cache in GB; the least recently used results are removed [default: 50]
+    --plan                        probe the input and print the execution plan as JSON instead of running it: the commands of each stage, the frames and samples they decode and encode, and estimates of the wall time, peak memory and disk space for intermediate files
+    --calibration <reports>       calibrate the estimates of --plan with the timing reports of earlier runs, e.g. a batch report written by --report
+    <variants>                    (variants) JSON or CSV file with a "buflist" and an "output" for each variant; all variants are rendered from a single decode of <input>
+    -j --jobs <jobs>              (batch, queue, serve) number of jobs to run in parallel (default: number of CPUs)
+    --cpu-budget <cpus>           (batch, queue, serve) total number of ffmpeg threads shared by all jobs (default: number of CPUs)
+    --report <report>             (batch) write per-job results as JSON to this file
+    <queue>                       (queue) SQLite database of a resumable job queue, created by "queue add"; "queue work" runs workers until all jobs are done or failed
+    --lease <seconds>             (queue) seconds after which the job of a worker that stopped responding is run again [default: 300]
+    <address>                     (serve) path of a Unix socket, or a TCP port on localhost, on which to accept jobs as JSON lines
     --verbose                     show verbose output
     --version                     show version
 """
 
+import json
 import logging
 import os
 import shutil
@@ -53,8 +125,13 @@ import sys
 from docopt import docopt
 
 from . import __version__
+from ._batch import load_manifest, run_batch
 from ._bufferer import Bufferer
 from ._log import CustomLogFormatter
+from ._plan import CostModel, get_plan, load_timing_reports
+from ._queue import JobQueue, run_workers
+from ._server import serve
+from ._variants import insert_buf_variants, load_variants
 
 
 def setup_logger(level: int = logging.INFO) -> logging.Logger:
@@ -71,6 +148,152 @@ def setup_logger(level: int = logging.INFO) -> logging.Logger:
     return logger
 
 
+def run_batch_cli(arguments: dict) -> None:
+    logger = setup_logger(logging.DEBUG if arguments["--verbose"] else logging.INFO)
+
+    jobs = load_manifest(arguments["<manifest>"])
+    for job in jobs:
+        job.setdefault("ffmpeg_path", arguments["--ffmpeg-path"])
+
+    results = run_batch(
+        jobs,
+        max_workers=int(arguments["--jobs"]) if arguments["--jobs"] else None,
+        cpu_budget=int(arguments["--cpu-budget"])
+        if arguments["--cpu-budget"]
+        else None,
+    )
+
+    if arguments["--report"]:
+        with open(arguments["--report"], "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info("Report written to " + arguments["--report"])
+
+    failed_jobs = [result for result in results if result["status"] != "done"]
+    logger.info(
+        f"{len(results) - len(failed_jobs)} jobs done, {len(failed_jobs)} failed"
+    )
+    if failed_jobs:
+        sys.exit(1)
+
+
+def run_queue_cli(arguments: dict) -> None:
+    logger = setup_logger(logging.DEBUG if arguments["--verbose"] else logging.INFO)
+
+    if arguments["work"]:
+        counts = run_workers(
+            arguments["<queue>"],
+            max_workers=int(arguments["--jobs"]) if arguments["--jobs"] else None,
+            cpu_budget=int(arguments["--cpu-budget"])
+            if arguments["--cpu-budget"]
+            else None,
+            lease=float(arguments["--lease"]),
+            defaults={"ffmpeg_path": arguments["--ffmpeg-path"]},
+        )
+        logger.info(f"{counts['done']} jobs done, {counts['failed']} failed")
+        if counts["failed"]:
+            sys.exit(1)
+        return
+
+    queue = JobQueue(arguments["<queue>"])
+    try:
+        if arguments["add"]:
+            jobs = load_manifest(arguments["<manifest>"])
+            added = queue.add(jobs)
+            logger.info(f"{added} jobs added, {len(jobs) - added} already queued")
+        elif arguments["retry"]:
+            logger.info(f"{queue.retry_failed()} failed jobs queued again")
+        else:
+            for status, count in queue.get_counts().items():
+                print(f"{status}: {count}")
+            if arguments["--verbose"]:
+                for job in queue.get_failed_jobs():
+                    print(
+                        f"failed job {job['id']} ({job['output']}, {job['attempts']} attempts): {job['error']}"
+                    )
+    finally:
+        queue.close()
+
+
+def run_serve_cli(arguments: dict) -> None:
+    setup_logger(logging.DEBUG if arguments["--verbose"] else logging.INFO)
+
+    serve(
+        arguments["<address>"],
+        max_workers=int(arguments["--jobs"]) if arguments["--jobs"] else None,
+        cpu_budget=int(arguments["--cpu-budget"])
+        if arguments["--cpu-budget"]
+        else None,
+        defaults={
+            "ffmpeg_path": arguments["--ffmpeg-path"],
+            "cache_dir": arguments["--cache-dir"],
+            "force_overwrite": arguments["--force"],
+        },
+    )
+
+
+def get_bufferer_options(arguments: dict) -> dict:
+    """
+    Get the Bufferer options from the command line arguments, except the input,
+    output and buffering list
+    """
+    return dict(
+        spinner=arguments["--spinner"],
+        disable_spinner=arguments["--disable-spinner"],
+        speed=int(arguments["--speed"]),
+        trim=arguments["--trim"],
+        start=arguments["--start"],
+        force_overwrite=arguments["--force"],
+        dry=arguments["--dry-run"],
+        vcodec=arguments["--vcodec"],
+        acodec=arguments["--acodec"],
+        pixfmt=arguments["--pixfmt"],
+        brightness=arguments["--brightness"],
+        blur=arguments["--blur"],
+        audio_disable=arguments["--audio-disable"],
+        black_frame=arguments["--black-frame"],
+        force_framerate=arguments["--force-framerate"],
+        skipping=arguments["--skipping"],
+        ffmpeg_path=arguments["--ffmpeg-path"],
+        single_pass=arguments["--single-pass"],
+        smart_render=arguments["--smart-render"],
+        threads=int(arguments["--threads"]),
+        graph_strategy=arguments["--graph-strategy"],
+        audio_engine=arguments["--audio-engine"],
+        video_engine=arguments["--video-engine"],
+        tmp_dir=arguments["--tmp-dir"],
+        intermediate_codec=arguments["--intermediate-codec"],
+        spinner_cache=arguments["--spinner-cache"],
+        blur_once=arguments["--blur-once"],
+        output_format=arguments["--output-format"],
+        fragmented=arguments["--fragmented"],
+        ffprobe_path=arguments["--ffprobe-path"],
+        probe_cache=arguments["--probe-cache"],
+        cache_dir=arguments["--cache-dir"],
+        mezzanine_cache=arguments["--mezzanine-cache"],
+        mezzanine_cache_size=float(arguments["--mezzanine-cache-size"]),
+        result_cache=arguments["--result-cache"],
+        result_cache_size=float(arguments["--result-cache-size"]),
+    )
+
+
+def run_variants_cli(arguments: dict) -> None:
+    logger = setup_logger(logging.DEBUG if arguments["--verbose"] else logging.INFO)
+
+    if not os.path.isfile(arguments["--input"]):
+        raise IOError("Input file does not exist")
+
+    variants = load_variants(arguments["<variants>"])
+    try:
+        insert_buf_variants(
+            arguments["--input"], variants, **get_bufferer_options(arguments)
+        )
+    except Exception as e:
+        raise RuntimeError("Error while converting: " + str(e))
+
+    for variant in variants:
+        logger.info("Output written to " + variant["output"])
+
+
 def main():
     arguments = docopt(__doc__, version=str(__version__))
 
@@ -84,6 +307,22 @@ def main():
         )
         sys.exit(1)
 
+    if arguments["batch"]:
+        run_batch_cli(arguments)
+        return
+
+    if arguments["variants"]:
+        run_variants_cli(arguments)
+        return
+
+    if arguments["queue"]:
+        run_queue_cli(arguments)
+        return
+
+    if arguments["serve"]:
+        run_serve_cli(arguments)
+        return
+
     if not os.path.isfile(arguments["--input"]):
         raise IOError("Input file does not exist")
 
@@ -107,24 +346,18 @@ def main():
         input_file=arguments["--input"],
         output_file=arguments["--output"],
         buflist=arguments["--buflist"],
-        spinner=arguments["--spinner"],
-        disable_spinner=arguments["--disable-spinner"],
-        speed=int(arguments["--speed"]),
-        trim=arguments["--trim"],
-        force_overwrite=arguments["--force"],
-        dry=arguments["--dry-run"],
-        vcodec=arguments["--vcodec"],
-        acodec=arguments["--acodec"],
-        pixfmt=arguments["--pixfmt"],
-        brightness=arguments["--brightness"],
-        blur=arguments["--blur"],
-        audio_disable=arguments["--audio-disable"],
-        black_frame=arguments["--black-frame"],
-        force_framerate=arguments["--force-framerate"],
-        skipping=arguments["--skipping"],
-        ffmpeg_path=ffmpeg_path,
+        **get_bufferer_options(arguments),
     )
 
+    if arguments["--plan"]:
+        cost_model = None
+        if arguments["--calibration"]:
+            cost_model = CostModel.from_reports(
+                load_timing_reports(arguments["--calibration"])
+            )
+        print(json.dumps(get_plan(b, cost_model), indent=2))
+        return
+
     try:
         b.insert_buf_audiovisual()
     except Exception as e:
@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import concurrent.futures
+import csv
+import inspect
+import json
+import logging
+import os
+import time
+from typing import Any
+
+from ._bufferer import Bufferer
+
+logger = logging.getLogger("bufferer")
+
+REQUIRED_JOB_KEYS = ("input", "buflist", "output")
+SCALAR_OPTION_TYPES: dict[str, type] = {
+    "str": str,
+    "int": int,
+    "float": float,
+    "bool": bool,
+}
+
+
+def _get_option_types() -> dict[str, type]:
+    """
+    Get the types of the optional Bufferer arguments that a manifest can set,
+    based on their annotations
+    """
+    parameters = inspect.signature(Bufferer.__init__).parameters
+    option_types = {}
+    for name, parameter in parameters.items():
+        if parameter.default is inspect.Parameter.empty:
+            continue
+        # annotations are strings, e.g. "str | float | None"
+        types = [
+            type_name.strip()
+            for type_name in str(parameter.annotation).split("|")
+            if type_name.strip() != "None"
+        ]
+        # options that are not scalars (e.g. media_info, progress_callback)
+        # cannot be set from a manifest
+        if not all(type_name in SCALAR_OPTION_TYPES for type_name in types):
+            continue
+        # options with several types (e.g. start) are passed as strings
+        option_types[name] = SCALAR_OPTION_TYPES[types[0]] if len(types) == 1 else str
+    return option_types
+
+
+def _coerce_option(name: str, value: Any, option_types: dict[str, type]) -> Any:
+    """
+    Convert a manifest value (which may be a string, e.g. from CSV) to the type
+    that Bufferer expects for this option
+    """
+    if name not in option_types:
+        raise RuntimeError(f"Unknown option in manifest: {name}")
+    option_type = option_types[name]
+    if not isinstance(value, str) or option_type is str:
+        return value
+    if option_type is bool:
+        return value.strip().lower() in ("1", "true", "yes", "y")
+    return option_type(value)
+
+
+def load_manifest(manifest_file: str) -> list[dict[str, Any]]:
+    """
+    Load a batch manifest.
+
+    The manifest is either a JSON list of objects, or a CSV file with a header row.
+    Each job needs the keys "input", "buflist" and "output"; all other keys are
+    passed as options to Bufferer (e.g. "vcodec", "skipping"). Empty CSV cells
+    are ignored.
+
+    Args:
+        manifest_file (str): Path to the manifest (.json or .csv)
+
+    Returns:
+        list[dict[str, Any]]: Jobs
+
+    Raises:
+        RuntimeError: Manifest not properly formatted
+    """
+    with open(manifest_file) as f:
+        if manifest_file.lower().endswith(".csv"):
+            jobs = [
+                {key: value for key, value in row.items() if value not in (None, "")}
+                for row in csv.DictReader(f)
+            ]
+        else:
+            jobs = json.load(f)
+
+    if not isinstance(jobs, list):
+        raise RuntimeError("Manifest must contain a list of jobs")
+
+    for index, job in enumerate(jobs):
+        check_job(job, f"Job {index} in manifest")
+
+    return jobs
+
+
+def check_job(job: dict[str, Any], name: str = "Job") -> None:
+    """
+    Check that a job has the required keys, and convert its options in place
+    to the types that Bufferer expects.
+
+    Args:
+        job (dict[str, Any]): Job
+        name (str, optional): Name of the job in error messages. Defaults to "Job".
+
+    Raises:
+        RuntimeError: Missing keys or unknown options
+    """
+    missing_keys = [key for key in REQUIRED_JOB_KEYS if key not in job]
+    if missing_keys:
+        raise RuntimeError(f"{name} is missing keys: {', '.join(missing_keys)}")
+
+    option_types = _get_option_types()
+    for option, value in job.items():
+        if option not in REQUIRED_JOB_KEYS:
+            job[option] = _coerce_option(option, value, option_types)
+
+
+def run_job(job: dict[str, Any], threads: int = 1) -> dict[str, Any]:
+    """
+    Run a single batch job.
+
+    Args:
+        job (dict[str, Any]): Job as loaded from the manifest
+        threads (int, optional): Number of threads assigned to the job. Defaults to 1.
+
+    Returns:
+        dict[str, Any]: Result of the job, with status "done" or "failed"
+    """
+    options = {
+        name: value for name, value in job.items() if name not in REQUIRED_JOB_KEYS
+    }
+    options["threads"] = threads
+
+    result: dict[str, Any] = {
+        "input": job["input"],
+        "output": job["output"],
+        "status": "done",
+        "error": None,
+    }
+
+    start_time = time.monotonic()
+    try:
+        b = Bufferer(
+            input_file=job["input"],
+            output_file=job["output"],
+            buflist=job["buflist"],
+            **options,
+        )
+        result["timings"] = b.insert_buf_audiovisual().to_dict()
+        if not b.dry and not os.path.isfile(b.output_file):
+            raise RuntimeError("no output file was written")
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = str(e)
+    result["elapsed"] = round(time.monotonic() - start_time, 3)
+
+    return result
+
+
+def run_batch(
+    jobs: list[dict[str, Any]],
+    max_workers: int | None = None,
+    cpu_budget: int | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Run batch jobs on a bounded process pool.
+
+    The CPU budget is shared between the workers, so that each job gets
+    cpu_budget // max_workers ffmpeg threads (at least one).
+
+    Args:
+        jobs (list[dict[str, Any]]): Jobs as loaded from the manifest
+        max_workers (int | None, optional): Number of parallel jobs. Defaults to the CPU count.
+        cpu_budget (int | None, optional): Total number of CPUs to use. Defaults to the CPU count.
+
+    Returns:
+        list[dict[str, Any]]: Results, in the same order as the jobs
+    """
+    cpu_count = os.cpu_count() or 1
+    cpu_budget = cpu_budget or cpu_count
+    max_workers = max(1, min(max_workers or cpu_budget, len(jobs) or 1))
+    threads = max(1, cpu_budget // max_workers)
+
+    logger.info(
+        f"running {len(jobs)} jobs on {max_workers} workers with {threads} threads each"
+    )
+
+    results: list[dict[str, Any]] = [{} for _ in jobs]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(run_job, job, threads): index
+            for index, job in enumerate(jobs)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            index = futures[future]
+            results[index] = future.result()
+            if results[index]["status"] == "done":
+                logger.info(
+                    f"job {index} done in {results[index]['elapsed']}s: {results[index]['output']}"
+                )
+            else:
+                logger.error(f"job {index} failed: {results[index]['error']}")
+
+    return results
@@ -1,16 +1,151 @@
 from __future__ import annotations
 
+import asyncio
+import concurrent.futures
+import copy
 import datetime
-import json
+import functools
+import itertools
 import logging
 import os
-import re
 import shlex
+import shutil
+import stat
 import subprocess
-from typing import Optional
+import tempfile
+import time
+import uuid
+from collections.abc import Generator
+from fractions import Fraction
+from typing import Callable, Optional, Union
+
+from ._buflist import EventTable, normalize_buflist, parse_buflist
+from ._cache import evict_lru, get_content_hash, get_file_key, touch
+from ._mezzanine import (
+    DEFAULT_MEZZANINE_CACHE_SIZE,
+    get_mezzanine_cmd,
+    get_mezzanine_file,
+)
+from ._probe import (
+    MediaInfo,
+    format_duration,
+    get_ffprobe_path,
+    get_filter_script_option,
+    get_filter_thread_options,
+    parse_duration,
+    probe,
+    probe_async,
+)
+from ._progress import (
+    Progress,
+    ProgressParser,
+    StageTiming,
+    TimingReport,
+    wait_for_process,
+)
+from ._raw import (
+    RAW_PIX_FMT,
+    StallRenderer,
+    get_stall_frames,
+    load_numpy,
+    render_video,
+)
+from ._result_cache import (
+    BITEXACT_OPTIONS,
+    DEFAULT_RESULT_CACHE_SIZE,
+    get_result_file,
+    get_result_key,
+    link_or_copy,
+)
+from ._smart import (
+    PARAMETER_SET_FILTERS,
+    get_codec_for_encoder,
+    get_keyframe_times,
+    get_matching_encoder_options,
+    get_video_stream_info,
+    plan_segments,
+)
+from ._spinner import get_cached_spinner
 
 logger = logging.getLogger("bufferer")
 
+GRAPH_STRATEGIES = ("loop", "retime")
+
+AUDIO_ENGINES = ("loop", "splice")
+
+VIDEO_ENGINES = ("filter", "raw")
+
+# encoder options for fast intermediate codecs
+INTERMEDIATE_CODEC_OPTIONS = {
+    "rawvideo": [],
+    "utvideo": [],
+    # many slices let ffv1 encode and decode on all cores
+    "ffv1": ["-level", "3", "-slices", "16", "-slicecrc", "0"],
+}
+
+# approximate size of encoded video relative to the raw frames, for the free space check;
+# other (usually lossy) codecs are assumed to compress at least ten times
+INTERMEDIATE_SIZE_RATIOS = {"rawvideo": 1.0, "utvideo": 0.6, "ffv1": 0.5}
+DEFAULT_SIZE_RATIO = 0.1
+
+# bits per pixel of common pixel formats, others are assumed to have 24
+PIX_FMT_BITS = {
+    "gray": 8,
+    "yuv420p": 12,
+    "nv12": 12,
+    "yuv422p": 16,
+    "yuv420p10le": 24,
+    "yuv444p": 24,
+    "rgb24": 24,
+    "rgba": 32,
+}
+
+# a processing step: stage, command (or function running the stage) and whether it writes to stdout
+Step = tuple[str, Union[list[str], functools.partial[None]], bool]
+
+# outputs that write to the standard output
+STDOUT_OUTPUTS = ("-", "pipe:", "pipe:1")
+
+# stages that write the final output file
+OUTPUT_STAGES = ("single_pass", "merge")
+
+# options that affect the output, besides the input, spinner and buffering events,
+# for the result cache
+RESULT_CACHE_OPTIONS = (
+    "speed",
+    "trim",
+    "vcodec",
+    "acodec",
+    "pixfmt",
+    "brightness",
+    "blur",
+    "audio_disable",
+    "black_frame",
+    "force_framerate",
+    "skipping",
+    "disable_spinner",
+    "single_pass",
+    "smart_render",
+    "graph_strategy",
+    "blur_once",
+    "output_format",
+    "fragmented",
+    "audio_engine",
+    "video_engine",
+    "intermediate_codec",
+    "mezzanine_cache",
+)
+
+# from this number of events on, the stall effects are switched on and off by
+# sendcmd at the event times, instead of an enable expression with one term per event
+ENABLE_COMMANDS_MIN_EVENTS = 16
+
+# filter graphs from this length on are passed to ffmpeg in a script file
+FILTER_SCRIPT_MIN_LENGTH = 4096
+
+# formats that need fragmentation to be written to a non-seekable output
+FRAGMENTABLE_FORMATS = ("mp4", "mov", "ismv", "ipod")
+
 
 class Bufferer:
     """
@@ -19,7 +154,9 @@ class Bufferer:
     Args:
         input_file (str): Input file
         output_file (str): Output file
-        buflist (list[list] | str): Buffering list
+        buflist (list[list] | str): Buffering list, as [position, duration] pairs in seconds,
+            a NumPy array, a JSON or CSV string, or the path to a JSON or CSV file.
+            The events are sorted, and events that freeze the same frame are merged.
         spinner (str, optional): Spinner image. Defaults to "spinners/spinner-256-white.png".
         disable_spinner (bool, optional): Disable spinner. Defaults to False.
         speed (int, optional): Speed of spinner. Defaults to 2.
@@ -36,6 +173,49 @@ class Bufferer:
         force_framerate (bool, optional): Force framerate. Defaults to False.
         skipping (bool, optional): Enable skipping. Defaults to False.
         ffmpeg_path (str, optional): Path to ffmpeg executable. Defaults to "ffmpeg".
+        single_pass (bool, optional): Process audio and video in one ffmpeg run, without intermediate files. Defaults to False.
+        smart_render (bool, optional): Only re-encode the GOPs containing buffering events, and stream-copy the rest. Defaults to False.
+        ffprobe_path (str | None, optional): Path to ffprobe executable. Defaults to the ffprobe next to ffmpeg_path.
+        threads (int, optional): Number of threads for each ffmpeg run. With 2 or more, the video and audio passes
+            run concurrently, sharing the threads between them; with 1, they run one after the other. Defaults to 1.
+        media_info (MediaInfo | None, optional): Already probed info about the input file. Defaults to None (probe the input).
+        probe_cache (bool, optional): Cache probe results on disk, keyed by path, size and modification time. Defaults to False.
+        cache_dir (str | None, optional): Base directory for caches. Defaults to ~/.cache/bufferer.
+        graph_strategy (str, optional): How to freeze video frames, either "loop" (one loop filter per event)
+            or "retime" (shift all timestamps in one setpts filter and repeat frames to fill the gaps). With skipping,
+            "retime" drops the skipped frames in the same pass instead of trimming them in a second pass. Defaults to "loop".
+        spinner_cache (bool, optional): Pre-render the spinner once per spinner, speed and frame rate, and reuse it across runs.
+            Defaults to False.
+        blur_once (bool, optional): Blur and darken each frozen frame once before repeating it, instead of processing
+            every repeated frame. The repeated copy of the frozen frame after the stall is then blurred, too. Requires the
+            "retime" graph strategy or the raw video engine. Defaults to False.
+        output_format (str | None, optional): Output container format (see `ffmpeg -muxers`), required when writing to stdout,
+            a named pipe or a file without extension. Defaults to None (guess from the output file name).
+        fragmented (bool, optional): Write fragmented MP4/MOV output, which can be read while it is being written.
+            Always enabled for MP4/MOV written to stdout or a named pipe. Defaults to False.
+        progress_callback (Callable[[Progress], None] | None, optional): Function called with the progress of each
+            ffmpeg run, parsed from `ffmpeg -progress`. Defaults to None.
+        audio_engine (str, optional): How to insert the audio stalls, either "loop" (loop one sample per event and mute it)
+            or "splice" (cut the input at the events and splice in generated silence, sample-exactly). Defaults to "loop".
+        video_engine (str, optional): How to insert the video stalls, either "filter" (ffmpeg filter graph) or "raw"
+            (pipe the decoded frames through Python, which repeats the frozen frames frame-exactly and draws the
+            stall effects with NumPy, see the "raw" extra). Defaults to "filter".
+        tmp_dir (str | None, optional): Directory for the intermediate files, e.g. a tmpfs like /dev/shm.
+            Defaults to None (next to the output file).
+        intermediate_codec (str | None, optional): Video encoder for the intermediate files, e.g. "rawvideo", "utvideo"
+            or "ffv1" (with many slices). The merge step then encodes the video with vcodec. Defaults to None (use vcodec).
+        start (str | float | None, optional): Start the output at this position of the input, in seconds or "HH:MM:SS.msec"
+            format. Only the part of the input needed for the output (see trim) is decoded, and the buffering events
+            are shifted accordingly. Defaults to None (start at the beginning).
+        mezzanine_cache (bool, optional): Decode the input once into a lossless intraframe mezzanine in the cache,
+            keyed by content hash and pixfmt, and read from it instead of the input in this and later runs. Defaults to False.
+        mezzanine_cache_size (float, optional): Size limit of the mezzanine cache in GB; the least recently used
+            mezzanines are removed when it is exceeded. Defaults to 50.
+        result_cache (bool, optional): Look up the output in a cache keyed by the input content and all options that
+            affect the output, and hardlink or copy it instead of rendering it again. Outputs are written with
+            bitexact flags, so that identical renders are identical files. Defaults to False.
+        result_cache_size (float, optional): Size limit of the result cache in GB; the least recently used results
+            are removed when it is exceeded. Defaults to 50.
 
     Raises:
         RuntimeError: Buffering list parameter not properly formatted. Use a list like [[0, 1], [5, 10]]
@@ -62,6 +242,28 @@ class Bufferer:
         force_framerate: bool = False,
         skipping: bool = False,
         ffmpeg_path: str = "ffmpeg",
+        single_pass: bool = False,
+        smart_render: bool = False,
+        ffprobe_path: str | None = None,
+        threads: int = 1,
+        media_info: MediaInfo | None = None,
+        probe_cache: bool = False,
+        cache_dir: str | None = None,
+        graph_strategy: str = "loop",
+        spinner_cache: bool = False,
+        blur_once: bool = False,
+        output_format: str | None = None,
+        fragmented: bool = False,
+        progress_callback: Callable[[Progress], None] | None = None,
+        audio_engine: str = "loop",
+        video_engine: str = "filter",
+        tmp_dir: str | None = None,
+        intermediate_codec: str | None = None,
+        start: str | float | None = None,
+        mezzanine_cache: bool = False,
+        mezzanine_cache_size: float = DEFAULT_MEZZANINE_CACHE_SIZE,
+        result_cache: bool = False,
+        result_cache_size: float = DEFAULT_RESULT_CACHE_SIZE,
     ):
         # assign arguments from commandline
         self.input_file = input_file
@@ -82,33 +284,87 @@ class Bufferer:
         self.force_framerate = force_framerate
         self.skipping = skipping
         self.ffmpeg_path = ffmpeg_path
+        self.single_pass = single_pass
+        self.smart_render = smart_render
+        self.ffprobe_path = ffprobe_path or get_ffprobe_path(self.ffmpeg_path)
+        self.threads = threads
+        self.media_info = media_info
+        self.probe_cache = probe_cache
+        self.cache_dir = cache_dir
+        self.graph_strategy = graph_strategy
+        self.spinner_cache = spinner_cache
+        self.blur_once = blur_once
+        self.output_format = output_format
+        self.fragmented = fragmented
+        self.progress_callback = progress_callback
+        self.audio_engine = audio_engine
+        self.video_engine = video_engine
+        self.tmp_dir = tmp_dir
+        self.mezzanine_cache = mezzanine_cache
+        self.mezzanine_cache_size = mezzanine_cache_size
+        self.result_cache = result_cache
+        self.result_cache_size = result_cache_size
+        self.intermediate_codec = intermediate_codec
+        self.start = start
+
+        # input options that limit decoding to the part of the input that is needed
+        self.input_window_options: list[str] = []
+
+        # keeps the intermediate files of concurrent runs in a shared directory apart
+        self._tmp_id = uuid.uuid4().hex[:8]
+
+        # timings of the processing stages of the last run
+        self.timing_report = TimingReport()
+        # commands started by run_command that have not finished yet
+        self._running_processes: list[subprocess.Popen] = []
+        # prefix of the internal filter graph labels, to keep the labels of several
+        # outputs apart when they share one filter graph
+        self._label_prefix = ""
+        # filter graph files written for commands that have not run yet
+        self._filter_scripts: list[str] = []
+        # cached result of this render, see restore_cached_result()
+        self._result_file: str | None = None
+        self._result_restored = False
+        # encoder options that match the re-encoded parts of a smart render to the
+        # copied parts, see _can_smart_render()
+        self._smart_encoder_options: list[str] | None = None
+
+        # ffmpeg guesses the container format from the extension of the output file
+        if not self.output_format and (
+            self._is_streaming_output() or not os.path.splitext(self.output_file)[1]
+        ):
+            raise RuntimeError(
+                "An output format is required when writing to stdout, a named pipe or "
+                f"a file without extension ({self.output_file}), e.g. matroska or mp4"
+            )
 
-        if isinstance(buflist, str):
-            try:
-                self.buflist = json.loads(buflist)
-                if not isinstance(self.buflist[0], list):
-                    self.buflist = [self.buflist]
-            except json.JSONDecodeError as e:
-                buflist_mod = "[" + buflist + "]"
-                try:
-                    self.buflist = json.loads(buflist_mod)
-                except json.JSONDecodeError:
-                    raise RuntimeError(
-                        f"Buffering list parameter not properly formatted.\n"
-                        f"  Received: {buflist!r}\n"
-                        f"  JSON error: {e.msg} at position {e.pos}\n"
-                        f"  Expected format: '[[0, 1], [5, 10]]' or '[0, 1], [5, 10]'\n"
-                        f"  where each pair is [position_in_seconds, duration_in_seconds]"
-                    )
-            except (IndexError, TypeError):
-                raise RuntimeError(
-                    f"Buffering list parameter is empty or invalid.\n"
-                    f"  Received: {buflist!r}\n"
-                    f"  Expected format: '[[0, 1], [5, 10]]' or '[0, 1], [5, 10]'\n"
-                    f"  where each pair is [position_in_seconds, duration_in_seconds]"
-                )
-        else:
-            self.buflist = buflist
+        if self.graph_strategy not in GRAPH_STRATEGIES:
+            raise RuntimeError(
+                f"Unknown graph strategy {self.graph_strategy!r}, use one of: {', '.join(GRAPH_STRATEGIES)}"
+            )
+
+        if self.audio_engine not in AUDIO_ENGINES:
+            raise RuntimeError(
+                f"Unknown audio engine {self.audio_engine!r}, use one of: {', '.join(AUDIO_ENGINES)}"
+            )
+
+        if self.video_engine not in VIDEO_ENGINES:
+            raise RuntimeError(
+                f"Unknown video engine {self.video_engine!r}, use one of: {', '.join(VIDEO_ENGINES)}"
+            )
+
+        if (
+            self.blur_once
+            and self.graph_strategy == "loop"
+            and self.video_engine != "raw"
+        ):
+            # the loop filter repeats the frame before its start frame, so the frozen
+            # frame cannot be selected by its frame number
+            raise RuntimeError(
+                "Blurring once requires the retime graph strategy or the raw video engine"
+            )
+
+        self.buflist = parse_buflist(buflist)
 
         # presence of input streams
         self.has_video: bool = False
@@ -121,83 +377,272 @@ class Bufferer:
         self.input_duration: str | None = None
 
         # get info needed for processing (skip in dry mode to avoid running ffmpeg)
-        if self.dry:
+        validate_buflist = not (self.dry and self.media_info is None)
+        if self.dry and self.media_info is None:
             logger.warning(
                 "Dry run: skipping input file parsing. "
                 "Commands shown will use placeholder values."
             )
-            self.has_video = True
-            self.has_audio = not self.audio_disable
-            self.fps = 30.0
-            self.samplerate = 48000.0
-            self.video_resolution = "1920x1080"
-            self.input_duration = "00:00:10.000"
-        else:
-            self._parse_input()
+            self.media_info = MediaInfo(
+                has_video=True,
+                has_audio=True,
+                duration=10.0,
+                frame_rate="30/1",
+                width=1920,
+                height=1080,
+                sample_rate=48000,
+                channels=2,
+                channel_layout="stereo",
+            )
+        self._parse_input()
+        assert self.media_info is not None
+        self.buflist = normalize_buflist(
+            self.buflist,
+            self._get_frame_rate(),
+            self.media_info.duration if validate_buflist else None,
+        )
+        self._set_input_window()
+
+    @classmethod
+    async def create(
+        cls, input_file: str, output_file: str, buflist: list[list] | str, **kwargs
+    ) -> Bufferer:
+        """
+        Create a Bufferer, probing the input without blocking the event loop.
+
+        Args:
+            input_file (str): Input file
+            output_file (str): Output file
+            buflist (list[list] | str): Buffering list
+            **kwargs: Further options, see `Bufferer`
 
-    def run_command(self, cmd: list[str]) -> Optional[str]:
+        Returns:
+            Bufferer: Bufferer for the input
+        """
+        if kwargs.get("media_info") is None and not kwargs.get("dry", False):
+            kwargs["media_info"] = await probe_async(
+                input_file,
+                ffprobe_path=kwargs.get("ffprobe_path")
+                or get_ffprobe_path(kwargs.get("ffmpeg_path", "ffmpeg")),
+                use_cache=kwargs.get("probe_cache", False),
+                cache_dir=kwargs.get("cache_dir"),
+            )
+        return cls(input_file, output_file, buflist, **kwargs)
+
+    def run_command(
+        self, cmd: list[str], pass_stdout: bool = False, stage: str | None = None
+    ) -> Optional[str]:
         """
         Run a command directly.
 
         Args:
             cmd (list[str]): Command to run
+            pass_stdout (bool, optional): Let the command write to our stdout instead of capturing it. Defaults to False.
+            stage (str | None, optional): Processing stage, for progress reports and timings. Defaults to None.
 
         Returns:
             Optional[str]: Output of the command
         """
+        report_progress = self.progress_callback is not None and stage is not None
+        if report_progress:
+            cmd = [cmd[0], "-progress", "pipe:2", "-nostats", *cmd[1:]]
+
         logger.info(" ".join([shlex.quote(c) for c in cmd]))
         if self.dry:
             return None
 
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
+        try:
+            return self._run_command(cmd, pass_stdout, stage)
+        finally:
+            self._remove_filter_scripts(cmd)
+
+    def _run_command(
+        self, cmd: list[str], pass_stdout: bool, stage: str | None
+    ) -> Optional[str]:
+        """
+        Run a command directly, see `run_command()`
+        """
+        report_progress = self.progress_callback is not None and stage is not None
+        start_time = time.monotonic()
+        if stage is None:
+            process = subprocess.Popen(
+                cmd,
+                stdout=None if pass_stdout else subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            stdout, stderr = process.communicate()
+        else:
+            # read stderr ourselves, so that we can get the resource usage of the process
+            process = subprocess.Popen(
+                cmd,
+                stdout=None if pass_stdout else subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            self._running_processes.append(process)
+            try:
+                stdout = b""
+                stderr = self._read_stderr(
+                    process,
+                    ProgressParser(stage, self._get_output_duration())
+                    if report_progress
+                    else None,
+                )
+                cpu_time, max_rss = wait_for_process(process)
+            finally:
+                self._running_processes.remove(process)
+            self.timing_report.stages.append(
+                StageTiming(
+                    stage,
+                    round(time.monotonic() - start_time, 3),
+                    cpu_time=cpu_time,
+                    max_rss=max_rss,
+                    output_bytes=self._get_file_size(cmd[-1]),
+                    work=self._get_stage_work(stage),
+                )
+            )
 
         if process.returncode == 0:
-            return stdout.decode("utf-8") + stderr.decode("utf-8")
+            return (stdout or b"").decode("utf-8") + stderr.decode("utf-8")
         else:
             raise RuntimeError(
                 f"running command: {' '.join(cmd)}: {stderr.decode('utf-8')}"
             )
 
-    def _parse_input(self):
+    async def run_command_async(
+        self, cmd: list[str], pass_stdout: bool = False, stage: str | None = None
+    ) -> Optional[str]:
         """
-        Parse various info from the input file
+        Run a command without blocking the event loop. Cancelling the task kills the command.
+
+        Args:
+            cmd (list[str]): Command to run
+            pass_stdout (bool, optional): Let the command write to our stdout instead of capturing it. Defaults to False.
+            stage (str | None, optional): Processing stage, for progress reports and timings. Defaults to None.
+
+        Returns:
+            Optional[str]: Output of the command
         """
+        report_progress = self.progress_callback is not None and stage is not None
+        if report_progress:
+            cmd = [cmd[0], "-progress", "pipe:2", "-nostats", *cmd[1:]]
+
+        logger.info(" ".join([shlex.quote(c) for c in cmd]))
+        if self.dry:
+            return None
+
+        try:
+            return await self._run_command_async(cmd, pass_stdout, stage)
+        finally:
+            self._remove_filter_scripts(cmd)
 
-        p = subprocess.Popen(
-            [self.ffmpeg_path, "-i", self.input_file],
-            stdout=subprocess.PIPE,
+    async def _run_command_async(
+        self, cmd: list[str], pass_stdout: bool, stage: str | None
+    ) -> Optional[str]:
+        """
+        Run a command without blocking the event loop, see `run_command_async()`
+        """
+        report_progress = self.progress_callback is not None and stage is not None
+        start_time = time.monotonic()
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=None
+            if pass_stdout
+            else (subprocess.DEVNULL if report_progress else subprocess.PIPE),
             stderr=subprocess.PIPE,
         )
-        _, stderr = p.communicate()
-        output = stderr.decode("utf-8")
+        try:
+            if report_progress:
+                assert process.stderr is not None
+                parser = ProgressParser(str(stage), self._get_output_duration())
+                stderr_lines: list[bytes] = []
+                async for line in process.stderr:
+                    self._handle_stderr_line(parser, line, stderr_lines)
+                stdout, stderr = b"", b"".join(stderr_lines)
+                await process.wait()
+            else:
+                stdout, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                logger.info(f"killing cancelled command: {shlex.quote(cmd[0])}")
+                process.kill()
+                await process.wait()
+            raise
+        if stage is not None:
+            self.timing_report.stages.append(
+                StageTiming(
+                    stage,
+                    round(time.monotonic() - start_time, 3),
+                    output_bytes=self._get_file_size(cmd[-1]),
+                    work=self._get_stage_work(stage),
+                )
+            )
 
-        if video_match := re.compile(r"Video: (.*)").search(output):
-            self.has_video = True
-            video_line = video_match.group(1)
-            if fps_match := re.compile(r".*, ([0-9.]+) fps,.*").search(video_line):
-                self.fps = float(fps_match.group(1))
+        if process.returncode == 0:
+            return (stdout or b"").decode("utf-8") + stderr.decode("utf-8")
+        else:
+            raise RuntimeError(
+                f"running command: {' '.join(cmd)}: {stderr.decode('utf-8')}"
+            )
 
-            if video_resolution_match := re.compile(r".*, (\d+x\d+)[, ].*").search(
-                video_line
-            ):
-                self.video_resolution = video_resolution_match.group(1)
+    def _read_stderr(
+        self, process: subprocess.Popen, parser: ProgressParser | None = None
+    ) -> bytes:
+        """
+        Read the stderr of an ffmpeg process until it closes, reporting its progress if a parser is given
 
-        if (
-            audio_match := re.compile(r"Audio: (.*)").search(output)
-        ) and not self.audio_disable:
+        Returns:
+            bytes: The stderr output, without the progress reports
+        """
+        assert process.stderr is not None
+        if parser is None:
+            return process.stderr.read()
+        stderr_lines: list[bytes] = []
+        for line in process.stderr:
+            self._handle_stderr_line(parser, line, stderr_lines)
+        return b"".join(stderr_lines)
+
+    def _handle_stderr_line(
+        self, parser: ProgressParser, line: bytes, stderr_lines: list[bytes]
+    ):
+        """
+        Handle a line of ffmpeg's stderr: report progress, or keep it as log output
+        """
+        decoded_line = line.decode("utf-8", errors="replace")
+        if not parser.is_progress_line(decoded_line):
+            stderr_lines.append(line)
+            return
+        progress = parser.feed(decoded_line)
+        if progress is not None and self.progress_callback is not None:
+            self.progress_callback(progress)
+
+    def _parse_input(self):
+        """
+        Parse various info from the input file
+        """
+        if self.media_info is None:
+            self.media_info = probe(
+                self.input_file,
+                ffprobe_path=self.ffprobe_path,
+                use_cache=self.probe_cache,
+                cache_dir=self.cache_dir,
+            )
+
+        if self.media_info.has_video:
+            self.has_video = True
+            self.fps = self.media_info.fps
+            self.video_resolution = self.media_info.video_resolution
+
+        if self.media_info.has_audio and not self.audio_disable:
             self.has_audio = True
-            audio_line = audio_match.group(1)
-            if hz_match := re.compile(r".*, ([0-9]+) Hz,.*").search(audio_line):
-                self.samplerate = float(hz_match.group(1))
+            if self.media_info.sample_rate:
+                self.samplerate = float(self.media_info.sample_rate)
 
         if not (self.has_audio or self.has_video):
             raise RuntimeError("file has no video or audio stream")
 
-        if input_duration_match := re.compile(
-            r".* Duration: ([0-9.]+:[0-9.]+:[0-9.]+\.[0-9.]+), .*"
-        ).search(output):
-            self.input_duration = input_duration_match.group(1)
+        if self.media_info.duration is not None:
+            self.input_duration = format_duration(self.media_info.duration)
 
         if not self.fps:
             raise RuntimeError("Could not detect video fps from input file!")
@@ -208,92 +653,310 @@ class Bufferer:
         if not self.input_duration:
             raise RuntimeError("Could not detect duration from input file!")
 
-    def _generate_loop_cmds(self):
+    def _set_input_window(self):
         """
-        Construct the looping commands
+        Limit processing to the part of the input needed for the output, based on
+        the start position and the trim length, and shift the buffering events to it
         """
+        if self.start is None and not self.trim:
+            return
 
-        vloop_cmds = []
-        aloop_cmds = []
-        venable_cmds = []
-        aenable_cmds = []
+        start = parse_duration(self.start) if self.start is not None else 0.0
+        duration = self._get_duration_in_seconds()
+        if start >= duration:
+            raise RuntimeError(
+                f"Start position {self.start} is beyond the end of the input ({self.input_duration})"
+            )
 
-        total_vlooped = 0
-        total_alooped = 0
-        total_buf_len = 0
+        # drop the events before the start and shift the others
+        buflist = [
+            [round(buf_pos - start, 6), buf_len]
+            for buf_pos, buf_len in sorted(self.buflist)
+            if buf_pos >= start
+        ]
 
-        self.enable_black_cmd = None
+        window_length = duration - start
+        if self.trim:
+            window_length = min(
+                window_length, self._get_input_length_for_output(buflist)
+            )
+            buflist = [event for event in buflist if event[0] < window_length]
 
-        # trim_cmds are only used for freeze
-        trim_cmds = []
-        last_buf_end = 0
+        logger.debug(
+            f"processing {window_length:.3f} s of the input, starting at {start:.3f} s"
+        )
+        self.buflist = buflist
+        self.input_duration = format_duration(window_length)
+        self.input_window_options = []
+        if start > 0:
+            self.input_window_options.extend(["-ss", str(start)])
+        if window_length < duration - start:
+            self.input_window_options.extend(["-t", str(round(window_length, 6))])
+
+    def _get_input_length_for_output(self, buflist: list[list]) -> float:
+        """
+        Get the length of the input needed to fill the trimmed output, including
+        one extra frame so that the last frozen frame is decoded
 
-        for buf_event in self.buflist:
-            buf_pos, buf_len = buf_event
-            buf_pos_enable = round(total_buf_len + buf_pos, 3)
-            buf_len_enable = round(buf_pos_enable + buf_len, 3)
+        Args:
+            buflist (list[list]): Buffering events, sorted by position
 
-            # FIXME: the enable time is slightly smaller than what one would expect, with video
-            buf_len_enable_video = buf_len_enable - 0.001
+        Returns:
+            float: Length in seconds
+        """
+        output_length = parse_duration(str(self.trim))
+        frame_duration = 1 / self.fps if self.fps else 0.0
+        if self.skipping:
+            # skipping keeps the timeline of the input
+            return output_length + frame_duration
+
+        total_buf_len = 0.0
+        for buf_pos, buf_len in buflist:
+            if buf_pos + total_buf_len >= output_length:
+                break
+            total_buf_len += buf_len
+            if buf_pos + total_buf_len >= output_length:
+                # the output ends during this event
+                return buf_pos + frame_duration
+        return output_length - total_buf_len + frame_duration
 
-            total_buf_len = total_buf_len + buf_len
+    def _generate_loop_cmds(self):
+        """
+        Construct the looping commands
+        """
+        if self.fps is None:
+            raise RuntimeError("fps not specified!")
 
-            if self.has_video:
-                # offset buf_position by the total number of looped frames
-                buf_pos_frames = int(self.fps * buf_pos) + total_vlooped
-                # FIXME: the number of frames needs to be 1 shorter?
-                buf_len_frames = int(self.fps * buf_len)
+        events = EventTable.compile(
+            self.buflist,
+            self._get_frame_rate(),
+            int(self.samplerate) if self.has_audio and self.samplerate else None,
+        )
 
-                loop_cmd = f"loop=loop={buf_len_frames}:size=1:start={buf_pos_frames},setpts=N/FRAME_RATE/TB"
-                vloop_cmds.append(loop_cmd)
+        # stall time inserted before each event, for the enable times in the output
+        buf_offsets = [0.0, *itertools.accumulate(events.durations)][:-1]
+        if self._skips_in_video_graph():
+            # skipping in the same pass keeps the timeline of the input
+            enable_starts = [round(buf_pos, 3) for buf_pos in events.positions]
+        else:
+            enable_starts = [
+                round(buf_offset + buf_pos, 3)
+                for buf_offset, buf_pos in zip(buf_offsets, events.positions)
+            ]
+        enable_ends = [
+            round(enable_start + buf_len, 3)
+            for enable_start, buf_len in zip(enable_starts, events.durations)
+        ]
 
-                total_vlooped += buf_len_frames
+        # FIXME: the enable time is slightly smaller than what one would expect, with video
+        black_frame_ends = [
+            enable_end - 0.001
+            for enable_start, enable_end in zip(enable_starts, enable_ends)
+            if int(enable_start) == 0
+        ]
+        self.enable_black_cmd = (
+            f"between(t,0,{black_frame_ends[-1]})" if black_frame_ends else None
+        )
 
-                venable_cmd = f"between(t,{buf_pos_enable},{buf_len_enable_video})"
-                venable_cmds.append(venable_cmd)
+        # intervals in which the stall effects are enabled
+        self.venable_intervals = [
+            (enable_start, enable_end - 0.001)
+            for enable_start, enable_end in zip(enable_starts, enable_ends)
+        ]
+        self.aenable_intervals = list(zip(enable_starts, enable_ends))
 
-                trim_cmd = f"trim=start_frame={last_buf_end}:end_frame={buf_pos_frames + buf_len_frames},setpts=PTS-STARTPTS"
-                trim_cmds.append(trim_cmd)
-                last_buf_end = buf_pos_frames + 2 * buf_len_frames
+        self.vloop_cmd = ""
+        self.venable_cmd = ""
+        self.vfrozen_cmd = ""
+        self.trim_cmds = []
+        if self.has_video:
+            frame_positions = events.frame_positions
+            frame_lengths = events.frame_lengths
+            # offset each position by the number of frames looped before it
+            vlooped = [0, *itertools.accumulate(frame_lengths)]
+            total_vlooped = vlooped.pop()
+            output_frame_positions = [
+                buf_pos_frames + looped
+                for buf_pos_frames, looped in zip(frame_positions, vlooped)
+            ]
 
-            if self.has_audio:
-                # offset buf_position by the total number of looped samples
-                buf_pos_samples = int(self.samplerate * buf_pos) + total_alooped
-                buf_len_samples = int(self.samplerate * buf_len)
+            frame_rate = self.media_info.frame_rate if self.media_info else None
+            if self._skips_in_video_graph():
+                # drop the skipped frames, and let the fps filter fill the gaps by
+                # repeating the frozen frames; the timestamps stay those of the input
+                vskip_terms = "+".join(
+                    f"between(n,{buf_pos_frames + 1},{buf_pos_frames + buf_len_frames - 1})"
+                    for buf_pos_frames, buf_len_frames in zip(
+                        frame_positions, frame_lengths
+                    )
+                    if buf_len_frames > 1
+                )
+                select_cmd = f"select='not({vskip_terms})'," if vskip_terms else ""
+                self.vloop_cmd = f"{select_cmd}fps=fps={frame_rate or self.fps}"
+            elif self.graph_strategy == "retime":
+                # shift all frames after the frozen ones in a single filter, and let
+                # the fps filter fill the gaps by repeating the frozen frames
+                vretime_terms = "".join(
+                    f"+{buf_len_frames}*gt(N,{buf_pos_frames})"
+                    for buf_pos_frames, buf_len_frames in zip(
+                        frame_positions, frame_lengths
+                    )
+                )
+                self.vloop_cmd = (
+                    f"setpts='(N{vretime_terms})/FRAME_RATE/TB',"
+                    f"fps=fps={frame_rate or self.fps}"
+                )
+            else:
+                # FIXME: the number of frames needs to be 1 shorter?
+                # without events, e.g. when none is in the input window, the video passes through
+                self.vloop_cmd = (
+                    ",".join(
+                        f"loop=loop={buf_len_frames}:size=1:start={buf_pos_frames},setpts=N/FRAME_RATE/TB"
+                        for buf_pos_frames, buf_len_frames in zip(
+                            output_frame_positions, frame_lengths
+                        )
+                    )
+                    or "null"
+                )
+
+            if not self._uses_enable_commands():
+                self.venable_cmd = (
+                    "+".join(
+                        f"between(t,{enable_start},{enable_end})"
+                        for enable_start, enable_end in self.venable_intervals
+                    )
+                    or "0"
+                )
+            # the frozen frames, on the original frame numbers
+            self.vfrozen_cmd = "+".join(
+                f"eq(n,{buf_pos_frames})" for buf_pos_frames in frame_positions
+            )
 
-                aloop_cmd = f"aloop=loop={buf_len_samples}:size=1:start={buf_pos_samples},asetpts=N/SAMPLE_RATE/TB"
-                aloop_cmds.append(aloop_cmd)
+            if self.skipping:
+                # trim_cmds are only used for freeze; each piece ends after the
+                # looped frames, and the next one skips as many frames of the input
+                trim_starts = [0] + [
+                    buf_pos_frames + 2 * buf_len_frames
+                    for buf_pos_frames, buf_len_frames in zip(
+                        output_frame_positions, frame_lengths
+                    )
+                ]
+                # needs an extra trim at the end to get the end of the file
+                trim_ends = [
+                    buf_pos_frames + buf_len_frames
+                    for buf_pos_frames, buf_len_frames in zip(
+                        output_frame_positions, frame_lengths
+                    )
+                ] + [int(self._get_duration_in_seconds() * self.fps) + total_vlooped]
+                self.trim_cmds = [
+                    f"trim=start_frame={trim_start}:end_frame={trim_end},setpts=PTS-STARTPTS"
+                    for trim_start, trim_end in zip(trim_starts, trim_ends)
+                ]
+
+        self.aloop_cmd = ""
+        self.aenable_cmd = ""
+        self.asplice_events = []
+        if self.has_audio:
+            sample_positions = events.sample_positions
+            sample_lengths = events.sample_lengths
+            if self.audio_engine == "splice":
+                # the events, on the original sample numbers
+                self.asplice_events = list(zip(sample_positions, sample_lengths))
+            else:
+                # offset each position by the number of samples looped before it
+                alooped = itertools.accumulate(sample_lengths, initial=0)
+                self.aloop_cmd = (
+                    ",".join(
+                        f"aloop=loop={buf_len_samples}:size=1:start={buf_pos_samples + looped},asetpts=N/SAMPLE_RATE/TB"
+                        for buf_pos_samples, buf_len_samples, looped in zip(
+                            sample_positions, sample_lengths, alooped
+                        )
+                    )
+                    or "anull"
+                )
+                if not self._uses_enable_commands():
+                    self.aenable_cmd = (
+                        "+".join(
+                            f"between(t,{enable_start},{enable_end})"
+                            for enable_start, enable_end in self.aenable_intervals
+                        )
+                        or "0"
+                    )
 
-                total_alooped += buf_len_samples
+    def _uses_enable_commands(self) -> bool:
+        """
+        Whether the stall effects are switched with sendcmd instead of enable expressions
+        """
+        return len(self.buflist) >= ENABLE_COMMANDS_MIN_EVENTS
 
-                aenable_cmd = f"between(t,{buf_pos_enable},{buf_len_enable})"
-                aenable_cmds.append(aenable_cmd)
+    def _get_enable_commands(
+        self, intervals: list[tuple[float, float]], targets: list[str]
+    ) -> str:
+        """
+        Get the sendcmd commands that enable filters during the given intervals, so
+        that each frame is only checked against the current interval rather than
+        evaluating an expression with one term per event
 
-            if int(buf_pos_enable) == 0:
-                self.enable_black_cmd = f"between(t,0,{buf_len_enable_video})"
+        Args:
+            intervals (list[tuple[float, float]]): Start and end times
+            targets (list[str]): Names of the filters to enable, e.g. "overlay@stall"
 
-        # needs an extra trim at the end to get the end of the file
-        if self.fps is None:
-            raise RuntimeError("fps not specified!")
+        Returns:
+            str: Commands, for the "commands" option of sendcmd or asendcmd
+        """
+        enter = ",".join(f"[enter] {target} enable 1" for target in targets)
+        leave = ",".join(f"[leave] {target} enable 0" for target in targets)
+        return "".join(f"{start}-{end} {enter},{leave};" for start, end in intervals)
 
-        duration_in_frames = (
-            int(self._get_duration_in_seconds() * self.fps) + total_vlooped
+    def _skips_in_video_graph(self) -> bool:
+        """
+        Whether skipped frames are dropped while inserting the buffering, so that
+        no separate trimming pass is needed
+        """
+        return self.skipping and (
+            self.graph_strategy == "retime" or self.video_engine == "raw"
         )
-        trim_cmd = f"trim=start_frame={last_buf_end}:end_frame={duration_in_frames},setpts=PTS-STARTPTS"
-        trim_cmds.append(trim_cmd)
 
-        self.vloop_cmd = (",").join(vloop_cmds)
-        self.aloop_cmd = (",").join(aloop_cmds)
-        self.trim_cmds = trim_cmds
-        self.venable_cmd = ("+").join(venable_cmds)
-        self.aenable_cmd = ("+").join(aenable_cmds)
+    def _is_streaming_output(self) -> bool:
+        """
+        Whether the output is written to stdout or a named pipe, i.e., a
+        non-seekable output that must be written in a single pass
+        """
+        if self.output_file in STDOUT_OUTPUTS:
+            return True
+        try:
+            return stat.S_ISFIFO(os.stat(self.output_file).st_mode)
+        except OSError:
+            return False
+
+    def _get_output_format_options(self) -> list[str]:
+        """
+        Get the ffmpeg options for the container format of the final output
+        """
+        options = []
+        if self.output_format:
+            options.extend(["-f", self.output_format])
+
+        output_format = (
+            self.output_format or os.path.splitext(self.output_file)[1].lstrip(".")
+        ).lower()
+        if output_format in FRAGMENTABLE_FORMATS and (
+            self.fragmented or self._is_streaming_output()
+        ):
+            options.extend(["-movflags", "+frag_keyframe+empty_moov+default_base_moof"])
+
+        if self.result_cache:
+            options.extend(BITEXACT_OPTIONS)
+
+        return options
 
     def _set_specs(self):
         """
         set various ffmpeg options
         """
 
-        if self.force_overwrite:
+        # a named pipe already exists, but must be written to anyway
+        if self.force_overwrite or self._is_streaming_output():
             self.overwrite_spec = "-y"
         else:
             self.overwrite_spec = "-n"
@@ -303,124 +966,879 @@ class Bufferer:
         else:
             self.trim_spec = None
 
-    def insert_buf_video(self):
-        """
-        Insert buffering into the video file
+    def _get_video_filters(
+        self, input_label: str = "[0:v]", output_label: str = "[outv]"
+    ) -> list[str]:
         """
-        base_cmd = self._get_base_cmd()
+        Get the filter chains that insert buffering into the video stream
+
+        Args:
+            input_label (str, optional): Label of the input video pad. Defaults to "[0:v]".
+            output_label (str, optional): Label of the output video pad. Defaults to "[outv]".
 
+        Returns:
+            list[str]: Filter chains, to be joined with ";"
+        """
+        label = self._get_label
         vfilters = []
         if self.disable_spinner:
-            vfilters = [f"[0:v]{self.vloop_cmd}[outv]"]
+            vfilters = [f"{input_label}{self.vloop_cmd}{output_label}"]
         else:
+            vloop_cmd = self.vloop_cmd
+            if self.blur_once and self.vfrozen_cmd:
+                # process the frozen frames before they are repeated
+                vloop_cmd = (
+                    f"avgblur={self.blur}:enable='{self.vfrozen_cmd}',"
+                    f"eq=brightness={self.brightness}:enable='{self.vfrozen_cmd}',"
+                    f"{vloop_cmd}"
+                )
             if self.black_frame and self.enable_black_cmd:
                 vfilters.extend(
                     [
-                        f"[0:v]{self.vloop_cmd}[stallvid]",
-                        f"color=c=black:r={self.fps}[black]",
-                        "[black][stallvid]scale2ref[black2][stallvid]",
-                        f"[stallvid][black2]overlay=(main_w-overlay_w)/2:(main_h-overlay_h)/2:shortest=1:enable='{self.enable_black_cmd}'[stallvid2]",
+                        f"{input_label}{vloop_cmd}{label('stallvid')}",
+                        f"color=c=black:r={self.fps}{label('black')}",
+                        f"{label('black')}{label('stallvid')}scale2ref{label('black2')}{label('stallvid')}",
+                        f"{label('stallvid')}{label('black2')}overlay=(main_w-overlay_w)/2:(main_h-overlay_h)/2:shortest=1:enable='{self.enable_black_cmd}'{label('stallvid2')}",
+                    ]
+                )
+            else:
+                vfilters.append(
+                    f"{input_label}{vloop_cmd}{label('stallvid2')}",
+                )
+            stall_label = label("stallvid2")
+            if self._uses_enable_commands():
+                # the effects start disabled, and are switched on during the stalls
+                venable = "0"
+                targets = [f"overlay@{self._label_prefix}stall"]
+                if not self.blur_once:
+                    targets += [
+                        f"avgblur@{self._label_prefix}stall",
+                        f"eq@{self._label_prefix}stall",
                     ]
+                vfilters.append(
+                    f"{stall_label}sendcmd=c='{self._get_enable_commands(self.venable_intervals, targets)}'{label('stallvidcmd')}"
                 )
+                stall_label = label("stallvidcmd")
             else:
+                venable = f"'{self.venable_cmd}'"
+            if not self.blur_once:
                 vfilters.append(
-                    f"[0:v]{self.vloop_cmd}[stallvid2]",
+                    f"{stall_label}avgblur@{self._label_prefix}stall={self.blur}:enable={venable},eq@{self._label_prefix}stall=brightness={self.brightness}:enable={venable}{label('stallvidblur')}"
                 )
+                stall_label = label("stallvidblur")
             vfilters.extend(
                 [
-                    f"[stallvid2]avgblur={self.blur}:enable='{self.venable_cmd}',eq=brightness={self.brightness}:enable='{self.venable_cmd}'[stallvidblur]",
-                    f"movie=filename={self.spinner}:loop=0,setpts=N/(FRAME_RATE*TB)*{self.speed},fps=fps={self.fps}[spinner]",
-                    f"[stallvidblur][spinner]overlay=(main_w-overlay_w)/2:(main_h-overlay_h)/2:shortest=1:enable='{self.venable_cmd}'[outv]",
+                    f"{self._get_spinner_source()}{label('spinner')}",
+                    f"{stall_label}{label('spinner')}overlay@{self._label_prefix}stall=(main_w-overlay_w)/2:(main_h-overlay_h)/2:shortest=1:enable={venable}{output_label}",
                 ]
             )
 
-        filters = [";".join(vfilters)]
-
-        base_cmd.extend(["-filter_complex", ";".join(filters)])
-        base_cmd.extend(["-map", "[outv]"])
-        base_cmd.extend(["-c:v", self.vcodec, "-pix_fmt", self.pixfmt, "-vsync", "cfr"])
-        base_cmd.append(self._get_tmp_filename("video"))
+        return vfilters
 
-        self.run_command(base_cmd)
+    def _get_label(self, name: str) -> str:
+        """
+        Get an internal filter graph label, e.g. "[stallvid]"
+        """
+        return f"[{self._label_prefix}{name}]"
 
-    def insert_buf_audio(self):
+    def _get_spinner_source(self) -> str:
         """
-        Insert buffering into the audio file
+        Get the filter chain that produces the (endlessly looping) spinner animation
         """
+        if self.spinner_cache and not self.dry:
+            # a shortened loop would shift the animation, so the spinner is only
+            # overlaid from the cache if its loop repeats exactly
+            cached_spinner = get_cached_spinner(
+                self.spinner,
+                self.speed,
+                self._get_fps(),
+                ffmpeg_path=self.ffmpeg_path,
+                ffprobe_path=self.ffprobe_path,
+                cache_dir=self.cache_dir,
+                exact=True,
+            )
+            if cached_spinner is not None:
+                # the cached spinner is already at the right speed and frame rate
+                return f"movie=filename={cached_spinner}:loop=0,setpts=N/FRAME_RATE/TB"
 
-        base_cmd = self._get_base_cmd()
+        return f"movie=filename={self.spinner}:loop=0,setpts=N/(FRAME_RATE*TB)*{self.speed},fps=fps={self.fps}"
 
-        afilter = f"[0:a]{self.aloop_cmd},volume=0:enable='{self.aenable_cmd}'[outa]"
+    def _get_audio_filters(
+        self, input_label: str = "[0:a]", output_label: str = "[outa]"
+    ) -> list[str]:
+        """
+        Get the filter chains that insert buffering into the audio stream
 
-        base_cmd.extend(["-filter_complex", afilter])
-        base_cmd.extend(["-map", "[outa]"])
-        base_cmd.extend(["-c:a", self.acodec])
-        base_cmd.append(self._get_tmp_filename("audio"))
+        Args:
+            input_label (str, optional): Label of the input audio pad. Defaults to "[0:a]".
+            output_label (str, optional): Label of the output audio pad. Defaults to "[outa]".
+
+        Returns:
+            list[str]: Filter chains, to be joined with ";"
+        """
+        if self.audio_engine == "splice":
+            return self._get_audio_splice_filters(input_label, output_label)
+
+        if self._uses_enable_commands():
+            # the audio starts unmuted, and is muted during the stalls
+            target = f"volume@{self._label_prefix}stall"
+            return [
+                f"{input_label}{self.aloop_cmd},"
+                f"asendcmd=c='{self._get_enable_commands(self.aenable_intervals, [target])}',"
+                f"{target}=0:enable=0{output_label}"
+            ]
 
-        self.run_command(base_cmd)
+        return [
+            f"{input_label}{self.aloop_cmd},volume=0:enable='{self.aenable_cmd}'{output_label}"
+        ]
 
-    def trim_video(self):
+    def _get_audio_splice_filters(
+        self, input_label: str = "[0:a]", output_label: str = "[outa]"
+    ) -> list[str]:
         """
-        Remove frames after the frozen, repeated, ones to emulate freezing with skipping
+        Get the filter chains that cut the audio stream at the buffering events and
+        splice in silence, so that the cost depends on the number of events, not
+        on the number of stalled samples
+
+        Args:
+            input_label (str, optional): Label of the input audio pad. Defaults to "[0:a]".
+            output_label (str, optional): Label of the output audio pad. Defaults to "[outa]".
+
+        Returns:
+            list[str]: Filter chains, to be joined with ";"
         """
-        trim_extra_frames = [
-            self.ffmpeg_path,
-            self.overwrite_spec,
-        ]
+        # merge events at the same sample, and move events at the start before the first cut
+        silence_at: dict[int, int] = {}
+        for buf_pos_samples, buf_len_samples in self.asplice_events:
+            silence_at[buf_pos_samples] = (
+                silence_at.get(buf_pos_samples, 0) + buf_len_samples
+            )
+        leading_silence = silence_at.pop(0, 0)
+        cuts = sorted(silence_at)
 
-        trim_extra_frames.extend(
-            [
-                "-i",
-                self._get_tmp_filename("video"),
+        if self.samplerate is None:
+            raise RuntimeError("Could not detect audio sample rate from input file!")
+        sample_rate = int(self.samplerate)
+        channel_layout = self._get_channel_layout()
+
+        filters = []
+        if cuts:
+            segment_labels = [
+                self._get_label(f"aseg{index}") for index in range(len(cuts) + 1)
             ]
+            filters.append(
+                f"{input_label}asegment=samples={'|'.join(str(cut) for cut in cuts)}"
+                f"{''.join(segment_labels)}"
+            )
+        else:
+            segment_labels = [input_label]
+
+        concat_labels = []
+        silences = [leading_silence] + [silence_at[cut] for cut in cuts]
+        for index, (segment_label, silence_samples) in enumerate(
+            zip(segment_labels, silences)
+        ):
+            if silence_samples > 0:
+                silence_label = self._get_label(f"asil{index}")
+                filters.append(
+                    f"anullsrc=r={sample_rate}:cl={channel_layout},"
+                    f"atrim=end_sample={silence_samples}{silence_label}"
+                )
+                concat_labels.append(silence_label)
+            concat_labels.append(segment_label)
+
+        filters.append(
+            f"{''.join(concat_labels)}concat=n={len(concat_labels)}:v=0:a=1,"
+            f"asetpts=N/SR/TB{output_label}"
         )
+        return filters
 
-        vfilters = []
-        filter_interface_list = []
+    def _get_channel_layout(self) -> str:
+        """
+        Get the channel layout of the input audio, for generating matching silence
+        """
+        if self.media_info is None:
+            return "stereo"
+        if self.media_info.channel_layout:
+            return self.media_info.channel_layout
+        if self.media_info.channels:
+            return f"{self.media_info.channels}c"
+        return "stereo"
+
+    def _get_trim_filters(
+        self, input_label: str = "[0:v]", output_label: str = "[outv]"
+    ) -> list[str]:
+        """
+        Get the filter chains that remove the frames after the frozen ones, for skipping
 
-        for ii in range(0, len(self.trim_cmds)):
-            filter_interface_list.append(f"[i{ii}v]")
+        Args:
+            input_label (str, optional): Label of the (already looped) video pad. Defaults to "[0:v]".
+            output_label (str, optional): Label of the output video pad. Defaults to "[outv]".
 
-        remaining_trim_cmds = list(self.trim_cmds)
-        for ii, jj in enumerate(filter_interface_list):
-            filter_string = f"[0:v]{remaining_trim_cmds.pop(0)}{jj}"
-            vfilters.append(filter_string)
-        filters = ";".join(vfilters) + ";"
-        filters += "".join(filter_interface_list)
-        filters += f"concat=n={len(self.trim_cmds)}:v=1[outv]"
+        Returns:
+            list[str]: Filter chains, to be joined with ";"
+        """
+        filter_interface_list = [
+            self._get_label(f"i{ii}v") for ii in range(len(self.trim_cmds))
+        ]
+        split_list = [self._get_label(f"s{ii}v") for ii in range(len(self.trim_cmds))]
+
+        vfilters = [f"{input_label}split={len(self.trim_cmds)}{''.join(split_list)}"]
+        for split_label, trim_cmd, interface_label in zip(
+            split_list, self.trim_cmds, filter_interface_list
+        ):
+            vfilters.append(f"{split_label}{trim_cmd}{interface_label}")
+        vfilters.append(
+            "".join(filter_interface_list)
+            + f"concat=n={len(self.trim_cmds)}:v=1{output_label}"
+        )
 
-        trim_extra_frames.extend(["-filter_complex", filters])
+        return vfilters
 
-        trim_extra_frames.extend(["-map", "[outv]"])
+    def insert_buf_video(self):
+        """
+        Insert buffering into the video file
+        """
+        self.run_command(self._get_video_cmd(), stage="video")
 
-        trim_extra_frames.extend(
+    def _get_video_cmd(self, threads: int | None = None) -> list[str]:
+        """
+        Get the command for inserting buffering into the video file
+        """
+        base_cmd = self._get_base_cmd(threads)
+
+        base_cmd.extend(self._get_filter_options(self._get_video_filters()))
+        base_cmd.extend(["-map", "[outv]"])
+        base_cmd.extend(
             [
-                "-c:v",
-                self.vcodec,
+                *self._get_intermediate_codec_options(),
+                "-pix_fmt",
+                self.pixfmt,
                 "-vsync",
                 "cfr",
-                self._get_tmp_filename("skipping"),
+                "-threads",
+                str(threads or self.threads),
             ]
         )
+        base_cmd.append(self._get_tmp_filename("video"))
 
-        self.run_command(trim_extra_frames)
+        return base_cmd
 
-    def merge_audio_video(self):
+    def _get_video_step(
+        self, threads: int | None = None
+    ) -> list[str] | functools.partial[None]:
         """
-        Merge the audio and video files
+        Get the command, or with the raw engine the function, that inserts buffering into the video file
         """
-        if self.skipping:
-            if self.has_audio and self.has_video:
-                output_codec_options = ["-map", "0:v", "-map", "1:a"]
-            else:
-                output_codec_options = []
-            if self.force_framerate:
-                output_codec_options.extend(
-                    [
-                        "-c:v",
-                        self.vcodec,
-                        "-filter:v",
-                        "fps=fps=" + str(self.fps),
+        if self.video_engine == "raw":
+            return functools.partial(self.insert_buf_video_raw, threads=threads)
+        return self._get_video_cmd(threads=threads)
+
+    def insert_buf_video_raw(self, threads: int | None = None):
+        """
+        Insert buffering into the video file with the raw engine: ffmpeg decodes the
+        input to raw frames, which are piped through Python to a second ffmpeg that
+        encodes them. The frozen frames are repeated at frame-exact positions, and
+        the stall effects are drawn with NumPy, once per event.
+
+        Args:
+            threads (int | None, optional): Number of threads for each ffmpeg process. Defaults to the configured number.
+
+        Raises:
+            RuntimeError: Decoding or encoding failed
+        """
+        width, height = (int(size) for size in str(self.video_resolution).split("x"))
+        frame_rate = self._get_frame_rate()
+        stall_frames = get_stall_frames(self.buflist, frame_rate)
+
+        decoder_cmd = [
+            self.ffmpeg_path,
+            "-nostdin",
+            "-threads",
+            str(threads or self.threads),
+            *self.input_window_options,
+            "-i",
+            self.input_file,
+            "-map",
+            "0:v:0",
+            "-vsync",
+            "cfr",
+            "-r",
+            str(frame_rate),
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            RAW_PIX_FMT,
+            "-",
+        ]
+        encoder_cmd = [
+            self.ffmpeg_path,
+            "-nostdin",
+            "-threads",
+            str(threads or self.threads),
+            self.overwrite_spec,
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            RAW_PIX_FMT,
+            "-s",
+            f"{width}x{height}",
+            "-framerate",
+            str(frame_rate),
+            "-i",
+            "-",
+            *self._get_intermediate_codec_options(),
+            "-pix_fmt",
+            self.pixfmt,
+            "-threads",
+            str(threads or self.threads),
+            self._get_tmp_filename("video"),
+        ]
+        for cmd in (decoder_cmd, encoder_cmd):
+            logger.info(" ".join([shlex.quote(c) for c in cmd]))
+        logger.debug(f"raw engine: stalls at frames {stall_frames}")
+        if self.dry:
+            return
+
+        renderer = StallRenderer(
+            width,
+            height,
+            spinner_frames=None if self.disable_spinner else self._get_spinner_frames(),
+            blur=int(self.blur),
+            brightness=float(self.brightness),
+        )
+
+        start_time = time.monotonic()
+        start_thread_time = time.thread_time()
+        with (
+            tempfile.TemporaryFile() as decoder_log,
+            tempfile.TemporaryFile() as encoder_log,
+        ):
+            decoder = subprocess.Popen(
+                decoder_cmd, stdout=subprocess.PIPE, stderr=decoder_log
+            )
+            encoder = subprocess.Popen(
+                encoder_cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=encoder_log,
+            )
+            self._running_processes.extend([decoder, encoder])
+            try:
+                assert decoder.stdout is not None and encoder.stdin is not None
+                try:
+                    render_video(
+                        decoder.stdout,
+                        encoder.stdin,
+                        width,
+                        height,
+                        stall_frames,
+                        renderer,
+                        skipping=self.skipping,
+                        black_frame=self.black_frame and not self.disable_spinner,
+                    )
+                except BrokenPipeError:
+                    # the encoder exited early, its log tells why
+                    decoder.kill()
+                finally:
+                    encoder.stdin.close()
+                    decoder.stdout.close()
+                decoder_cpu_time, decoder_max_rss = wait_for_process(decoder)
+                encoder_cpu_time, encoder_max_rss = wait_for_process(encoder)
+            finally:
+                for process in (decoder, encoder):
+                    if process.poll() is None:
+                        process.kill()
+                        process.wait()
+                    self._running_processes.remove(process)
+
+            for process, cmd, log in (
+                (encoder, encoder_cmd, encoder_log),
+                (decoder, decoder_cmd, decoder_log),
+            ):
+                if process.returncode != 0:
+                    log.seek(0)
+                    raise RuntimeError(
+                        f"running command: {' '.join(cmd)}: {log.read().decode('utf-8', errors='replace')}"
+                    )
+
+        cpu_times = [
+            time.thread_time() - start_thread_time,
+            decoder_cpu_time,
+            encoder_cpu_time,
+        ]
+        rss_values = [rss for rss in (decoder_max_rss, encoder_max_rss) if rss]
+        self.timing_report.stages.append(
+            StageTiming(
+                "video",
+                round(time.monotonic() - start_time, 3),
+                cpu_time=round(sum(cpu_times), 3) if None not in cpu_times else None,
+                max_rss=max(rss_values) if rss_values else None,
+                output_bytes=self._get_file_size(self._get_tmp_filename("video")),
+                work=self._get_stage_work("video"),
+            )
+        )
+
+    def _get_fps(self) -> float:
+        """
+        Get the frame rate of the output video, which is known once the input is probed
+        """
+        if self.fps is None:
+            raise RuntimeError("fps not specified!")
+        return self.fps
+
+    def _get_frame_rate(self) -> Fraction:
+        """
+        Get the exact frame rate of the input video
+        """
+        if self.media_info is not None and self.media_info.frame_rate:
+            return Fraction(self.media_info.frame_rate)
+        return Fraction(self._get_fps()).limit_denominator(1001)
+
+    def _get_spinner_frames(self) -> list:
+        """
+        Get the loop of the spinner animation as RGBA frames, at the output frame rate
+
+        Returns:
+            list[numpy.ndarray]: Frames of shape (height, width, 4)
+        """
+        np = load_numpy()
+        cached_spinner = get_cached_spinner(
+            self.spinner,
+            self.speed,
+            self._get_fps(),
+            ffmpeg_path=self.ffmpeg_path,
+            ffprobe_path=self.ffprobe_path,
+            cache_dir=self.cache_dir,
+        )
+        assert cached_spinner is not None
+        spinner_info = probe(cached_spinner, ffprobe_path=self.ffprobe_path)
+        if spinner_info.width is None or spinner_info.height is None:
+            raise RuntimeError(
+                f"Could not detect the size of the spinner {self.spinner}"
+            )
+
+        output = subprocess.check_output(
+            [
+                self.ffmpeg_path,
+                "-nostdin",
+                "-i",
+                cached_spinner,
+                "-f",
+                "rawvideo",
+                "-pix_fmt",
+                "rgba",
+                "-",
+            ],
+            stderr=subprocess.DEVNULL,
+        )
+        frames = np.frombuffer(output, dtype=np.uint8).reshape(
+            -1, spinner_info.height, spinner_info.width, 4
+        )
+        return list(frames)
+
+    def _can_smart_render(self) -> bool:
+        """
+        Check whether the video can be smart-rendered, i.e., whether untouched
+        parts of the input can be stream-copied into the output
+        """
+        if self.dry:
+            logger.warning("Dry run: smart rendering requires probing, disabling it")
+            return False
+        if self.video_engine == "raw":
+            logger.warning(
+                "Smart rendering requires the filter video engine, disabling it"
+            )
+            return False
+        if self.skipping:
+            logger.warning("Smart rendering does not support skipping, disabling it")
+            return False
+        if self.start is not None or self.trim:
+            logger.warning(
+                "Smart rendering does not support start or trim, disabling it"
+            )
+            return False
+        if self.mezzanine_cache:
+            logger.warning(
+                "Smart rendering cannot copy from the mezzanine cache, disabling it"
+            )
+            return False
+
+        input_codec = self.media_info.video_codec if self.media_info else None
+        output_codec = get_codec_for_encoder(self.vcodec)
+        if input_codec != output_codec:
+            logger.warning(
+                f"Smart rendering requires the output codec ({output_codec}) to match "
+                f"the input codec ({input_codec}), disabling it"
+            )
+            return False
+
+        # the copied parts keep the stream parameters of the input, so the re-encoded
+        # parts must have the same ones to be decodable after them; the filter graph
+        # keeps the resolution of the input
+        stream_info = get_video_stream_info(self.ffprobe_path, self.input_file)
+        if stream_info.get("pix_fmt") != self.pixfmt:
+            logger.warning(
+                f"Smart rendering requires the pixel format ({self.pixfmt}) to match "
+                f"the input pixel format ({stream_info.get('pix_fmt')}), disabling it"
+            )
+            return False
+        encoder_options = get_matching_encoder_options(self.vcodec, stream_info)
+        if encoder_options is None:
+            logger.warning(
+                f"Smart rendering cannot match the profile and level of the input "
+                f"({stream_info.get('profile')}, {stream_info.get('level')}) "
+                f"with {self.vcodec}, disabling it"
+            )
+            return False
+        self._smart_encoder_options = encoder_options
+
+        return True
+
+    def insert_buf_video_smart(self):
+        """
+        Insert buffering into the video file, re-encoding only the GOPs that
+        contain buffering events and stream-copying all other GOPs
+        """
+        for stage, cmd, _ in self._iter_smart_render_steps():
+            self.run_command(cmd, stage=stage)
+
+    def _iter_smart_render_steps(
+        self,
+    ) -> Generator[tuple[str, list[str], bool], None, None]:
+        """
+        Generate the commands for smart rendering the video file. Each command
+        must have finished before the generator is resumed; the intermediate
+        pieces are removed when the generator finishes or is closed.
+
+        Yields:
+            tuple[str, list[str], bool]: Stage, command and whether it writes to stdout
+        """
+        keyframes = get_keyframe_times(self.ffprobe_path, self.input_file)
+        frame_rate = self._get_frame_rate()
+        segments = plan_segments(
+            keyframes,
+            self.buflist,
+            self._get_duration_in_seconds(),
+            float(1 / frame_rate),
+        )
+        logger.debug(
+            f"smart rendering: re-encoding {sum(events is not None for _, _, events in segments)} "
+            f"of {len(segments)} segments"
+        )
+
+        # the pieces are concatenated with exact durations, from the frame counts,
+        # so that the timestamps of the output are continuous
+        piece_pattern = self._get_tmp_prefix() + "_piece%05d.mkv"
+        piece_files = [piece_pattern % index for index in range(len(segments))]
+        stalled_files = []
+        concat_list_file = self._get_tmp_prefix() + "_pieces.txt"
+
+        try:
+            # split the video stream at the segment boundaries, without re-encoding;
+            # the segment muxer cuts at the first keyframe after each time. Each
+            # keyframe gets the parameter sets in front of it, as the re-encoded
+            # pieces have their own.
+            split_cmd = [
+                self.ffmpeg_path,
+                "-nostdin",
+                self.overwrite_spec,
+                "-i",
+                self.input_file,
+                "-map",
+                "0:v:0",
+                "-c",
+                "copy",
+                "-bsf:v",
+                PARAMETER_SET_FILTERS[get_codec_for_encoder(self.vcodec)],
+                "-f",
+                "segment",
+                "-segment_format",
+                "matroska",
+                "-reset_timestamps",
+                "1",
+            ]
+            if len(segments) > 1:
+                split_cmd.extend(
+                    [
+                        "-segment_times",
+                        ",".join(
+                            f"{max(0.0, start - 0.001):.6f}"
+                            for start, _, _ in segments[1:]
+                        ),
+                    ]
+                )
+            split_cmd.append(piece_pattern)
+            yield "smart_split", split_cmd, False
+
+            if not all(os.path.isfile(piece) for piece in piece_files):
+                raise RuntimeError(
+                    "smart rendering: input could not be split at the expected keyframes"
+                )
+
+            concat_entries = []
+            for piece_file, (start, end, events) in zip(piece_files, segments):
+                frames = round((end - start) * frame_rate)
+                if events is None:
+                    concat_entries.append((piece_file, frames))
+                    continue
+
+                # re-use the regular filter graph for the events within the segment
+                segment = copy.copy(self)
+                segment.input_file = piece_file
+                segment.buflist = events
+                segment.input_duration = str(datetime.timedelta(seconds=end - start))
+                segment.black_frame = self.black_frame and start == 0
+                segment._generate_loop_cmds()
+                frames += sum(EventTable.compile(events, frame_rate).frame_lengths)
+
+                stalled_file = piece_file[: -len(".mkv")] + "_stalled.mkv"
+                stalled_files.append(stalled_file)
+
+                stall_cmd = segment._get_base_cmd()
+                # the segment shares the list of filter scripts, so they are removed
+                # when the command has run
+                stall_cmd.extend(
+                    segment._get_filter_options(segment._get_video_filters())
+                )
+                stall_cmd.extend(["-map", "[outv]"])
+                stall_cmd.extend(
+                    [
+                        "-c:v",
+                        self.vcodec,
+                        *(self._smart_encoder_options or []),
+                        "-vsync",
+                        "cfr",
+                        "-r",
+                        str(frame_rate),
+                        "-frames:v",
+                        str(frames),
+                        "-threads",
+                        str(self.threads),
+                    ]
+                )
+                stall_cmd.append(stalled_file)
+                yield "smart_video", stall_cmd, False
+
+                concat_entries.append((stalled_file, frames))
+
+            with open(concat_list_file, "w") as f:
+                for concat_file, frames in concat_entries:
+                    f.write(f"file '{os.path.abspath(concat_file)}'\n")
+                    f.write(f"duration {float(frames / frame_rate):.6f}\n")
+
+            concat_cmd = [
+                self.ffmpeg_path,
+                "-nostdin",
+                self.overwrite_spec,
+                "-f",
+                "concat",
+                "-safe",
+                "0",
+                "-i",
+                concat_list_file,
+                "-c",
+                "copy",
+                self._get_tmp_filename("video"),
+            ]
+            yield "smart_concat", concat_cmd, False
+        finally:
+            for file in [*piece_files, *stalled_files, concat_list_file]:
+                if os.path.isfile(file):
+                    os.remove(file)
+
+    def insert_buf_audio(self):
+        """
+        Insert buffering into the audio file
+        """
+        self.run_command(self._get_audio_cmd(), stage="audio")
+
+    def _get_audio_cmd(self, threads: int | None = None) -> list[str]:
+        """
+        Get the command for inserting buffering into the audio file
+        """
+        base_cmd = self._get_base_cmd(threads)
+
+        base_cmd.extend(self._get_filter_options(self._get_audio_filters()))
+        base_cmd.extend(["-map", "[outa]"])
+        base_cmd.extend(["-c:a", self.acodec, "-threads", str(threads or self.threads)])
+        base_cmd.append(self._get_tmp_filename("audio"))
+
+        return base_cmd
+
+    def trim_video(self):
+        """
+        Remove frames after the frozen, repeated, ones to emulate freezing with skipping
+        """
+        self.run_command(self._get_trim_cmd(), stage="trim")
+
+    def _get_trim_cmd(self) -> list[str]:
+        """
+        Get the command for removing the frames after the frozen ones
+        """
+        trim_extra_frames = [
+            self.ffmpeg_path,
+            self.overwrite_spec,
+        ]
+
+        trim_extra_frames.extend(
+            [
+                "-i",
+                self._get_tmp_filename("video"),
+            ]
+        )
+
+        trim_extra_frames.extend(self._get_filter_options(self._get_trim_filters()))
+
+        trim_extra_frames.extend(["-map", "[outv]"])
+
+        trim_extra_frames.extend(
+            [
+                *self._get_intermediate_codec_options(),
+                "-vsync",
+                "cfr",
+                self._get_tmp_filename("skipping"),
+            ]
+        )
+
+        return trim_extra_frames
+
+    def insert_buf_single_pass(self):
+        """
+        Insert buffering into audio and video in a single ffmpeg run, writing
+        straight to the output file instead of going through intermediate files
+        """
+        self.run_command(
+            self._get_single_pass_cmd(),
+            pass_stdout=self.output_file in STDOUT_OUTPUTS,
+            stage="single_pass",
+        )
+
+    def _get_single_pass_cmd(self) -> list[str]:
+        """
+        Get the command for processing audio and video in a single pass
+        """
+        base_cmd = self._get_base_cmd()
+
+        filters, output_options = self._get_single_pass_output()
+
+        base_cmd.extend(self._get_filter_options(filters))
+        base_cmd.extend(output_options)
+
+        return base_cmd
+
+    def _get_single_pass_output(
+        self, video_input: str = "[0:v]", audio_input: str = "[0:a]"
+    ) -> tuple[list[str], list[str]]:
+        """
+        Get the filter chains and the output options (maps, codecs and output file)
+        of a single pass
+
+        Args:
+            video_input (str, optional): Label of the input video pad. Defaults to "[0:v]".
+            audio_input (str, optional): Label of the input audio pad. Defaults to "[0:a]".
+
+        Returns:
+            tuple[list[str], list[str]]: Filter chains, and the output options
+        """
+        label = self._get_label
+        filters = []
+        maps = []
+        codec_options = []
+
+        if self.has_video:
+            trim_video = self.skipping and not self._skips_in_video_graph()
+            video_label = (
+                label("stalled")
+                if trim_video or self.force_framerate
+                else label("outv")
+            )
+            filters.extend(
+                self._get_video_filters(
+                    input_label=video_input, output_label=video_label
+                )
+            )
+            if trim_video:
+                skipped_label = (
+                    label("skipped") if self.force_framerate else label("outv")
+                )
+                filters.extend(self._get_trim_filters(video_label, skipped_label))
+                video_label = skipped_label
+            if self.force_framerate:
+                filters.append(f"{video_label}fps=fps={self.fps}{label('outv')}")
+            maps.extend(["-map", label("outv")])
+            codec_options.extend(
+                ["-c:v", self.vcodec, "-pix_fmt", self.pixfmt, "-vsync", "cfr"]
+            )
+
+        if self.has_audio:
+            if self.skipping:
+                # skipping keeps the original audio untouched
+                maps.extend(["-map", "0:a"])
+                codec_options.extend(["-c:a", "copy"])
+            else:
+                filters.extend(
+                    self._get_audio_filters(
+                        input_label=audio_input, output_label=label("outa")
+                    )
+                )
+                maps.extend(["-map", label("outa")])
+                codec_options.extend(["-c:a", self.acodec])
+
+        output_options = list(maps)
+
+        output_duration_options = None
+        if self.skipping:
+            output_duration_options = ["-t", self.input_duration]
+        if self.trim:
+            output_duration_options = self.trim_spec
+
+        if output_duration_options:
+            output_options.extend([*output_duration_options])
+
+        output_options.extend(
+            [
+                *codec_options,
+                "-threads",
+                str(self.threads),
+                *self._get_output_format_options(),
+                self.output_file,
+            ]
+        )
+
+        return filters, output_options
+
+    def merge_audio_video(self):
+        """
+        Merge the audio and video files
+        """
+        self.run_command(self._get_merge_cmd(), stage="merge")
+
+    def _get_merge_codec_options(self) -> list[str]:
+        """
+        Get the codec options for merging, which only need to encode the video if
+        the intermediate files use a different codec
+        """
+        if not self._uses_intermediate_codec():
+            return ["-c", "copy"]
+        return ["-c:v", self.vcodec, "-pix_fmt", self.pixfmt, "-c:a", "copy"]
+
+    def _get_merge_cmd(self) -> list[str]:
+        """
+        Get the command for merging the audio and video files
+        """
+        if self.skipping:
+            if self.has_audio and self.has_video:
+                output_codec_options = ["-map", "0:v", "-map", "1:a"]
+            else:
+                output_codec_options = []
+            if self.force_framerate:
+                output_codec_options.extend(
+                    [
+                        "-c:v",
+                        self.vcodec,
+                        "-filter:v",
+                        "fps=fps=" + str(self.fps),
                     ]
                 )
                 if self.has_audio:
@@ -431,7 +1849,11 @@ class Bufferer:
                         ]
                     )
             else:
-                output_codec_options.extend(["-c", "copy"])
+                output_codec_options.extend(self._get_merge_codec_options())
+            if self.has_audio and self.input_window_options:
+                # a stream copy would start at the keyframe before the window, so
+                # the audio of the window is encoded
+                output_codec_options.extend(["-c:a", self.acodec])
 
         else:
             if self.force_framerate:
@@ -445,7 +1867,7 @@ class Bufferer:
                     "copy",
                 ]
             else:
-                output_codec_options = ["-c", "copy"]
+                output_codec_options = self._get_merge_codec_options()
 
         combine_cmd = [
             self.ffmpeg_path,
@@ -453,7 +1875,7 @@ class Bufferer:
         ]
 
         if self.has_video:
-            if self.skipping:
+            if self.skipping and not self._skips_in_video_graph():
                 combine_cmd.extend(
                     [
                         "-i",
@@ -472,6 +1894,7 @@ class Bufferer:
             if self.skipping:
                 combine_cmd.extend(
                     [
+                        *self.input_window_options,
                         "-i",
                         self.input_file,
                     ]
@@ -496,31 +1919,119 @@ class Bufferer:
         combine_cmd.extend(
             [
                 *output_codec_options,
+                *self._get_output_format_options(),
                 self.output_file,
             ]
         )
 
-        self.run_command(combine_cmd)
+        return combine_cmd
 
-    def _get_base_cmd(self):
+    def _get_base_cmd(self, threads: int | None = None):
         """
-        Get the base command to build the ffmpeg command
+        Get the base command to build the ffmpeg command. The encoder threads are
+        output options, which the commands add before each output file.
+
+        Args:
+            threads (int | None, optional): Number of threads. Defaults to the configured number of threads.
         """
+        threads = threads or self.threads
         base_cmd = [
             self.ffmpeg_path,
             "-nostdin",
+            *get_filter_thread_options(threads),
             "-threads",
-            "1",
+            str(threads),
             self.overwrite_spec,
+            *self.input_window_options,
             "-i",
             self.input_file,
         ]
 
-        # if self.trim_spec:
-        #     base_cmd.extend(self.trim_spec)
-
         return base_cmd
 
+    def _get_file_size(self, path: str) -> int | None:
+        """
+        Get the size of a file written by a command, if it is a regular file
+        """
+        if not os.path.isfile(path):
+            return None
+        return os.path.getsize(path)
+
+    def _get_output_duration(self) -> float | None:
+        """
+        Get the expected duration of the output in seconds, including the buffering events
+        """
+        if self.input_duration is None:
+            return None
+        duration = self._get_duration_in_seconds()
+        if not self.skipping:
+            duration += sum(buf_len for _, buf_len in self.buflist)
+        if self.trim:
+            duration = min(duration, parse_duration(self.trim))
+        return duration
+
+    def _get_stage_work(self, stage: str) -> dict[str, int] | None:
+        """
+        Get the number of frames and samples that a processing stage decodes and
+        encodes, with the raw size of a frame and a sample
+
+        Args:
+            stage (str): Processing stage
+
+        Returns:
+            dict[str, int] | None: Work of the stage, or None for stages without a fixed amount of work
+        """
+        input_duration = self._get_duration_in_seconds()
+        output_duration = self._get_output_duration() or 0.0
+        # with skipping in a separate pass, the video pass writes the stalls, and the trim pass drops them
+        stalled_duration = input_duration + sum(buf_len for _, buf_len in self.buflist)
+        separate_trim = self.skipping and not self._skips_in_video_graph()
+
+        # decoded and encoded seconds of video and audio
+        if stage == "video":
+            video = (
+                input_duration,
+                stalled_duration if separate_trim else output_duration,
+            )
+            audio = (0.0, 0.0)
+        elif stage == "audio":
+            video = (0.0, 0.0)
+            audio = (input_duration, output_duration)
+        elif stage == "trim":
+            video = (stalled_duration, output_duration)
+            audio = (0.0, 0.0)
+        elif stage == "merge":
+            video = audio = (output_duration, output_duration)
+        elif stage in ("single_pass", "variants"):
+            video = (input_duration, output_duration)
+            audio = (input_duration, output_duration)
+        elif stage == "mezzanine":
+            source_duration = (
+                self.media_info.duration if self.media_info else None
+            ) or 0.0
+            video = (source_duration, source_duration)
+            audio = (0.0, 0.0)
+        else:
+            return None
+
+        frame_bytes = 0
+        if self.has_video and self.video_resolution:
+            width, height = (int(size) for size in self.video_resolution.split("x"))
+            frame_bytes = width * height * PIX_FMT_BITS.get(self.pixfmt, 24) // 8
+        channels = (self.media_info.channels if self.media_info else None) or 2
+        fps = (self.fps or 0.0) if self.has_video else 0.0
+        samplerate = (self.samplerate or 0.0) if self.has_audio else 0.0
+
+        return {
+            "decoded_frames": round(video[0] * fps),
+            "frames": round(video[1] * fps),
+            "decoded_samples": round(audio[0] * samplerate),
+            "samples": round(audio[1] * samplerate),
+            "frame_bytes": frame_bytes,
+            # 16 bit PCM
+            "sample_bytes": channels * 2 if samplerate else 0,
+        }
+
     def _get_duration_in_seconds(self):
         """
         Convert between the HH:MM:SS.sss format, to total number of seconds.
@@ -541,41 +2052,524 @@ class Bufferer:
 
         suffix = f"_{what}.nut"
 
-        return self.output_file + suffix
+        return self._get_tmp_prefix() + suffix
 
-    def insert_buf_audiovisual(self):
+    def _get_tmp_prefix(self) -> str:
         """
-        Insert the buffering events on both audio and video tracks, looping the video
-        frames and audio samples at the corresponding positions.
+        Get the path prefix of the intermediate files
         """
+        if self.tmp_dir is None:
+            return self.output_file
+        return os.path.join(
+            self.tmp_dir, f"{os.path.basename(self.output_file)}.{self._tmp_id}"
+        )
+
+    def _uses_mezzanine(self) -> bool:
+        """
+        Whether the input is read from the mezzanine cache, which only holds inputs
+        with video, since decoding audio is cheap
+        """
+        return self.mezzanine_cache and self.has_video
+
+    def _uses_intermediate_codec(self) -> bool:
+        """
+        Whether the intermediate video files use a different codec than the output
+        """
+        return (
+            self.intermediate_codec is not None
+            and self.intermediate_codec != self.vcodec
+        )
+
+    def _get_intermediate_codec_options(self) -> list[str]:
+        """
+        Get the encoder options for the intermediate video files
+        """
+        if not self._uses_intermediate_codec():
+            return ["-c:v", self.vcodec]
+        assert self.intermediate_codec is not None
+        return [
+            "-c:v",
+            self.intermediate_codec,
+            *INTERMEDIATE_CODEC_OPTIONS.get(self.intermediate_codec, []),
+        ]
+
+    def _estimate_tmp_bytes(self) -> int:
+        """
+        Estimate the disk space needed for the intermediate files
+
+        Returns:
+            int: Estimated size in bytes
+        """
+        duration = self._get_duration_in_seconds()
+        if not self.skipping:
+            duration += sum(buf_len for _, buf_len in self.buflist)
+
+        tmp_bytes = 0.0
+        if self.has_video and self.video_resolution and self.fps:
+            width, height = (int(size) for size in self.video_resolution.split("x"))
+            frame_bytes = width * height * PIX_FMT_BITS.get(self.pixfmt, 24) / 8
+            codec = self.intermediate_codec or self.vcodec
+            video_bytes = (
+                frame_bytes
+                * duration
+                * self.fps
+                * INTERMEDIATE_SIZE_RATIOS.get(codec, DEFAULT_SIZE_RATIO)
+            )
+            tmp_bytes += video_bytes
+            if self.skipping and not self._skips_in_video_graph():
+                # the trimmed copy exists at the same time
+                tmp_bytes += video_bytes
+        if self.has_audio and not self.skipping:
+            channels = (self.media_info.channels if self.media_info else None) or 2
+            # 16 bit PCM
+            tmp_bytes += (self.samplerate or 48000) * channels * 2 * duration
+
+        return int(tmp_bytes)
+
+    def _check_free_space(self):
+        """
+        Check that the intermediate files fit into their directory
+
+        Raises:
+            RuntimeError: Not enough free space
+        """
+        tmp_dir = os.path.dirname(os.path.abspath(self._get_tmp_filename("video")))
+        free_bytes = shutil.disk_usage(tmp_dir).free
+        needed_bytes = self._estimate_tmp_bytes()
+        logger.debug(
+            f"intermediate files need about {needed_bytes / 1e6:.0f} MB in {tmp_dir}, "
+            f"{free_bytes / 1e6:.0f} MB available"
+        )
+        if needed_bytes > free_bytes:
+            raise RuntimeError(
+                f"Not enough free space in {tmp_dir} for the intermediate files: "
+                f"need about {needed_bytes / 1e6:.0f} MB, {free_bytes / 1e6:.0f} MB available. "
+                "Use a different tmp_dir or intermediate codec."
+            )
+
+    def use_mezzanine(self):
+        """
+        Read from the mezzanine of the input instead of the input itself, decoding
+        the input into the mezzanine cache first if it is not cached yet
+        """
+        mezzanine_file = get_mezzanine_file(
+            self.input_file, self.pixfmt, cache_dir=self.cache_dir
+        )
+        if os.path.isfile(mezzanine_file):
+            logger.debug(f"using cached mezzanine {mezzanine_file}")
+            touch(mezzanine_file)
+        else:
+            logger.info(f"decoding {self.input_file} into the mezzanine cache")
+            tmp_file = f"{mezzanine_file}.{self._tmp_id}.tmp.mkv"
+            try:
+                self.run_command(
+                    get_mezzanine_cmd(
+                        self.input_file,
+                        tmp_file,
+                        self.pixfmt,
+                        ffmpeg_path=self.ffmpeg_path,
+                        threads=self.threads,
+                    ),
+                    stage="mezzanine",
+                )
+                os.replace(tmp_file, mezzanine_file)
+            finally:
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+
+        for removed_file in evict_lru(
+            os.path.dirname(mezzanine_file),
+            int(self.mezzanine_cache_size * 1e9),
+            keep=mezzanine_file,
+        ):
+            logger.debug(f"evicted mezzanine {removed_file}")
+
+        self.input_file = mezzanine_file
+
+    def _get_result_parameters(self) -> dict:
+        """
+        Get everything that affects the output, as the key of the result cache
+        """
+        return {
+            "input": get_content_hash(self.input_file, self.cache_dir),
+            # the spinner is drawn over the stalls in skipping mode as well
+            "spinner": get_content_hash(self.spinner, self.cache_dir)
+            if not self.disable_spinner
+            else None,
+            # a different ffmpeg build may render differently
+            "ffmpeg": get_file_key(shutil.which(self.ffmpeg_path) or self.ffmpeg_path),
+            "buflist": self.buflist,
+            "input_window": self.input_window_options,
+            "extension": os.path.splitext(self.output_file)[1].lower(),
+            **{name: getattr(self, name) for name in RESULT_CACHE_OPTIONS},
+        }
+
+    def restore_cached_result(self):
+        """
+        Look up the output in the result cache, and hardlink or copy it to the
+        output file if it is there
+
+        Raises:
+            RuntimeError: The output file exists and may not be overwritten
+        """
+        self._result_file = get_result_file(
+            get_result_key(self._get_result_parameters()),
+            os.path.splitext(self.output_file)[1],
+            cache_dir=self.cache_dir,
+        )
+        self._result_restored = os.path.isfile(self._result_file)
+        if not self._result_restored:
+            logger.debug(f"no cached result for {self.output_file}")
+            return
+
+        if os.path.exists(self.output_file) and not self.force_overwrite:
+            raise RuntimeError(f"Output file {self.output_file} already exists")
+        logger.info(f"restoring {self.output_file} from the result cache")
+        touch(self._result_file)
+        link_or_copy(self._result_file, self.output_file)
+
+    def store_result(self):
+        """
+        Add the output to the result cache, removing the least recently used results
+        if the cache is full
+        """
+        # the result file is set by the lookup in restore_result()
+        assert self._result_file is not None
+        link_or_copy(self.output_file, self._result_file)
+        for removed_file in evict_lru(
+            os.path.dirname(self._result_file),
+            int(self.result_cache_size * 1e9),
+            keep=self._result_file,
+        ):
+            logger.debug(f"evicted result {removed_file}")
+
+    def _prepare_processing(self):
+        """
+        Generate the filter expressions and output options before processing
+        """
+        self.timing_report = TimingReport()
 
         self._generate_loop_cmds()
         self._set_specs()
 
-        tmp_file_list = []
+        if self.video_engine == "raw":
+            if self._is_streaming_output():
+                raise RuntimeError(
+                    "The raw video engine writes intermediate files and cannot stream the output"
+                )
+            if self.single_pass:
+                logger.warning(
+                    "The raw video engine does not support a single pass, disabling it"
+                )
+                self.single_pass = False
 
-        try:
-            if self.has_video:
+        if self._is_streaming_output() and not self.single_pass:
+            logger.info("streaming output requires a single pass, enabling it")
+            self.single_pass = True
+
+        if (
+            self.force_overwrite
+            and not self.dry
+            and not self._is_streaming_output()
+            and os.path.isfile(self.output_file)
+            and os.stat(self.output_file).st_nlink > 1
+        ):
+            # the output may be a hardlink into the result cache, which ffmpeg
+            # would otherwise overwrite in place
+            os.remove(self.output_file)
+
+        if not self.single_pass and not self.dry:
+            if self.tmp_dir is not None:
+                os.makedirs(self.tmp_dir, exist_ok=True)
+            self._check_free_space()
+
+    def _can_run_passes_concurrently(self) -> bool:
+        """
+        Check whether the video and audio passes can run at the same time, sharing
+        the thread budget, instead of one after the other
+        """
+        return (
+            self.has_video
+            and self.has_audio
+            and not self.skipping
+            and not (self.smart_render and self._can_smart_render())
+            # the threads are the CPU budget of the job (batch and serve split the
+            # CPUs between jobs), so two passes need at least two of them
+            and self.threads >= 2
+        )
+
+    def _iter_processing_steps(
+        self, tmp_file_list: list[str]
+    ) -> Generator[list[Step], None, None]:
+        """
+        Generate the commands for processing the input, in the order in which
+        they have to run. The commands of a group can run concurrently, and all
+        of them must have finished before the generator is resumed.
+
+        Args:
+            tmp_file_list (list[str]): List to which the temporary files are added,
+                before the commands that write them are yielded
+
+        Yields:
+            list[tuple[str, list[str], bool]]: Group of steps, each a tuple of stage,
+                command and whether it writes to stdout
+        """
+        use_result_cache = (
+            self.result_cache and not self.dry and not self._is_streaming_output()
+        )
+        if use_result_cache:
+            yield [("result_cache", self.restore_cached_result, False)]
+            if self._result_restored:
+                return
+        if self._uses_mezzanine() and not self.dry:
+            # all later commands read from the mezzanine
+            yield [("mezzanine", self.use_mezzanine, False)]
+        yield from self._iter_render_steps(tmp_file_list)
+        if use_result_cache:
+            yield [("result_cache", self.store_result, False)]
+
+    def _iter_render_steps(
+        self, tmp_file_list: list[str]
+    ) -> Generator[list[Step], None, None]:
+        """
+        Generate the commands that render the output, see `_iter_processing_steps()`
+        """
+        if self.single_pass:
+            logger.info("running command for processing video/audio in one pass")
+            yield [
+                (
+                    "single_pass",
+                    self._get_single_pass_cmd(),
+                    self.output_file in STDOUT_OUTPUTS,
+                )
+            ]
+            return
+        if self._can_run_passes_concurrently():
+            # audio filtering is single-threaded, the video pass gets the rest
+            logger.info("running commands for processing video and audio concurrently")
+            tmp_file_list.extend(
+                [self._get_tmp_filename("video"), self._get_tmp_filename("audio")]
+            )
+            yield [
+                ("video", self._get_video_step(threads=self.threads - 1), False),
+                ("audio", self._get_audio_cmd(threads=1), False),
+            ]
+            logger.info("running command for merging video/audio")
+            yield [("merge", self._get_merge_cmd(), False)]
+            return
+        if self.has_video:
+            tmp_file_list.append(self._get_tmp_filename("video"))
+            if self.smart_render and self._can_smart_render():
+                logger.info("running commands for smart rendering video")
+                for step in self._iter_smart_render_steps():
+                    yield [step]
+            else:
                 logger.info("running command for processing video")
-                self.insert_buf_video()
-                tmp_file_list.append(self._get_tmp_filename("video"))
-            if self.skipping:
+                yield [("video", self._get_video_step(), False)]
+        if self.skipping:
+            if not self._skips_in_video_graph():
                 logger.info("running command for trimming video")
-                self.trim_video()
                 tmp_file_list.append(self._get_tmp_filename("skipping"))
+                yield [("trim", self._get_trim_cmd(), False)]
+        else:
+            if self.has_audio:
+                logger.info("running command for processing audio")
+                tmp_file_list.append(self._get_tmp_filename("audio"))
+                yield [("audio", self._get_audio_cmd(), False)]
+        logger.info("running command for merging video/audio")
+        yield [("merge", self._get_merge_cmd(), False)]
+
+    def _run_step_group(self, steps: list[Step]):
+        """
+        Run a group of steps concurrently. If one of them fails, the others are killed.
+
+        Raises:
+            RuntimeError: A command failed
+        """
+        if len(steps) == 1:
+            self._run_step(steps[0])
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(steps)) as executor:
+            futures = [executor.submit(self._run_step, step) for step in steps]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+            except BaseException:
+                self._kill_running_processes()
+                raise
+
+    async def _run_step_group_async(self, steps: list[Step]):
+        """
+        Run a group of steps concurrently in the event loop. If one of them fails
+        or the group is cancelled, the others are cancelled, too.
+
+        Raises:
+            RuntimeError: A command failed
+        """
+        tasks = [asyncio.ensure_future(self._run_step_async(step)) for step in steps]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def _run_step(self, step: Step):
+        """
+        Run a processing step, either a command or a function that runs the stage itself
+        """
+        stage, cmd, pass_stdout = step
+        if isinstance(cmd, list):
+            self.run_command(cmd, pass_stdout=pass_stdout, stage=stage)
+        else:
+            cmd()
+
+    async def _run_step_async(self, step: Step):
+        """
+        Run a processing step in the event loop; functions run in a worker thread
+        """
+        stage, cmd, pass_stdout = step
+        if isinstance(cmd, list):
+            await self.run_command_async(cmd, pass_stdout=pass_stdout, stage=stage)
+            return
+        try:
+            await asyncio.to_thread(cmd)
+        except asyncio.CancelledError:
+            # the thread cannot be cancelled, but it stops once its processes are gone
+            self._kill_running_processes()
+            raise
+
+    def _kill_running_processes(self):
+        """
+        Kill the commands started by run_command that are still running
+        """
+        for process in list(self._running_processes):
+            if process.poll() is None:
+                logger.info(f"killing command with PID {process.pid}")
+                process.kill()
+
+    def _get_filter_options(self, filters: list[str]) -> list[str]:
+        """
+        Get the options that pass a complex filter graph to ffmpeg.
+
+        Large graphs, e.g. with thousands of buffering events, are written to a
+        script file, since they can exceed the maximum command line length of the
+        OS. The script file is removed after the command has run.
+
+        Args:
+            filters (list[str]): Filter chains of the graph
+
+        Returns:
+            list[str]: ffmpeg options
+        """
+        graph = ";".join(filters)
+        if self.dry or len(graph) < FILTER_SCRIPT_MIN_LENGTH:
+            return ["-filter_complex", graph]
+
+        if self.tmp_dir is not None:
+            os.makedirs(self.tmp_dir, exist_ok=True)
+        fd, script_file = tempfile.mkstemp(
+            prefix="bufferer_filter_", suffix=".txt", dir=self.tmp_dir
+        )
+        with os.fdopen(fd, "w") as f:
+            f.write(graph)
+        self._filter_scripts.append(script_file)
+        logger.debug(f"filter graph in {script_file}: {graph}")
+
+        return [get_filter_script_option(self.ffmpeg_path), script_file]
+
+    def _remove_filter_scripts(self, cmd: list[str]):
+        """
+        Remove the filter script files used by a command
+        """
+        for script_file in [f for f in self._filter_scripts if f in cmd]:
+            self._filter_scripts.remove(script_file)
+            if os.path.isfile(script_file):
+                os.remove(script_file)
+
+    def _remove_tmp_files(self, tmp_file_list: list[str]):
+        """
+        Remove the temporary files of a run
+        """
+        if self.dry:
+            return
+        for file in tmp_file_list:
+            if os.path.isfile(file):
+                os.remove(file)
             else:
-                if self.has_audio:
-                    logger.info("running command for processing audio")
-                    self.insert_buf_audio()
-                    tmp_file_list.append(self._get_tmp_filename("audio"))
-            logger.info("running command for merging video/audio")
-            self.merge_audio_video()
-        except Exception as e:
-            logger.error(f"error running processing: {e}")
+                logger.debug(f"temporary file {file} was not written")
+
+    def insert_buf_audiovisual(self) -> TimingReport:
+        """
+        Insert the buffering events on both audio and video tracks, looping the video
+        frames and audio samples at the corresponding positions.
+
+        If there are enough threads, the video and audio passes run concurrently.
+
+        Returns:
+            TimingReport: Wall time of each processing stage
+
+        Raises:
+            RuntimeError: Processing failed
+        """
+        self._prepare_processing()
+        start_time = time.monotonic()
+
+        tmp_file_list: list[str] = []
+        steps = self._iter_processing_steps(tmp_file_list)
+
+        try:
+            for step_group in steps:
+                self._run_step_group(step_group)
+        finally:
+            steps.close()
+            self._remove_tmp_files(tmp_file_list)
+            self.timing_report.wall_time = round(time.monotonic() - start_time, 3)
+
+        return self.timing_report
+
+    async def insert_buf_audiovisual_async(self) -> TimingReport:
+        """
+        Insert the buffering events on both audio and video tracks, like
+        `insert_buf_audiovisual()`, but without blocking the event loop.
+
+        Cancelling the task kills the running ffmpeg process and removes the
+        temporary files as well as the partially written output file.
+
+        Returns:
+            TimingReport: Wall time of each processing stage
+
+        Raises:
+            RuntimeError: Processing failed
+        """
+        self._prepare_processing()
+        start_time = time.monotonic()
+
+        tmp_file_list: list[str] = []
+        steps = self._iter_processing_steps(tmp_file_list)
+        writing_output = False
+
+        try:
+            for step_group in steps:
+                writing_output = any(
+                    stage in OUTPUT_STAGES for stage, _, _ in step_group
+                )
+                await self._run_step_group_async(step_group)
+        except asyncio.CancelledError:
+            # only remove the output once we have started overwriting it
+            if (
+                writing_output
+                and not self.dry
+                and not self._is_streaming_output()
+                and os.path.isfile(self.output_file)
+            ):
+                os.remove(self.output_file)
+            raise
         finally:
-            if not self.dry:
-                for file in tmp_file_list:
-                    if os.path.isfile(file):
-                        os.remove(file)
-                    else:
-                        logger.warning(f"temporary file {file} not found!")
+            steps.close()
+            self._remove_tmp_files(tmp_file_list)
+            self.timing_report.wall_time = round(time.monotonic() - start_time, 3)
+
+        return self.timing_report
@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+import csv
+import io
+import json
+import logging
+import os
+from array import array
+from fractions import Fraction
+from typing import Any
+
+logger = logging.getLogger("bufferer")
+
+# exact timebase of the event times: positions and durations are rounded to
+# microseconds, and all frame and sample offsets are computed from these ticks
+# with integer arithmetic
+TICKS_PER_SECOND = 1_000_000
+
+BUFLIST_FORMAT_HINT = (
+    "  Expected format: '[[0, 1], [5, 10]]' or '[0, 1], [5, 10]'\n"
+    "  where each pair is [position_in_seconds, duration_in_seconds]"
+)
+
+
+def parse_buflist(buflist: Any) -> list[list[float]]:
+    """
+    Parse a buffering list given as a list of pairs, a NumPy array of shape (N, 2),
+    a JSON or CSV string, or the path to a JSON or CSV file.
+
+    CSV input has one event per line, as "position,duration", with an optional header.
+
+    Args:
+        buflist (Any): Buffering list
+
+    Returns:
+        list[list[float]]: Buffering events as [position, duration] in seconds, in the given order
+
+    Raises:
+        RuntimeError: The buffering list is not properly formatted
+    """
+    if hasattr(buflist, "tolist"):
+        # NumPy arrays and similar
+        buflist = buflist.tolist()
+
+    if isinstance(buflist, str):
+        if os.path.isfile(buflist):
+            with open(buflist) as f:
+                content = f.read()
+            if buflist.lower().endswith(".csv"):
+                events = _parse_csv(content, buflist)
+            else:
+                events = _parse_json(content)
+        elif "\n" in buflist.strip() and not buflist.lstrip().startswith("["):
+            events = _parse_csv(buflist, buflist)
+        else:
+            events = _parse_json(buflist)
+    else:
+        events = buflist
+        if len(events) == 0:
+            return []
+
+    try:
+        # a single event can be given without the enclosing list
+        pairs: list[Any] = events if isinstance(events[0], (list, tuple)) else [events]
+        return [[float(buf_pos), float(buf_len)] for buf_pos, buf_len in pairs]
+    except (IndexError, KeyError, TypeError, ValueError):
+        raise RuntimeError(
+            f"Buffering list parameter is empty or invalid.\n"
+            f"  Received: {buflist!r}\n"
+            f"{BUFLIST_FORMAT_HINT}"
+        )
+
+
+def _parse_json(buflist: str) -> Any:
+    try:
+        return json.loads(buflist)
+    except json.JSONDecodeError as e:
+        try:
+            return json.loads("[" + buflist + "]")
+        except json.JSONDecodeError:
+            raise RuntimeError(
+                f"Buffering list parameter not properly formatted.\n"
+                f"  Received: {buflist!r}\n"
+                f"  JSON error: {e.msg} at position {e.pos}\n"
+                f"{BUFLIST_FORMAT_HINT}"
+            )
+
+
+def _parse_csv(content: str, source: str) -> list[list[str]]:
+    rows = [row for row in csv.reader(io.StringIO(content)) if row]
+    if rows:
+        try:
+            float(rows[0][0])
+        except ValueError:
+            # header
+            rows = rows[1:]
+    if any(len(row) != 2 for row in rows):
+        raise RuntimeError(
+            f"Buffering list CSV {source!r} needs two columns: position,duration"
+        )
+    return rows
+
+
+def normalize_buflist(
+    buflist: list[list[float]],
+    frame_rate: Fraction,
+    duration: float | None = None,
+) -> list[list[float]]:
+    """
+    Sort the buffering events, drop empty ones and merge the events that freeze
+    the same frame into one event with their summed duration.
+
+    Args:
+        buflist (list[list[float]]): Buffering events as [position, duration] in seconds
+        frame_rate (Fraction): Frame rate of the video
+        duration (float | None, optional): Duration of the input, to validate the positions against. Defaults to None.
+
+    Returns:
+        list[list[float]]: Normalized buffering events
+
+    Raises:
+        RuntimeError: An event has a negative position or duration, or starts after the end of the input
+    """
+    for buf_pos, buf_len in buflist:
+        if buf_pos < 0 or buf_len < 0:
+            raise RuntimeError(
+                f"Buffering event [{buf_pos}, {buf_len}] has a negative position or duration"
+            )
+        if duration is not None and buf_pos > duration:
+            raise RuntimeError(
+                f"Buffering event at {buf_pos} s is after the end of the input ({duration} s)"
+            )
+
+    ticks = sorted(
+        (round(buf_pos * TICKS_PER_SECOND), round(buf_len * TICKS_PER_SECOND))
+        for buf_pos, buf_len in buflist
+    )
+    numerator = frame_rate.numerator
+    denominator = frame_rate.denominator * TICKS_PER_SECOND
+
+    merged: list[list[int]] = []
+    last_frame = -1
+    for pos_ticks, len_ticks in ticks:
+        if len_ticks == 0:
+            continue
+        frame = pos_ticks * numerator // denominator
+        if frame == last_frame:
+            merged[-1][1] += len_ticks
+        else:
+            merged.append([pos_ticks, len_ticks])
+            last_frame = frame
+
+    if len(merged) != len(buflist):
+        logger.debug(f"merged {len(buflist)} buffering events into {len(merged)}")
+    return [
+        [pos_ticks / TICKS_PER_SECOND, len_ticks / TICKS_PER_SECOND]
+        for pos_ticks, len_ticks in merged
+    ]
+
+
+class EventTable:
+    """
+    Buffering events with their exact frame and sample offsets, stored column-wise
+    in compact arrays. Use `EventTable.compile()` to create it.
+
+    Args:
+        positions (array): Event positions in seconds
+        durations (array): Event durations in seconds
+        frame_positions (array): Frame number of the frozen frame of each event
+        frame_lengths (array): Number of stall frames of each event
+        sample_positions (array): Sample number of each event
+        sample_lengths (array): Number of stall samples of each event
+    """
+
+    def __init__(
+        self,
+        positions: array,
+        durations: array,
+        frame_positions: array,
+        frame_lengths: array,
+        sample_positions: array,
+        sample_lengths: array,
+    ):
+        self.positions = positions
+        self.durations = durations
+        self.frame_positions = frame_positions
+        self.frame_lengths = frame_lengths
+        self.sample_positions = sample_positions
+        self.sample_lengths = sample_lengths
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    @classmethod
+    def compile(
+        cls,
+        buflist: list[list[float]],
+        frame_rate: Fraction,
+        sample_rate: int | None = None,
+    ) -> EventTable:
+        """
+        Compute the frame and sample offsets of normalized buffering events.
+
+        The offsets are computed from the event times in microseconds with integer
+        arithmetic, so that e.g. an event at 0.7 s in a 30 fps video starts at
+        frame 21 and not at frame 20, as floating point math would give.
+
+        Args:
+            buflist (list[list[float]]): Buffering events, see `normalize_buflist()`
+            frame_rate (Fraction): Frame rate of the video
+            sample_rate (int | None, optional): Sample rate of the audio. Defaults to None.
+
+        Returns:
+            EventTable: Event table
+        """
+        pos_ticks = [round(buf_pos * TICKS_PER_SECOND) for buf_pos, _ in buflist]
+        len_ticks = [round(buf_len * TICKS_PER_SECOND) for _, buf_len in buflist]
+
+        def to_units(ticks: list[int], rate: Fraction) -> array:
+            numerator = rate.numerator
+            denominator = rate.denominator * TICKS_PER_SECOND
+            return array("q", [tick * numerator // denominator for tick in ticks])
+
+        if sample_rate:
+            sample_positions = to_units(pos_ticks, Fraction(sample_rate))
+            sample_lengths = to_units(len_ticks, Fraction(sample_rate))
+        else:
+            sample_positions = array("q", bytes(8 * len(buflist)))
+            sample_lengths = array("q", bytes(8 * len(buflist)))
+
+        return cls(
+            positions=array("d", [buf_pos for buf_pos, _ in buflist]),
+            durations=array("d", [buf_len for _, buf_len in buflist]),
+            frame_positions=to_units(pos_ticks, frame_rate),
+            frame_lengths=to_units(len_ticks, frame_rate),
+            sample_positions=sample_positions,
+            sample_lengths=sample_lengths,
+        )
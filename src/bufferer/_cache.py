@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+
+
+def get_cache_dir(subdir: str, cache_dir: str | None = None) -> str:
+    """
+    Get (and create) a cache directory.
+
+    Args:
+        subdir (str): Subdirectory for the kind of cached data, e.g. "probe"
+        cache_dir (str | None, optional): Base cache directory. Defaults to
+            $XDG_CACHE_HOME/bufferer or ~/.cache/bufferer.
+
+    Returns:
+        str: Path to the cache directory
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(
+            os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+            "bufferer",
+        )
+    path = os.path.join(cache_dir, subdir)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def get_file_key(path: str) -> str:
+    """
+    Get a key identifying a file by its path, size and modification time.
+
+    Args:
+        path (str): Path to the file
+
+    Returns:
+        str: Key that changes whenever the file is replaced or modified
+    """
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def write_atomic(path: str, data: str | bytes) -> None:
+    """
+    Write a file so that concurrent readers never see partial content.
+
+    Args:
+        path (str): Path to the file
+        data (str | bytes): Content
+    """
+    # unique per thread, for concurrent writers in the same process
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb" if isinstance(data, bytes) else "w") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def get_content_hash(path: str, cache_dir: str | None = None) -> str:
+    """
+    Get the SHA-256 hash of a file's content.
+
+    The hash is remembered per path, size and modification time, so that a file
+    is only read again when it changes.
+
+    Args:
+        path (str): Path to the file
+        cache_dir (str | None, optional): Base cache directory. Defaults to ~/.cache/bufferer.
+
+    Returns:
+        str: Hex digest
+    """
+    key = hashlib.sha1(get_file_key(path).encode("utf-8")).hexdigest()
+    hash_file = os.path.join(get_cache_dir("hash", cache_dir), key)
+    if os.path.isfile(hash_file):
+        with open(hash_file) as f:
+            return f.read().strip()
+
+    content_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            content_hash.update(chunk)
+    digest = content_hash.hexdigest()
+    write_atomic(hash_file, digest)
+    return digest
+
+
+def touch(path: str) -> None:
+    """
+    Mark a cached file as recently used.
+
+    Args:
+        path (str): Path to the file
+    """
+    os.utime(path)
+
+
+def evict_lru(directory: str, max_bytes: int, keep: str | None = None) -> list[str]:
+    """
+    Remove the least recently used files of a cache directory until it fits the size limit.
+
+    Files are ordered by their modification time, which `touch()` updates on every
+    use. Temporary files of runs in progress are not counted or removed.
+
+    Args:
+        directory (str): Cache directory
+        max_bytes (int): Maximum total size of the files, in bytes
+        keep (str | None, optional): File that must not be removed, e.g. the one in use. Defaults to None.
+
+    Returns:
+        list[str]: Removed files
+    """
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and ".tmp" not in entry.name:
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        if keep is not None and os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # already evicted by a concurrent run
+            pass
+        total_bytes -= size
+        removed.append(path)
+    return removed
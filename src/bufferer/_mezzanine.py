@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import os
+
+from ._cache import get_cache_dir, get_content_hash
+
+# lossless intraframe codec of the mezzanine, so that every frame is a keyframe
+# and seeking to any position only decodes that frame
+MEZZANINE_CODEC_OPTIONS = [
+    "-c:v",
+    "ffv1",
+    "-level",
+    "3",
+    "-g",
+    "1",
+    "-slices",
+    "16",
+    "-slicecrc",
+    "0",
+]
+
+DEFAULT_MEZZANINE_CACHE_SIZE = 50.0
+
+
+def get_mezzanine_file(
+    input_file: str, pix_fmt: str, cache_dir: str | None = None
+) -> str:
+    """
+    Get the path of the mezzanine of an input file in the cache. The file may not exist yet.
+
+    The mezzanine is keyed by the content hash of the input and the pixel format,
+    so that renamed or copied sources share their mezzanine.
+
+    Args:
+        input_file (str): Input file
+        pix_fmt (str): Pixel format of the mezzanine
+        cache_dir (str | None, optional): Base cache directory. Defaults to ~/.cache/bufferer.
+
+    Returns:
+        str: Path to the mezzanine
+    """
+    content_hash = get_content_hash(input_file, cache_dir)
+    return os.path.join(
+        get_cache_dir("mezzanine", cache_dir), f"{content_hash}_{pix_fmt}.mkv"
+    )
+
+
+def get_mezzanine_cmd(
+    input_file: str,
+    output_file: str,
+    pix_fmt: str,
+    ffmpeg_path: str = "ffmpeg",
+    threads: int = 1,
+) -> list[str]:
+    """
+    Get the command that decodes an input file into a mezzanine.
+
+    The video is stored with a lossless intraframe codec, and the audio is copied,
+    so that the mezzanine can be used in place of the input.
+
+    Args:
+        input_file (str): Input file
+        output_file (str): Mezzanine file to write
+        pix_fmt (str): Pixel format of the mezzanine
+        ffmpeg_path (str, optional): Path to ffmpeg executable. Defaults to "ffmpeg".
+        threads (int, optional): Number of decoder and encoder threads. Defaults to 1.
+
+    Returns:
+        list[str]: Command
+    """
+    return [
+        ffmpeg_path,
+        "-nostdin",
+        "-threads",
+        str(threads),
+        "-y",
+        "-i",
+        input_file,
+        "-map",
+        "0:v:0",
+        "-map",
+        "0:a:0?",
+        *MEZZANINE_CODEC_OPTIONS,
+        "-pix_fmt",
+        pix_fmt,
+        "-c:a",
+        "copy",
+        "-threads",
+        str(threads),
+        output_file,
+    ]
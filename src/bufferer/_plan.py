@@ -0,0 +1,301 @@
+from __future__ import annotations
+
+import copy
+import json
+import os
+from typing import Any
+
+from ._bufferer import Bufferer
+from ._mezzanine import get_mezzanine_cmd, get_mezzanine_file
+from ._progress import TimingReport
+from ._result_cache import get_result_file, get_result_key
+
+# wall time per megabyte of raw frames and samples decoded and encoded, with one
+# thread, for stages without timing reports; rough values for FFV1 at 1080p
+DEFAULT_SECONDS_PER_MEGABYTE = {
+    "video": 0.008,
+    "audio": 0.005,
+    "trim": 0.004,
+    "merge": 0.001,
+    "single_pass": 0.008,
+    "variants": 0.008,
+    "mezzanine": 0.006,
+}
+FALLBACK_SECONDS_PER_MEGABYTE = 0.008
+
+# peak memory of an ffmpeg process that holds no frames
+BASE_RSS = 64 * 1024 * 1024
+
+# number of decoded frames that a stage holds in memory at the same time, for
+# stages without timing reports
+DEFAULT_FRAMES_IN_FLIGHT = 32.0
+
+
+def get_work_megabytes(work: dict[str, int]) -> float:
+    """
+    Get the raw size of the frames and samples that a stage decodes and encodes.
+
+    Args:
+        work (dict[str, int]): Work of the stage, see `StageTiming.work`
+
+    Returns:
+        float: Size in megabytes
+    """
+    video_bytes = (work["decoded_frames"] + work["frames"]) * work["frame_bytes"]
+    audio_bytes = (work["decoded_samples"] + work["samples"]) * work["sample_bytes"]
+    return (video_bytes + audio_bytes) / 1e6
+
+
+def _holds_frames(work: dict[str, int]) -> bool:
+    """
+    Whether a stage decodes or encodes video frames
+    """
+    return bool(work["frame_bytes"] and (work["decoded_frames"] or work["frames"]))
+
+
+class CostModel:
+    """
+    Model of the wall time and peak memory of the processing stages.
+
+    The wall time of a stage is proportional to the raw size of the frames and
+    samples it decodes and encodes, and its peak memory is a base amount plus a
+    number of frames in flight. Both are calibrated per stage from the timing
+    reports of earlier runs, see `CostModel.from_reports()`. Reports from runs
+    with the same codecs and thread count as the planned run give the best estimates.
+
+    Args:
+        seconds_per_megabyte (dict[str, float] | None, optional): Calibrated wall time per
+            megabyte of each stage. Defaults to None.
+        frames_in_flight (dict[str, float] | None, optional): Calibrated number of frames in
+            memory of each stage. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        seconds_per_megabyte: dict[str, float] | None = None,
+        frames_in_flight: dict[str, float] | None = None,
+    ):
+        self.seconds_per_megabyte = seconds_per_megabyte or {}
+        self.frames_in_flight = frames_in_flight or {}
+
+    @classmethod
+    def from_reports(cls, reports: list[TimingReport]) -> CostModel:
+        """
+        Calibrate the model from the timing reports of earlier runs. Stages that
+        were recorded without their work, e.g. by older versions, are ignored.
+
+        Args:
+            reports (list[TimingReport]): Timing reports
+
+        Returns:
+            CostModel: Calibrated model
+        """
+        seconds: dict[str, float] = {}
+        megabytes: dict[str, float] = {}
+        frames_in_flight: dict[str, float] = {}
+        for report in reports:
+            for timing in report.stages:
+                if not timing.work:
+                    continue
+                work_megabytes = get_work_megabytes(timing.work)
+                if work_megabytes > 0:
+                    seconds[timing.stage] = (
+                        seconds.get(timing.stage, 0.0) + timing.wall_time
+                    )
+                    megabytes[timing.stage] = (
+                        megabytes.get(timing.stage, 0.0) + work_megabytes
+                    )
+                if timing.max_rss and _holds_frames(timing.work):
+                    # the peak is what matters for packing jobs, so keep the largest
+                    frames_in_flight[timing.stage] = max(
+                        frames_in_flight.get(timing.stage, 0.0),
+                        max(0, timing.max_rss - BASE_RSS) / timing.work["frame_bytes"],
+                    )
+
+        return cls(
+            seconds_per_megabyte={
+                stage: seconds[stage] / megabytes[stage] for stage in megabytes
+            },
+            frames_in_flight=frames_in_flight,
+        )
+
+    def is_calibrated(self, stage: str) -> bool:
+        """
+        Whether the estimates of a stage are based on timing reports
+        """
+        return stage in self.seconds_per_megabyte
+
+    def estimate_wall_time(self, stage: str, work: dict[str, int]) -> float:
+        """
+        Estimate the wall time of a stage.
+
+        Args:
+            stage (str): Processing stage
+            work (dict[str, int]): Work of the stage
+
+        Returns:
+            float: Wall time in seconds
+        """
+        seconds_per_megabyte = self.seconds_per_megabyte.get(
+            stage,
+            DEFAULT_SECONDS_PER_MEGABYTE.get(stage, FALLBACK_SECONDS_PER_MEGABYTE),
+        )
+        return seconds_per_megabyte * get_work_megabytes(work)
+
+    def estimate_max_rss(self, stage: str, work: dict[str, int]) -> int:
+        """
+        Estimate the peak memory of a stage.
+
+        Args:
+            stage (str): Processing stage
+            work (dict[str, int]): Work of the stage
+
+        Returns:
+            int: Peak resident set size in bytes
+        """
+        if not _holds_frames(work):
+            return BASE_RSS
+        frames_in_flight = self.frames_in_flight.get(stage, DEFAULT_FRAMES_IN_FLIGHT)
+        return int(BASE_RSS + frames_in_flight * work["frame_bytes"])
+
+
+def load_timing_reports(report_file: str) -> list[TimingReport]:
+    """
+    Load timing reports for calibrating a cost model.
+
+    The file contains a timing report, a list of timing reports, or the report
+    of a batch run, whose successful jobs contain their timing reports.
+
+    Args:
+        report_file (str): Path to the JSON file
+
+    Returns:
+        list[TimingReport]: Timing reports
+    """
+    with open(report_file) as f:
+        data = json.load(f)
+    if not isinstance(data, list):
+        data = [data]
+
+    reports = []
+    for entry in data:
+        if "stages" in entry:
+            reports.append(TimingReport.from_dict(entry))
+        elif entry.get("timings"):
+            reports.append(TimingReport.from_dict(entry["timings"]))
+    return reports
+
+
+def get_plan(b: Bufferer, cost_model: CostModel | None = None) -> dict[str, Any]:
+    """
+    Get the execution plan of a run without running it.
+
+    The plan lists the stages in the order they run, with their commands, the
+    frames and samples they decode and encode, and estimates of their wall time
+    and peak memory. Stages in the same group run concurrently. The totals
+    include the disk space of the intermediate files.
+
+    Args:
+        b (Bufferer): Bufferer of the run, with the input probed
+        cost_model (CostModel | None, optional): Calibrated cost model. Defaults to uncalibrated estimates.
+
+    Returns:
+        dict[str, Any]: JSON-serializable plan
+    """
+    cost_model = cost_model or CostModel()
+    notes = []
+
+    # generate the commands on a copy in dry mode, so that nothing is written
+    planner = copy.copy(b)
+    planner.dry = True
+    if planner.smart_render:
+        notes.append(
+            "smart rendering depends on the keyframes of the input, "
+            "the plan assumes that all of the video is re-encoded"
+        )
+        planner.smart_render = False
+    planner._prepare_processing()
+
+    groups: list[list[tuple[str, list[str] | None]]] = []
+    cached_result = None
+    if b.result_cache and not b._is_streaming_output():
+        result_file = get_result_file(
+            get_result_key(b._get_result_parameters()),
+            os.path.splitext(b.output_file)[1],
+            cache_dir=b.cache_dir,
+        )
+        cached_result = os.path.isfile(result_file)
+
+    if not cached_result:
+        if b._uses_mezzanine():
+            mezzanine_file = get_mezzanine_file(
+                b.input_file, b.pixfmt, cache_dir=b.cache_dir
+            )
+            if not os.path.isfile(mezzanine_file):
+                groups.append(
+                    [
+                        (
+                            "mezzanine",
+                            get_mezzanine_cmd(
+                                b.input_file,
+                                mezzanine_file,
+                                b.pixfmt,
+                                ffmpeg_path=b.ffmpeg_path,
+                                threads=b.threads,
+                            ),
+                        )
+                    ]
+                )
+            planner.input_file = mezzanine_file
+        for step_group in planner._iter_processing_steps([]):
+            groups.append(
+                [
+                    # the raw engine runs the video stage in Python
+                    (stage, None if callable(cmd) else cmd)
+                    for stage, cmd, _ in step_group
+                ]
+            )
+
+    stages = []
+    wall_time = 0.0
+    peak_memory = 0
+    for index, step_group in enumerate(groups):
+        group_wall_time = 0.0
+        group_memory = 0
+        for stage, cmd in step_group:
+            work = planner._get_stage_work(stage)
+            assert work is not None
+            stage_wall_time = cost_model.estimate_wall_time(stage, work)
+            stage_memory = cost_model.estimate_max_rss(stage, work)
+            stages.append(
+                {
+                    "stage": stage,
+                    "group": index,
+                    "command": cmd,
+                    **work,
+                    "wall_time": round(stage_wall_time, 3),
+                    "max_rss": stage_memory,
+                    "calibrated": cost_model.is_calibrated(stage),
+                }
+            )
+            group_wall_time = max(group_wall_time, stage_wall_time)
+            group_memory += stage_memory
+        wall_time += group_wall_time
+        peak_memory = max(peak_memory, group_memory)
+
+    return {
+        "input": b.input_file,
+        "output": b.output_file,
+        "media_info": b.media_info.to_dict() if b.media_info else None,
+        "events": len(b.buflist),
+        "input_duration": planner._get_duration_in_seconds(),
+        "output_duration": planner._get_output_duration(),
+        "cached_result": cached_result,
+        "stages": stages,
+        "tmp_bytes": planner._estimate_tmp_bytes()
+        if groups and not planner.single_pass
+        else 0,
+        "max_rss": peak_memory,
+        "wall_time": round(wall_time, 3),
+        "notes": notes,
+    }
@@ -0,0 +1,359 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import subprocess
+from fractions import Fraction
+from typing import Any
+
+from ._cache import get_cache_dir, get_file_key, write_atomic
+
+logger = logging.getLogger("bufferer")
+
+
+@dataclasses.dataclass
+class MediaInfo:
+    """
+    Stream information of a media file, as needed for inserting buffering events
+
+    Args:
+        has_video (bool): File contains a video stream
+        has_audio (bool): File contains an audio stream
+        duration (float | None): Duration in seconds
+        frame_rate (str | None, optional): Video frame rate as a fraction, e.g. "30000/1001"
+        width (int | None, optional): Video width
+        height (int | None, optional): Video height
+        video_codec (str | None, optional): Video codec name, e.g. "h264"
+        pix_fmt (str | None, optional): Video pixel format
+        sample_rate (int | None, optional): Audio sample rate
+        channels (int | None, optional): Number of audio channels
+        channel_layout (str | None, optional): Audio channel layout, e.g. "stereo"
+        audio_codec (str | None, optional): Audio codec name, e.g. "aac"
+    """
+
+    has_video: bool
+    has_audio: bool
+    duration: float | None
+    frame_rate: str | None = None
+    width: int | None = None
+    height: int | None = None
+    video_codec: str | None = None
+    pix_fmt: str | None = None
+    sample_rate: int | None = None
+    channels: int | None = None
+    channel_layout: str | None = None
+    audio_codec: str | None = None
+
+    @property
+    def fps(self) -> float | None:
+        """
+        Video frame rate as a float
+        """
+        if self.frame_rate is None:
+            return None
+        return float(Fraction(self.frame_rate))
+
+    @property
+    def video_resolution(self) -> str | None:
+        """
+        Video resolution as "WxH"
+        """
+        if self.width is None or self.height is None:
+            return None
+        return f"{self.width}x{self.height}"
+
+    @classmethod
+    def from_ffprobe(cls, data: dict[str, Any]) -> MediaInfo:
+        """
+        Create the media info from ffprobe's JSON output.
+
+        Args:
+            data (dict[str, Any]): Output of ffprobe -show_format -show_streams -print_format json
+
+        Returns:
+            MediaInfo: Media info
+        """
+        streams = data.get("streams", [])
+        video_stream = next(
+            (
+                stream
+                for stream in streams
+                if stream.get("codec_type") == "video"
+                and not stream.get("disposition", {}).get("attached_pic")
+            ),
+            None,
+        )
+        audio_stream = next(
+            (stream for stream in streams if stream.get("codec_type") == "audio"),
+            None,
+        )
+
+        duration = data.get("format", {}).get("duration")
+
+        info = cls(
+            has_video=video_stream is not None,
+            has_audio=audio_stream is not None,
+            duration=float(duration) if duration is not None else None,
+        )
+
+        if video_stream is not None:
+            for key in ("avg_frame_rate", "r_frame_rate"):
+                frame_rate = video_stream.get(key, "0/0")
+                if not frame_rate.startswith("0/") and not frame_rate.endswith("/0"):
+                    info.frame_rate = frame_rate
+                    break
+            info.width = video_stream.get("width")
+            info.height = video_stream.get("height")
+            info.video_codec = video_stream.get("codec_name")
+            info.pix_fmt = video_stream.get("pix_fmt")
+
+        if audio_stream is not None:
+            if "sample_rate" in audio_stream:
+                info.sample_rate = int(audio_stream["sample_rate"])
+            info.channels = audio_stream.get("channels")
+            info.channel_layout = audio_stream.get("channel_layout")
+            info.audio_codec = audio_stream.get("codec_name")
+
+        return info
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Convert the media info to a JSON-serializable dict
+        """
+        return dataclasses.asdict(self)
+
+
+def format_duration(seconds: float) -> str:
+    """
+    Format a duration in the HH:MM:SS.sss format.
+
+    Args:
+        seconds (float): Duration in seconds
+
+    Returns:
+        str: Formatted duration
+    """
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}"
+
+
+def parse_duration(duration: str | float) -> float:
+    """
+    Parse a duration given in seconds or in the [HH:]MM:SS.sss format.
+
+    Args:
+        duration (str | float): Duration
+
+    Returns:
+        float: Duration in seconds
+    """
+    seconds = 0.0
+    for part in str(duration).split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def get_ffprobe_path(ffmpeg_path: str) -> str:
+    """
+    Get the path to the ffprobe executable that belongs to an ffmpeg executable.
+
+    Args:
+        ffmpeg_path (str): Path to ffmpeg executable
+
+    Returns:
+        str: Path to ffprobe executable
+    """
+    dirname, basename = os.path.split(ffmpeg_path)
+    return os.path.join(dirname, basename.replace("ffmpeg", "ffprobe"))
+
+
+@functools.lru_cache(maxsize=None)
+def get_ffmpeg_version(ffmpeg_path: str) -> tuple[int, int] | None:
+    """
+    Get the major and minor version of an ffmpeg executable.
+
+    Builds from git, which report a version like "N-113000-g...", are treated as newer
+    than any release.
+
+    Args:
+        ffmpeg_path (str): Path to ffmpeg executable
+
+    Returns:
+        tuple[int, int] | None: Major and minor version, or None if it cannot be determined
+    """
+    try:
+        output = subprocess.run(
+            [ffmpeg_path, "-version"], capture_output=True, text=True, check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    if re.match(r"ffmpeg version N-", output):
+        return (999, 0)
+    match = re.match(r"ffmpeg version n?(\d+)\.(\d+)", output)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def get_filter_script_option(ffmpeg_path: str) -> str:
+    """
+    Get the ffmpeg option that reads a complex filter graph from a file.
+
+    Args:
+        ffmpeg_path (str): Path to ffmpeg executable
+
+    Returns:
+        str: "-/filter_complex" for ffmpeg 7 and newer, "-filter_complex_script" before
+    """
+    version = get_ffmpeg_version(ffmpeg_path)
+    if version is not None and version >= (7, 0):
+        return "-/filter_complex"
+    return "-filter_complex_script"
+
+
+def get_filter_thread_options(threads: int) -> list[str]:
+    """
+    Get the global ffmpeg options that limit the threads of the filter graphs. The
+    -threads option only limits the decoder before an input, and the encoder
+    before an output.
+
+    Args:
+        threads (int): Number of threads
+
+    Returns:
+        list[str]: Options, to be placed before the inputs
+    """
+    return ["-filter_threads", str(threads), "-filter_complex_threads", str(threads)]
+
+
+def _get_probe_cache_file(input_file: str, cache_dir: str | None) -> str:
+    """
+    Get the path of the cached probe result for a file
+    """
+    cache_key = hashlib.sha1(get_file_key(input_file).encode("utf-8")).hexdigest()
+    return os.path.join(get_cache_dir("probe", cache_dir), f"{cache_key}.json")
+
+
+def _load_cached_probe(cache_file: str | None, input_file: str) -> MediaInfo | None:
+    """
+    Load a cached probe result, if there is one
+    """
+    if cache_file is None or not os.path.isfile(cache_file):
+        return None
+    logger.debug(f"using cached probe result for {input_file}")
+    with open(cache_file) as f:
+        return MediaInfo(**json.load(f))
+
+
+def _get_probe_cmd(input_file: str, ffprobe_path: str) -> list[str]:
+    return [
+        ffprobe_path,
+        "-v",
+        "error",
+        "-print_format",
+        "json",
+        "-show_format",
+        "-show_streams",
+        input_file,
+    ]
+
+
+def probe(
+    input_file: str,
+    ffprobe_path: str = "ffprobe",
+    use_cache: bool = False,
+    cache_dir: str | None = None,
+) -> MediaInfo:
+    """
+    Probe a media file with ffprobe.
+
+    Args:
+        input_file (str): Input file
+        ffprobe_path (str, optional): Path to ffprobe executable. Defaults to "ffprobe".
+        use_cache (bool, optional): Store and look up the result in the on-disk probe cache,
+            keyed by path, size and modification time. Defaults to False.
+        cache_dir (str | None, optional): Base cache directory. Defaults to ~/.cache/bufferer.
+
+    Returns:
+        MediaInfo: Media info
+
+    Raises:
+        RuntimeError: ffprobe failed
+    """
+    cache_file = _get_probe_cache_file(input_file, cache_dir) if use_cache else None
+    cached_info = _load_cached_probe(cache_file, input_file)
+    if cached_info is not None:
+        return cached_info
+
+    cmd = _get_probe_cmd(input_file, ffprobe_path)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(
+            f"running command: {' '.join(cmd)}: {stderr.decode('utf-8')}"
+        )
+
+    info = MediaInfo.from_ffprobe(json.loads(stdout.decode("utf-8")))
+
+    if cache_file is not None:
+        write_atomic(cache_file, json.dumps(info.to_dict()))
+
+    return info
+
+
+async def probe_async(
+    input_file: str,
+    ffprobe_path: str = "ffprobe",
+    use_cache: bool = False,
+    cache_dir: str | None = None,
+) -> MediaInfo:
+    """
+    Probe a media file with ffprobe, without blocking the event loop. See `probe()`.
+
+    Args:
+        input_file (str): Input file
+        ffprobe_path (str, optional): Path to ffprobe executable. Defaults to "ffprobe".
+        use_cache (bool, optional): Store and look up the result in the on-disk probe cache. Defaults to False.
+        cache_dir (str | None, optional): Base cache directory. Defaults to ~/.cache/bufferer.
+
+    Returns:
+        MediaInfo: Media info
+
+    Raises:
+        RuntimeError: ffprobe failed
+    """
+    cache_file = _get_probe_cache_file(input_file, cache_dir) if use_cache else None
+    cached_info = _load_cached_probe(cache_file, input_file)
+    if cached_info is not None:
+        return cached_info
+
+    cmd = _get_probe_cmd(input_file, ffprobe_path)
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(
+            f"running command: {' '.join(cmd)}: {stderr.decode('utf-8')}"
+        )
+
+    info = MediaInfo.from_ffprobe(json.loads(stdout.decode("utf-8")))
+
+    if cache_file is not None:
+        write_atomic(cache_file, json.dumps(info.to_dict()))
+
+    return info
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import dataclasses
+import os
+import subprocess
+import sys
+from typing import Any
+
+# keys written by ffmpeg -progress, for each report
+PROGRESS_KEYS = (
+    "frame",
+    "fps",
+    "bitrate",
+    "total_size",
+    "out_time_us",
+    "out_time_ms",
+    "out_time",
+    "dup_frames",
+    "drop_frames",
+    "speed",
+    "progress",
+)
+
+
+@dataclasses.dataclass
+class Progress:
+    """
+    Progress of an ffmpeg run, as reported by `ffmpeg -progress`
+
+    Args:
+        stage (str): Processing stage, e.g. "video", "audio", "trim" or "merge"
+        frame (int | None): Number of frames written so far
+        fps (float | None): Frames processed per second of wall time
+        speed (float | None): Processing speed relative to realtime
+        out_time (float | None): Output time written so far, in seconds
+        duration (float | None): Expected output duration, in seconds
+        finished (bool): Whether this is the final report of the stage
+    """
+
+    stage: str
+    frame: int | None = None
+    fps: float | None = None
+    speed: float | None = None
+    out_time: float | None = None
+    duration: float | None = None
+    finished: bool = False
+
+    @property
+    def eta(self) -> float | None:
+        """
+        Estimated remaining wall time of the stage, in seconds
+        """
+        if not (self.duration and self.out_time is not None and self.speed):
+            return None
+        return max(0.0, self.duration - self.out_time) / self.speed
+
+
+class ProgressParser:
+    """
+    Incremental parser for the key=value blocks written by `ffmpeg -progress`
+
+    Args:
+        stage (str): Processing stage that the reports belong to
+        duration (float | None, optional): Expected output duration, in seconds. Defaults to None.
+    """
+
+    def __init__(self, stage: str, duration: float | None = None):
+        self.stage = stage
+        self.duration = duration
+        self._values: dict[str, str] = {}
+
+    def feed(self, line: str) -> Progress | None:
+        """
+        Feed a line of ffmpeg output.
+
+        Args:
+            line (str): Line of output
+
+        Returns:
+            Progress | None: Progress, if the line completed a report, otherwise None
+        """
+        if not self.is_progress_line(line):
+            return None
+        key, _, value = line.strip().partition("=")
+        self._values[key] = value.strip()
+        if key != "progress":
+            return None
+
+        values, self._values = self._values, {}
+        # out_time_ms is in microseconds, too
+        out_time_us = _to_number(
+            values.get("out_time_us", values.get("out_time_ms")), int
+        )
+        return Progress(
+            stage=self.stage,
+            frame=_to_number(values.get("frame"), int),
+            fps=_to_number(values.get("fps"), float),
+            speed=_to_number(values.get("speed", "").rstrip("x"), float),
+            out_time=out_time_us / 1_000_000 if out_time_us is not None else None,
+            duration=self.duration,
+            finished=values["progress"] == "end",
+        )
+
+    def is_progress_line(self, line: str) -> bool:
+        """
+        Check whether a line is part of a progress report, rather than regular log output.
+
+        Args:
+            line (str): Line of output
+
+        Returns:
+            bool: True if the line belongs to a progress report
+        """
+        key, sep, _ = line.strip().partition("=")
+        return bool(sep) and (key in PROGRESS_KEYS or key.startswith("stream_"))
+
+
+def _to_number(value: str | None, number_type: type) -> Any:
+    if value is None:
+        return None
+    try:
+        return number_type(value)
+    except ValueError:
+        return None
+
+
+@dataclasses.dataclass
+class StageTiming:
+    """
+    Timing and resource usage of a processing stage
+
+    Args:
+        stage (str): Processing stage, e.g. "video", "audio", "trim" or "merge"
+        wall_time (float): Wall time in seconds
+        cpu_time (float | None, optional): User and system CPU time of the ffmpeg process, in seconds
+        max_rss (int | None, optional): Peak resident set size of the ffmpeg process, in bytes
+        output_bytes (int | None, optional): Size of the file written by the stage, in bytes
+        work (dict[str, int] | None, optional): Frames and samples decoded and encoded by the stage,
+            for calibrating the cost model of execution plans
+    """
+
+    stage: str
+    wall_time: float
+    cpu_time: float | None = None
+    max_rss: int | None = None
+    output_bytes: int | None = None
+    work: dict[str, int] | None = None
+
+
+@dataclasses.dataclass
+class TimingReport:
+    """
+    Timings of all processing stages of a run
+
+    Args:
+        stages (list[StageTiming]): Timings of the stages, in the order they ran
+        wall_time (float): Total wall time in seconds, including overhead between stages
+    """
+
+    stages: list[StageTiming] = dataclasses.field(default_factory=list)
+    wall_time: float = 0.0
+
+    def get_stage_time(self, stage: str) -> float:
+        """
+        Get the summed wall time of all runs of a stage.
+
+        Args:
+            stage (str): Processing stage
+
+        Returns:
+            float: Wall time in seconds
+        """
+        return sum(timing.wall_time for timing in self.stages if timing.stage == stage)
+
+    def get_max_rss(self) -> int | None:
+        """
+        Get the peak resident set size over all stages.
+
+        Returns:
+            int | None: Peak RSS in bytes, or None if it was not measured
+        """
+        values = [timing.max_rss for timing in self.stages if timing.max_rss]
+        return max(values) if values else None
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Convert the report to a JSON-serializable dict
+        """
+        return dataclasses.asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> TimingReport:
+        """
+        Create a report from a dict, as written by `to_dict()`
+        """
+        return cls(
+            stages=[StageTiming(**stage) for stage in data.get("stages", [])],
+            wall_time=data.get("wall_time", 0.0),
+        )
+
+
+def wait_for_process(process: subprocess.Popen) -> tuple[float | None, int | None]:
+    """
+    Wait for a process to exit and get its resource usage.
+
+    Args:
+        process (subprocess.Popen): Process whose output has been read completely
+
+    Returns:
+        tuple[float | None, int | None]: CPU time in seconds and peak RSS in bytes,
+            or None where the platform does not report them
+    """
+    if not hasattr(os, "wait4"):
+        process.wait()
+        return None, None
+
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # already reaped, e.g. by a concurrent poll()
+        process.wait()
+        return None, None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    max_rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return round(rusage.ru_utime + rusage.ru_stime, 3), max_rss
@@ -0,0 +1,451 @@
+from __future__ import annotations
+
+import concurrent.futures
+import glob
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any
+
+from ._batch import run_job
+
+logger = logging.getLogger("bufferer")
+
+JOB_STATES = ("pending", "running", "done", "failed")
+
+DEFAULT_LEASE = 300.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    output TEXT NOT NULL UNIQUE,
+    job TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    error TEXT,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_until REAL,
+    started REAL,
+    finished REAL,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until);
+"""
+
+
+def get_worker_id() -> str:
+    """
+    Get an ID for this worker process that is unique across hosts
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def get_partial_output(output_file: str, token: str) -> str:
+    """
+    Get the path to write an output to before it is renamed into place.
+
+    The partial file is in the same directory, so that the rename is atomic, and
+    keeps the extension, so that ffmpeg picks the same output format.
+
+    Args:
+        output_file (str): Final output file
+        token (str): Token that makes the path unique, e.g. the job ID
+
+    Returns:
+        str: Path of the partial output
+    """
+    dirname, basename = os.path.split(output_file)
+    root, ext = os.path.splitext(basename)
+    return os.path.join(dirname, f".{root}.{token}.partial{ext}")
+
+
+def remove_partial_outputs(output_file: str, job_id: int) -> list[str]:
+    """
+    Remove the partial outputs that earlier attempts of a job left behind when
+    their worker died.
+
+    Args:
+        output_file (str): Final output file
+        job_id (int): Job ID
+
+    Returns:
+        list[str]: Paths of the removed partial outputs
+    """
+    pattern = get_partial_output(glob.escape(output_file), f"{job_id}-*")
+    removed = []
+    for partial_output in glob.glob(pattern):
+        try:
+            os.remove(partial_output)
+        except FileNotFoundError:
+            continue
+        removed.append(partial_output)
+    return removed
+
+
+class JobQueue:
+    """
+    Persistent queue of bufferer jobs in an SQLite database.
+
+    Each job is pending, running, done or failed. Workers claim a job by taking a
+    lease on it, which they renew while the job runs. When a worker dies, e.g.
+    because its host rebooted, its lease expires and the job is claimed again,
+    so that restarting the workers resumes only the unfinished work.
+
+    Workers on several hosts can share a queue on a shared filesystem, as long
+    as it supports file locking and the clocks of the hosts are synchronized.
+
+    Args:
+        path (str): Path to the database, created if it does not exist
+        timeout (float, optional): Seconds to wait for the database lock. Defaults to 60.
+    """
+
+    def __init__(self, path: str, timeout: float = 60.0):
+        self.path = path
+        # autocommit mode, transactions are started explicitly
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        """
+        Close the database connection
+        """
+        self.connection.close()
+
+    def add(self, jobs: list[dict[str, Any]]) -> int:
+        """
+        Add jobs to the queue. Jobs whose output is already queued are skipped,
+        so that a manifest can be added again without duplicating work.
+
+        Args:
+            jobs (list[dict[str, Any]]): Jobs as loaded from a manifest, see `load_manifest()`
+
+        Returns:
+            int: Number of jobs added
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            added = 0
+            for job in jobs:
+                # workers may run in other working directories
+                job = {
+                    **job,
+                    "input": os.path.abspath(job["input"]),
+                    "output": os.path.abspath(job["output"]),
+                }
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO jobs (output, job) VALUES (?, ?)",
+                    (job["output"], json.dumps(job)),
+                )
+                added += cursor.rowcount
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return added
+
+    def claim(
+        self, worker: str, lease: float = DEFAULT_LEASE
+    ) -> tuple[int, dict[str, Any], bool] | None:
+        """
+        Claim the next pending job, or a running job whose lease has expired.
+
+        Args:
+            worker (str): ID of the claiming worker
+            lease (float, optional): Seconds until the claim expires unless renewed. Defaults to 300.
+
+        Returns:
+            tuple[int, dict[str, Any], bool] | None: Job ID, job and whether the lease of an
+                earlier worker expired, or None if there is no work left
+        """
+        now = time.time()
+        # take the write lock before reading, so that no other worker can claim the same job
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute(
+                "SELECT id, job, status, worker FROM jobs "
+                "WHERE status = 'pending' OR (status = 'running' AND lease_until < ?) "
+                "ORDER BY id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is not None:
+                job_id, job, status, previous_worker = row
+                if status == "running":
+                    logger.warning(
+                        f"job {job_id} of worker {previous_worker} expired, claiming it again"
+                    )
+                self.connection.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, "
+                    "started = ?, attempts = attempts + 1, error = NULL WHERE id = ?",
+                    (worker, now + lease, now, job_id),
+                )
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+        return job_id, json.loads(job), status == "running"
+
+    def renew(self, job_id: int, worker: str, lease: float = DEFAULT_LEASE) -> bool:
+        """
+        Renew the lease on a running job.
+
+        Args:
+            job_id (int): Job ID
+            worker (str): ID of the worker that claimed the job
+            lease (float, optional): Seconds until the claim expires unless renewed again. Defaults to 300.
+
+        Returns:
+            bool: False if the job is no longer claimed by this worker
+        """
+        cursor = self.connection.execute(
+            "UPDATE jobs SET lease_until = ? "
+            "WHERE id = ? AND worker = ? AND status = 'running'",
+            (time.time() + lease, job_id, worker),
+        )
+        return cursor.rowcount == 1
+
+    def finish(self, job_id: int, worker: str, result: dict[str, Any]) -> bool:
+        """
+        Record the result of a job.
+
+        Args:
+            job_id (int): Job ID
+            worker (str): ID of the worker that claimed the job
+            result (dict[str, Any]): Result, see `run_job()`
+
+        Returns:
+            bool: False if the job is no longer claimed by this worker, so the result was not recorded
+        """
+        cursor = self.connection.execute(
+            "UPDATE jobs SET status = ?, error = ?, finished = ?, result = ?, lease_until = NULL "
+            "WHERE id = ? AND worker = ? AND status = 'running'",
+            (
+                result["status"],
+                result["error"],
+                time.time(),
+                json.dumps(result),
+                job_id,
+                worker,
+            ),
+        )
+        return cursor.rowcount == 1
+
+    def retry_failed(self) -> int:
+        """
+        Put all failed jobs back into the queue.
+
+        Returns:
+            int: Number of jobs queued again
+        """
+        cursor = self.connection.execute(
+            "UPDATE jobs SET status = 'pending', worker = NULL WHERE status = 'failed'"
+        )
+        return cursor.rowcount
+
+    def get_counts(self) -> dict[str, int]:
+        """
+        Get the number of jobs in each state.
+
+        Returns:
+            dict[str, int]: Number of jobs by state
+        """
+        counts = dict.fromkeys(JOB_STATES, 0)
+        for status, count in self.connection.execute(
+            "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+        ):
+            counts[status] = count
+        return counts
+
+    def get_failed_jobs(self) -> list[dict[str, Any]]:
+        """
+        Get the failed jobs with their errors.
+
+        Returns:
+            list[dict[str, Any]]: ID, output, error and number of attempts of each failed job
+        """
+        return [
+            {"id": job_id, "output": output, "error": error, "attempts": attempts}
+            for job_id, output, error, attempts in self.connection.execute(
+                "SELECT id, output, error, attempts FROM jobs "
+                "WHERE status = 'failed' ORDER BY id"
+            )
+        ]
+
+
+def _renew_lease(
+    queue_path: str, job_id: int, worker: str, lease: float, stop: threading.Event
+):
+    """
+    Renew the lease on a job until it has finished
+    """
+    # SQLite connections cannot be shared between threads
+    queue = JobQueue(queue_path)
+    try:
+        while not stop.wait(lease / 3):
+            if not queue.renew(job_id, worker, lease):
+                logger.warning(f"lost the lease on job {job_id}")
+                return
+    finally:
+        queue.close()
+
+
+def run_queued_job(
+    job: dict[str, Any], job_id: int, threads: int = 1, expired: bool = False
+) -> dict[str, Any]:
+    """
+    Run a queued job, writing to a partial output that is renamed into place only
+    when the job has succeeded, so that a crashed job never leaves a half-written output.
+
+    Partial outputs of earlier attempts are removed. If the lease of an earlier
+    attempt expired and the output exists, that attempt died after renaming its
+    output into place, so the job is done.
+
+    Args:
+        job (dict[str, Any]): Job as loaded from the manifest
+        job_id (int): Job ID, to make the partial output unique
+        threads (int, optional): Number of threads assigned to the job. Defaults to 1.
+        expired (bool, optional): Whether the lease of an earlier attempt expired. Defaults to False.
+
+    Returns:
+        dict[str, Any]: Result of the job, with status "done" or "failed"
+    """
+    output_file = job["output"]
+    for partial_output in remove_partial_outputs(output_file, job_id):
+        logger.info(f"removed partial output {partial_output} of an earlier attempt")
+
+    if os.path.exists(output_file) and not job.get("force_overwrite"):
+        if expired:
+            logger.info(f"output file {output_file} was written by an earlier attempt")
+            return {
+                "input": job["input"],
+                "output": output_file,
+                "status": "done",
+                "error": None,
+            }
+        return {
+            "input": job["input"],
+            "output": output_file,
+            "status": "failed",
+            "error": f"output file {output_file} already exists",
+        }
+
+    partial_output = get_partial_output(output_file, f"{job_id}-{os.getpid()}")
+    result = run_job({**job, "output": partial_output}, threads=threads)
+    result["output"] = output_file
+
+    if result["status"] == "done" and not job.get("dry"):
+        os.replace(partial_output, output_file)
+    elif os.path.isfile(partial_output):
+        os.remove(partial_output)
+
+    return result
+
+
+def run_worker(
+    queue_path: str,
+    threads: int = 1,
+    lease: float = DEFAULT_LEASE,
+    defaults: dict[str, Any] | None = None,
+) -> dict[str, int]:
+    """
+    Claim and run jobs from a queue until no work is left.
+
+    Args:
+        queue_path (str): Path to the queue database
+        threads (int, optional): Number of threads for each job. Defaults to 1.
+        lease (float, optional): Seconds until a claim expires unless renewed. Defaults to 300.
+        defaults (dict[str, Any] | None, optional): Options for jobs that do not set them, e.g. "ffmpeg_path".
+            Defaults to None.
+
+    Returns:
+        dict[str, int]: Number of jobs done and failed by this worker
+    """
+    worker = get_worker_id()
+    queue = JobQueue(queue_path)
+    counts = {"done": 0, "failed": 0}
+    try:
+        while True:
+            claimed = queue.claim(worker, lease)
+            if claimed is None:
+                break
+            job_id, job, expired = claimed
+            job = {**(defaults or {}), **job}
+
+            stop = threading.Event()
+            renewer = threading.Thread(
+                target=_renew_lease,
+                args=(queue_path, job_id, worker, lease, stop),
+                daemon=True,
+            )
+            renewer.start()
+            try:
+                result = run_queued_job(job, job_id, threads=threads, expired=expired)
+            finally:
+                stop.set()
+                renewer.join()
+
+            if not queue.finish(job_id, worker, result):
+                logger.warning(
+                    f"job {job_id} was claimed by another worker, discarding the result"
+                )
+                continue
+            counts[result["status"]] += 1
+            if result["status"] == "done":
+                logger.info(f"job {job_id} done: {result['output']}")
+            else:
+                logger.error(f"job {job_id} failed: {result['error']}")
+    finally:
+        queue.close()
+
+    return counts
+
+
+def run_workers(
+    queue_path: str,
+    max_workers: int | None = None,
+    cpu_budget: int | None = None,
+    lease: float = DEFAULT_LEASE,
+    defaults: dict[str, Any] | None = None,
+) -> dict[str, int]:
+    """
+    Run worker processes on a queue until no work is left.
+
+    The CPU budget is shared between the workers, like in `run_batch()`.
+
+    Args:
+        queue_path (str): Path to the queue database
+        max_workers (int | None, optional): Number of worker processes. Defaults to the CPU count.
+        cpu_budget (int | None, optional): Total number of CPUs to use. Defaults to the CPU count.
+        lease (float, optional): Seconds until a claim expires unless renewed. Defaults to 300.
+        defaults (dict[str, Any] | None, optional): Options for jobs that do not set them. Defaults to None.
+
+    Returns:
+        dict[str, int]: Number of jobs done and failed by all workers
+    """
+    cpu_count = os.cpu_count() or 1
+    cpu_budget = cpu_budget or cpu_count
+    max_workers = max(1, max_workers or cpu_budget)
+    threads = max(1, cpu_budget // max_workers)
+
+    logger.info(
+        f"running {max_workers} workers with {threads} threads each on {queue_path}"
+    )
+
+    counts = {"done": 0, "failed": 0}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(run_worker, queue_path, threads, lease, defaults)
+            for _ in range(max_workers)
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            for status, count in future.result().items():
+                counts[status] += count
+
+    return counts
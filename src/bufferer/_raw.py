@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+import logging
+from fractions import Fraction
+from typing import IO, Any
+
+from ._buflist import EventTable, normalize_buflist
+
+logger = logging.getLogger("bufferer")
+
+# pixel format of the frames exchanged with ffmpeg
+RAW_PIX_FMT = "rgb24"
+RAW_BYTES_PER_PIXEL = 3
+
+
+def load_numpy() -> Any:
+    """
+    Import NumPy, which is an optional dependency of the raw engine.
+
+    Returns:
+        module: The numpy module
+
+    Raises:
+        RuntimeError: NumPy is not installed
+    """
+    try:
+        import numpy  # ty: ignore[unresolved-import]
+    except ImportError:
+        raise RuntimeError(
+            "The raw video engine needs NumPy for the spinner and blur effects. "
+            "Install it with: pip install 'bufferer[raw]'"
+        )
+    return numpy
+
+
+def get_stall_frames(
+    buflist: list[list], frame_rate: Fraction
+) -> list[tuple[int, int]]:
+    """
+    Get the frame-exact positions and lengths of the buffering events.
+
+    Events that freeze the same frame are merged, see `normalize_buflist()`.
+
+    Args:
+        buflist (list[list]): Buffering events as [position, duration] in seconds
+        frame_rate (Fraction): Frame rate of the video
+
+    Returns:
+        list[tuple[int, int]]: Frame number of each frozen frame and number of stall frames, sorted by position
+    """
+    events = EventTable.compile(normalize_buflist(buflist, frame_rate), frame_rate)
+    return [
+        (frame, length)
+        for frame, length in zip(events.frame_positions, events.frame_lengths)
+        if length > 0
+    ]
+
+
+def box_blur(frame: Any, size: int) -> Any:
+    """
+    Blur a frame with a box filter of the given radius, like ffmpeg's avgblur.
+
+    Args:
+        frame (numpy.ndarray): Frame of shape (height, width, channels)
+        size (int): Horizontal and vertical radius of the filter
+
+    Returns:
+        numpy.ndarray: Blurred frame, as uint8
+    """
+    np = load_numpy()
+    if size < 1:
+        return frame
+    result = frame.astype(np.uint32)
+    for axis in (0, 1):
+        # running sums over the edge-padded frame give each window sum in O(1)
+        pad_width = [(0, 0)] * result.ndim
+        pad_width[axis] = (size + 1, size)
+        padded = np.pad(result, pad_width, mode="edge").cumsum(axis=axis)
+        upper = padded.take(range(2 * size + 1, padded.shape[axis]), axis=axis)
+        lower = padded.take(range(0, padded.shape[axis] - 2 * size - 1), axis=axis)
+        result = (upper - lower) // (2 * size + 1)
+    return result.astype(np.uint8)
+
+
+class StallRenderer:
+    """
+    Renders the frames shown during a buffering event: the frozen frame, blurred
+    and darkened once per event, with the spinner composited on top
+
+    Args:
+        width (int): Frame width
+        height (int): Frame height
+        spinner_frames (list | None, optional): RGBA spinner frames (numpy arrays) of one cycle,
+            or None to show only the frozen frame. Defaults to None.
+        blur (int, optional): Blur radius. Defaults to 0.
+        brightness (float, optional): Brightness change, between -1.0 and 1.0. Defaults to 0.0.
+    """
+
+    def __init__(
+        self,
+        width: int,
+        height: int,
+        spinner_frames: list | None = None,
+        blur: int = 0,
+        brightness: float = 0.0,
+    ):
+        self.width = width
+        self.height = height
+        self.spinner_frames = spinner_frames
+        self.blur = blur
+        self.brightness = brightness
+
+    @property
+    def has_effects(self) -> bool:
+        """
+        Whether the stall frames differ from the frozen frame
+        """
+        return self.spinner_frames is not None
+
+    def iter_frames(
+        self, frozen_frame: bytearray | None, num_frames: int, first_index: int
+    ):
+        """
+        Generate the frames of one buffering event.
+
+        Args:
+            frozen_frame (bytearray | None): Frozen frame, or None for a black frame
+            num_frames (int): Number of stall frames
+            first_index (int): Output frame number of the first stall frame, to keep the spinner in phase
+
+        Yields:
+            memoryview: Frame data, only valid until the next frame is requested
+        """
+        if not self.has_effects:
+            if frozen_frame is None:
+                frozen_frame = bytearray(self.width * self.height * RAW_BYTES_PER_PIXEL)
+            # repeat the frozen frame without copying it
+            frame_view = memoryview(frozen_frame)
+            for _ in range(num_frames):
+                yield frame_view
+            return
+
+        np = load_numpy()
+        shape = (self.height, self.width, RAW_BYTES_PER_PIXEL)
+        if frozen_frame is None:
+            base = np.zeros(shape, dtype=np.uint8)
+        else:
+            base = np.frombuffer(frozen_frame, dtype=np.uint8).reshape(shape)
+
+        # blur and darken the frozen frame only once per event
+        base = box_blur(base, self.blur)
+        if self.brightness:
+            base = np.clip(
+                base.astype(np.int16) + round(self.brightness * 255), 0, 255
+            ).astype(np.uint8)
+        else:
+            base = base.copy()
+
+        assert self.spinner_frames is not None
+        spinner_height, spinner_width = self.spinner_frames[0].shape[:2]
+        top = (self.height - spinner_height) // 2
+        left = (self.width - spinner_width) // 2
+        region = (
+            slice(max(0, top), min(self.height, top + spinner_height)),
+            slice(max(0, left), min(self.width, left + spinner_width)),
+        )
+        spinner_region = (
+            slice(region[0].start - top, region[0].stop - top),
+            slice(region[1].start - left, region[1].stop - left),
+        )
+        background = base[region].astype(np.uint16)
+
+        frame = base
+        for index in range(first_index, first_index + num_frames):
+            # only the area below the spinner changes between the stall frames
+            spinner = self.spinner_frames[index % len(self.spinner_frames)][
+                spinner_region
+            ]
+            alpha = spinner[..., 3:4].astype(np.uint16)
+            frame[region] = (
+                (spinner[..., :3] * alpha + background * (255 - alpha)) // 255
+            ).astype(np.uint8)
+            yield memoryview(frame).cast("B")
+
+
+def read_frame(stream: IO[bytes], frame: bytearray) -> bool:
+    """
+    Read a complete frame from a stream.
+
+    Args:
+        stream (IO[bytes]): Stream of raw frames
+        frame (bytearray): Buffer to read into
+
+    Returns:
+        bool: False if the stream ended before the frame
+    """
+    view = memoryview(frame)
+    position = 0
+    while position < len(frame):
+        num_read = stream.readinto(view[position:])  # type: ignore[attr-defined]
+        if not num_read:
+            return False
+        position += num_read
+    return True
+
+
+def render_video(
+    decoder_stdout: IO[bytes],
+    encoder_stdin: IO[bytes],
+    width: int,
+    height: int,
+    stall_frames: list[tuple[int, int]],
+    renderer: StallRenderer,
+    skipping: bool = False,
+    black_frame: bool = False,
+) -> int:
+    """
+    Copy raw frames from the decoder to the encoder, inserting the buffering events.
+
+    For each event, the stall frames are inserted after the frozen frame has been
+    read, and the frozen frame is shown once more afterwards. With skipping, the
+    stall frames replace the frozen frame and the following frames instead, so
+    that the number of frames stays the same.
+
+    Args:
+        decoder_stdout (IO[bytes]): Raw frames of the input
+        encoder_stdin (IO[bytes]): Raw frames of the output
+        width (int): Frame width
+        height (int): Frame height
+        stall_frames (list[tuple[int, int]]): Frozen frame numbers and stall lengths, see `get_stall_frames()`
+        renderer (StallRenderer): Renderer of the stall frames
+        skipping (bool, optional): Skip the input frames during stalls. Defaults to False.
+        black_frame (bool, optional): Show a black frame for a stall at the first frame. Defaults to False.
+
+    Returns:
+        int: Number of frames written
+    """
+    frame = bytearray(width * height * RAW_BYTES_PER_PIXEL)
+    frame_view = memoryview(frame)
+    stalls = dict(stall_frames)
+
+    input_index = 0
+    output_index = 0
+    skip_until = 0
+    while read_frame(decoder_stdout, frame):
+        if input_index < skip_until:
+            input_index += 1
+            continue
+
+        num_stall_frames = stalls.get(input_index)
+        if num_stall_frames:
+            frozen_frame = None if black_frame and input_index == 0 else frame
+            for stall_frame in renderer.iter_frames(
+                frozen_frame, num_stall_frames, output_index
+            ):
+                encoder_stdin.write(stall_frame)
+            output_index += num_stall_frames
+            if skipping:
+                # the stall replaces the frozen frame and the frames after it
+                skip_until = input_index + num_stall_frames
+                input_index += 1
+                continue
+
+        encoder_stdin.write(frame_view)
+        output_index += 1
+        input_index += 1
+
+    logger.debug(f"raw engine: read {input_index} frames, wrote {output_index} frames")
+    return output_index
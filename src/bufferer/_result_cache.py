@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from typing import Any
+
+from ._cache import get_cache_dir
+
+# keep ffmpeg from writing its version into the output, so that identical
+# renders are identical byte by byte
+BITEXACT_OPTIONS = [
+    "-fflags",
+    "+bitexact",
+    "-flags:v",
+    "+bitexact",
+    "-flags:a",
+    "+bitexact",
+]
+
+DEFAULT_RESULT_CACHE_SIZE = 50.0
+
+
+def get_result_key(parameters: dict[str, Any]) -> str:
+    """
+    Get the cache key of a render.
+
+    Args:
+        parameters (dict[str, Any]): JSON-serializable description of everything that affects the output
+
+    Returns:
+        str: Key
+    """
+    return hashlib.sha256(
+        json.dumps(parameters, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def get_result_file(key: str, extension: str, cache_dir: str | None = None) -> str:
+    """
+    Get the path of a cached result. The file may not exist yet.
+
+    Args:
+        key (str): Cache key, see `get_result_key()`
+        extension (str): Extension of the output, e.g. ".mkv"
+        cache_dir (str | None, optional): Base cache directory. Defaults to ~/.cache/bufferer.
+
+    Returns:
+        str: Path to the cached result
+    """
+    return os.path.join(get_cache_dir("result", cache_dir), f"{key}{extension}")
+
+
+def link_or_copy(source: str, destination: str) -> None:
+    """
+    Hardlink a file, or copy it if it is on another filesystem. The destination
+    appears atomically.
+
+    Args:
+        source (str): Existing file
+        destination (str): New file, replaced if it exists
+    """
+    # unique per thread, for concurrent jobs of a server in the same process
+    tmp_destination = f"{destination}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source, tmp_destination)
+    except OSError:
+        shutil.copyfile(source, tmp_destination)
+    os.replace(tmp_destination, destination)
@@ -0,0 +1,405 @@
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import dataclasses
+import hmac
+import json
+import logging
+import os
+import secrets
+import socket
+import socketserver
+import threading
+import time
+from collections.abc import Iterator
+from typing import Any, Callable
+
+from ._batch import check_job, run_job
+from ._cache import get_cache_dir, get_file_key
+from ._probe import MediaInfo, get_ffprobe_path, probe
+from ._progress import Progress
+
+logger = logging.getLogger("bufferer")
+
+# number of probe results kept in memory
+PROBE_CACHE_SIZE = 1024
+
+# options that only the defaults of the server set: which executables run, where
+# the caches are and whether existing files are replaced. Outputs and scratch files
+# are still written where the client asks, which is why only the user running
+# the server can connect, see `create_server()`
+SERVER_OPTIONS = ("ffmpeg_path", "ffprobe_path", "cache_dir", "force_overwrite")
+
+
+class JobServer:
+    """
+    Runs jobs on a pool of worker threads in a long-running process, so that
+    jobs do not pay for starting Python and probing inputs again.
+
+    Probe results are kept in memory, keyed by path, size and modification time
+    of the input. Spinners are pre-rendered once into the spinner cache, unless
+    the defaults or a job disable the spinner cache. The options in
+    `SERVER_OPTIONS` can only be set in the defaults, jobs that set them fail.
+
+    Args:
+        max_workers (int | None, optional): Number of parallel jobs. Defaults to the CPU count.
+        cpu_budget (int | None, optional): Total number of CPUs to use. Defaults to the CPU count.
+        defaults (dict[str, Any] | None, optional): Options for jobs that do not set them. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        max_workers: int | None = None,
+        cpu_budget: int | None = None,
+        defaults: dict[str, Any] | None = None,
+    ):
+        cpu_count = os.cpu_count() or 1
+        cpu_budget = cpu_budget or cpu_count
+        self.max_workers = max(1, max_workers or cpu_budget)
+        self.threads = max(1, cpu_budget // self.max_workers)
+        self.defaults = {"spinner_cache": True, **(defaults or {})}
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="bufferer-job"
+        )
+        self._probe_cache: collections.OrderedDict[tuple[str, str], MediaInfo] = (
+            collections.OrderedDict()
+        )
+        self._probe_lock = threading.Lock()
+
+    def close(self):
+        """
+        Wait for the running jobs and stop the worker threads
+        """
+        self.executor.shutdown(wait=True)
+
+    def get_media_info(self, job: dict[str, Any]) -> MediaInfo:
+        """
+        Probe the input of a job, or get the probe result from memory.
+
+        Args:
+            job (dict[str, Any]): Job
+
+        Returns:
+            MediaInfo: Media info of the input
+        """
+        ffprobe_path = job.get("ffprobe_path") or get_ffprobe_path(
+            job.get("ffmpeg_path", "ffmpeg")
+        )
+        key = (get_file_key(job["input"]), ffprobe_path)
+        with self._probe_lock:
+            media_info = self._probe_cache.get(key)
+            if media_info is not None:
+                self._probe_cache.move_to_end(key)
+                return media_info
+
+        # probe outside of the lock, so that other jobs are not blocked
+        media_info = probe(
+            job["input"],
+            ffprobe_path=ffprobe_path,
+            use_cache=job.get("probe_cache", False),
+            cache_dir=job.get("cache_dir"),
+        )
+        with self._probe_lock:
+            self._probe_cache[key] = media_info
+            while len(self._probe_cache) > PROBE_CACHE_SIZE:
+                self._probe_cache.popitem(last=False)
+        return media_info
+
+    def run(
+        self,
+        job: dict[str, Any],
+        progress_callback: Callable[[Progress], None] | None = None,
+    ) -> dict[str, Any]:
+        """
+        Run a job in the calling thread.
+
+        Args:
+            job (dict[str, Any]): Job, with the same keys as in a batch manifest
+            progress_callback (Callable[[Progress], None] | None, optional): Function called with the
+                progress of each stage. Defaults to None.
+
+        Returns:
+            dict[str, Any]: Result of the job, with status "done" or "failed", see `run_job()`
+        """
+        start_time = time.monotonic()
+        try:
+            rejected = [key for key in SERVER_OPTIONS if key in job]
+            if rejected:
+                raise RuntimeError(
+                    f"options only set by the server: {', '.join(rejected)}"
+                )
+            job = {**self.defaults, **job}
+            check_job(job)
+            media_info = None if job.get("dry") else self.get_media_info(job)
+        except Exception as e:
+            return {
+                "input": job.get("input"),
+                "output": job.get("output"),
+                "status": "failed",
+                "error": str(e),
+                "elapsed": round(time.monotonic() - start_time, 3),
+            }
+
+        return run_job(
+            {**job, "media_info": media_info, "progress_callback": progress_callback},
+            threads=self.threads,
+        )
+
+    def submit(
+        self,
+        job: dict[str, Any],
+        progress_callback: Callable[[Progress], None] | None = None,
+    ) -> concurrent.futures.Future:
+        """
+        Run a job on the worker pool, see `run()`.
+
+        Returns:
+            concurrent.futures.Future: Future of the result
+        """
+        return self.executor.submit(self.run, job, progress_callback)
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    """
+    Handles a connection: reads one job per line and writes the progress and
+    the result of each job as they happen, one message per line
+    """
+
+    server: Any
+
+    def handle(self):
+        write_lock = threading.Lock()
+
+        def send(message: dict[str, Any]):
+            with write_lock:
+                try:
+                    self.wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+                    self.wfile.flush()
+                except OSError:
+                    # the client went away, the jobs still finish
+                    pass
+
+        def run_job_message(job_id: Any, job: dict[str, Any]):
+            def send_progress(progress: Progress):
+                send(
+                    {
+                        "id": job_id,
+                        "event": "progress",
+                        **dataclasses.asdict(progress),
+                        "eta": progress.eta,
+                    }
+                )
+
+            result = self.server.job_server.run(job, send_progress)
+            send({"id": job_id, "event": "result", **result})
+
+        if self.server.token is not None and not self._authenticate():
+            send({"id": None, "event": "error", "error": "invalid token"})
+            return
+
+        futures = []
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise ValueError("a job must be a JSON object")
+            except ValueError as e:
+                send({"id": None, "event": "error", "error": f"invalid job: {e}"})
+                continue
+            job_id = job.pop("id", len(futures))
+            futures.append(
+                self.server.job_server.executor.submit(run_job_message, job_id, job)
+            )
+
+        # the client has sent all of its jobs, keep the connection until they are done
+        concurrent.futures.wait(futures)
+
+    def _authenticate(self) -> bool:
+        """
+        Check the token that the client sends before its jobs, as {"token": "..."}
+        """
+        try:
+            token = json.loads(self.rfile.readline()).get("token")
+        except (ValueError, AttributeError):
+            return False
+        return isinstance(token, str) and hmac.compare_digest(token, self.server.token)
+
+
+class _UnixJobServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPJobServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _is_tcp_address(address: str) -> bool:
+    """
+    Whether an address is a TCP port on localhost rather than the path of a Unix socket
+    """
+    return address.isdigit()
+
+
+def get_token_file(port: int) -> str:
+    """
+    Get the path of the file that holds the token of a server on a TCP port.
+
+    Args:
+        port (int): TCP port of the server
+
+    Returns:
+        str: Path in the cache directory of the user
+    """
+    return os.path.join(get_cache_dir("server"), f"{port}.token")
+
+
+def _write_token_file(token_file: str) -> str:
+    """
+    Generate a token for a server on a TCP port, and write it to a file that
+    only the user running the server can read
+    """
+    token = secrets.token_hex(16)
+    fd = os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # the file may be left behind with other permissions
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    return token
+
+
+def create_server(address: str, job_server: JobServer) -> socketserver.BaseServer:
+    """
+    Create a socket server that runs the jobs sent to it.
+
+    Clients send jobs as JSON objects, one per line, with the same keys as in a
+    batch manifest and an optional "id". For each job, the server sends
+    "progress" messages while it runs and a "result" message when it has
+    finished, one JSON object per line, each with the ID of the job. Jobs of one
+    connection run concurrently, and the connection is closed when the client
+    has closed its side and all of its jobs have finished.
+
+    Only the user running the server can send jobs. A Unix socket is only
+    accessible to that user. Any local user can connect to a TCP port, so the
+    server writes a random token to a file that only this user can read, see
+    `get_token_file()`, and clients send it as {"token": "..."} before their jobs.
+
+    Args:
+        address (str): Path of a Unix socket, or a TCP port, which is only bound on localhost;
+            port 0 picks a free port
+        job_server (JobServer): Server that runs the jobs
+
+    Returns:
+        socketserver.BaseServer: Socket server, see `serve_forever()`
+
+    Raises:
+        RuntimeError: Another server is listening on the Unix socket
+    """
+    token = None
+    token_file = None
+    if _is_tcp_address(address):
+        tcp_server = _TCPJobServer(("127.0.0.1", int(address)), _JobHandler)
+        token_file = get_token_file(tcp_server.server_address[1])
+        try:
+            token = _write_token_file(token_file)
+        except BaseException:
+            tcp_server.server_close()
+            raise
+        server: socketserver.BaseServer = tcp_server
+    else:
+        if os.path.exists(address):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe_socket:
+                try:
+                    probe_socket.connect(address)
+                except OSError:
+                    # left behind by a server that did not shut down
+                    os.remove(address)
+                else:
+                    raise RuntimeError(f"A server is already listening on {address}")
+        server = _UnixJobServer(address, _JobHandler, bind_and_activate=False)
+        try:
+            server.server_bind()
+            # only the user running the server may send jobs, before it listens
+            os.chmod(address, 0o600)
+            server.server_activate()
+        except BaseException:
+            server.server_close()
+            raise
+    server.job_server = job_server  # type: ignore[attr-defined]
+    server.token = token  # type: ignore[attr-defined]
+    server.token_file = token_file  # type: ignore[attr-defined]
+    return server
+
+
+def serve(
+    address: str,
+    max_workers: int | None = None,
+    cpu_budget: int | None = None,
+    defaults: dict[str, Any] | None = None,
+) -> None:
+    """
+    Run jobs sent to a socket until interrupted, see `create_server()`.
+
+    Args:
+        address (str): Path of a Unix socket, or a TCP port on localhost
+        max_workers (int | None, optional): Number of parallel jobs. Defaults to the CPU count.
+        cpu_budget (int | None, optional): Total number of CPUs to use. Defaults to the CPU count.
+        defaults (dict[str, Any] | None, optional): Options for jobs that do not set them. Defaults to None.
+    """
+    job_server = JobServer(max_workers, cpu_budget, defaults)
+    server = create_server(address, job_server)
+    logger.info(
+        f"serving on {address} with {job_server.max_workers} workers "
+        f"with {job_server.threads} threads each"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("shutting down")
+    finally:
+        server.server_close()
+        job_server.close()
+        # the token file of a TCP server, or the Unix socket
+        leftover_file = server.token_file or address  # type: ignore[attr-defined]
+        if os.path.exists(leftover_file):
+            os.remove(leftover_file)
+
+
+def submit_jobs(
+    address: str, jobs: list[dict[str, Any]], token: str | None = None
+) -> Iterator[dict[str, Any]]:
+    """
+    Send jobs to a server and get its messages as they arrive.
+
+    Args:
+        address (str): Path of the Unix socket, or the TCP port on localhost, of the server
+        jobs (list[dict[str, Any]]): Jobs, see `create_server()`
+        token (str | None, optional): Token of a server on a TCP port. Defaults to the
+            content of its token file, see `get_token_file()`.
+
+    Yields:
+        dict[str, Any]: Progress and result messages
+    """
+    messages = list(jobs)
+    if _is_tcp_address(address):
+        if token is None:
+            with open(get_token_file(int(address))) as f:
+                token = f.read().strip()
+        messages.insert(0, {"token": token})
+        client = socket.create_connection(("127.0.0.1", int(address)))
+    else:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(address)
+
+    with client, client.makefile("rb") as reader:
+        client.sendall(
+            b"".join(
+                json.dumps(message).encode("utf-8") + b"\n" for message in messages
+            )
+        )
+        client.shutdown(socket.SHUT_WR)
+        for line in reader:
+            yield json.loads(line)
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import bisect
+import itertools
+import json
+import logging
+import subprocess
+from typing import Any
+
+logger = logging.getLogger("bufferer")
+
+# encoder name -> codec name as reported by ffprobe, for encoders whose name
+# differs from the codec they produce
+ENCODER_CODECS = {
+    "libx264": "h264",
+    "h264_nvenc": "h264",
+    "h264_qsv": "h264",
+    "h264_videotoolbox": "h264",
+    "libx265": "hevc",
+    "hevc_nvenc": "hevc",
+    "hevc_qsv": "hevc",
+    "hevc_videotoolbox": "hevc",
+    "libvpx": "vp8",
+    "libvpx-vp9": "vp9",
+    "libaom-av1": "av1",
+    "libsvtav1": "av1",
+    "librav1e": "av1",
+}
+
+
+# profile as reported by ffprobe -> profile option of the encoder, for the
+# encoders whose output can be matched to the stream-copied parts of the input
+ENCODER_PROFILES = {
+    "libx264": {
+        "Constrained Baseline": "baseline",
+        "Baseline": "baseline",
+        "Main": "main",
+        "High": "high",
+        "High 10": "high10",
+        "High 4:2:2": "high422",
+        "High 4:4:4 Predictive": "high444",
+    },
+    "libx265": {
+        "Main": "main",
+        "Main 10": "main10",
+        "Main Still Picture": "mainstillpicture",
+    },
+}
+
+# bitstream filters that put the parameter sets in front of every keyframe, so that
+# the stream-copied and the re-encoded parts of a smart render each carry their own
+PARAMETER_SET_FILTERS = {"h264": "h264_mp4toannexb", "hevc": "hevc_mp4toannexb"}
+
+
+def get_codec_for_encoder(encoder: str) -> str:
+    """
+    Get the codec name that an encoder produces.
+
+    Args:
+        encoder (str): Encoder name, e.g. "libx264"
+
+    Returns:
+        str: Codec name, e.g. "h264"
+    """
+    return ENCODER_CODECS.get(encoder, encoder)
+
+
+def get_video_stream_info(ffprobe_path: str, input_file: str) -> dict[str, Any]:
+    """
+    Get the parameters of the first video stream that the re-encoded parts of a
+    smart render have to match.
+
+    Args:
+        ffprobe_path (str): Path to ffprobe executable
+        input_file (str): Input file
+
+    Returns:
+        dict[str, Any]: Stream info as reported by ffprobe, with the keys codec_name,
+            profile, level, pix_fmt, width, height, time_base and r_frame_rate,
+            or an empty dict if there is no video stream
+    """
+    cmd = [
+        ffprobe_path,
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "stream=codec_name,profile,level,pix_fmt,width,height,time_base,r_frame_rate",
+        "-of",
+        "json",
+        input_file,
+    ]
+    output = subprocess.check_output(cmd, stderr=subprocess.PIPE).decode("utf-8")
+    streams = json.loads(output).get("streams") or [{}]
+    return streams[0]
+
+
+def get_matching_encoder_options(
+    encoder: str, stream_info: dict[str, Any]
+) -> list[str] | None:
+    """
+    Get the encoder options that produce a stream that can be concatenated with
+    the stream-copied parts of the input, i.e. with the same profile, level and
+    pixel format, and with the parameter sets in front of every keyframe.
+
+    Args:
+        encoder (str): Encoder name, e.g. "libx264"
+        stream_info (dict[str, Any]): Video stream of the input, see `get_video_stream_info()`
+
+    Returns:
+        list[str] | None: Encoder options, or None if the encoder cannot match the stream
+    """
+    profile = ENCODER_PROFILES.get(encoder, {}).get(stream_info.get("profile", ""))
+    level = stream_info.get("level")
+    pix_fmt = stream_info.get("pix_fmt")
+    if profile is None or not level or level < 0 or not pix_fmt:
+        return None
+
+    options = ["-profile:v", profile]
+    if encoder == "libx264":
+        # ffprobe reports the level times 10, and level 1b as 9
+        options.extend(["-level:v", "1b" if level == 9 else f"{level / 10:.1f}"])
+    else:
+        # ffprobe reports the level times 30
+        options.extend(["-x265-params", f"level-idc={level / 30:g}"])
+    options.extend(
+        [
+            "-pix_fmt",
+            pix_fmt,
+            "-bsf:v",
+            PARAMETER_SET_FILTERS[get_codec_for_encoder(encoder)],
+        ]
+    )
+    return options
+
+
+def get_keyframe_times(ffprobe_path: str, input_file: str) -> list[float]:
+    """
+    Get the presentation times of all video keyframes, relative to the start of the file.
+
+    Args:
+        ffprobe_path (str): Path to ffprobe executable
+        input_file (str): Input file
+
+    Returns:
+        list[float]: Sorted keyframe times in seconds
+    """
+    cmd = [
+        ffprobe_path,
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts_time,flags:format=start_time",
+        "-of",
+        "csv=p=0",
+        input_file,
+    ]
+    output = subprocess.check_output(cmd, stderr=subprocess.PIPE).decode("utf-8")
+
+    lines = [line.strip() for line in output.splitlines() if line.strip()]
+    # the format section comes last and only contains the start time
+    start_time = 0.0
+    if lines and "," not in lines[-1]:
+        start_time_str = lines.pop()
+        if start_time_str != "N/A":
+            start_time = float(start_time_str)
+
+    keyframes = set()
+    for line in lines:
+        pts_time, flags = line.split(",", 1)
+        if "K" in flags and pts_time != "N/A":
+            keyframes.add(round(float(pts_time) - start_time, 6))
+
+    return sorted(keyframes)
+
+
+def plan_segments(
+    keyframes: list[float],
+    buflist: list[list],
+    duration: float,
+    frame_duration: float = 0.0,
+) -> list[tuple[float, float, list[list] | None]]:
+    """
+    Split the input into GOP-aligned segments, separating the GOPs that contain
+    buffering events (which need re-encoding) from those that can be copied.
+
+    The frozen frame of an event can be the last frame before it, so an event
+    within one frame after a keyframe also marks the GOP before it. Adjacent
+    GOPs that need re-encoding form one segment.
+
+    Args:
+        keyframes (list[float]): Sorted keyframe times in seconds
+        buflist (list[list]): Buffering events as [position, duration] in seconds
+        duration (float): Duration of the input in seconds
+        frame_duration (float, optional): Duration of one frame in seconds. Defaults to 0.0.
+
+    Returns:
+        list[tuple[float, float, list[list] | None]]: Segments as (start, end, events),
+            where events are relative to the segment start, or None if the segment
+            can be stream-copied
+    """
+    if not keyframes or keyframes[0] > 0:
+        keyframes = [0.0, *keyframes]
+    bounds = [*keyframes, duration]
+
+    dirty: set[int] = set()
+    event_gops = []
+    for buf_pos, _ in buflist:
+        gop = max(0, bisect.bisect_right(keyframes, buf_pos) - 1)
+        first_gop = max(0, bisect.bisect_right(keyframes, buf_pos - frame_duration) - 1)
+        dirty.update(range(first_gop, gop + 1))
+        event_gops.append(gop)
+
+    segments: list[tuple[float, float, list[list] | None]] = []
+    for is_dirty, run in itertools.groupby(
+        range(len(keyframes)), key=lambda gop: gop in dirty
+    ):
+        gops = list(run)
+        start, end = bounds[gops[0]], bounds[gops[-1] + 1]
+        if not is_dirty:
+            segments.append((start, end, None))
+            continue
+        events = [
+            [round(buf_pos - start, 6), buf_len]
+            for (buf_pos, buf_len), gop in zip(buflist, event_gops)
+            if gops[0] <= gop <= gops[-1]
+        ]
+        segments.append((start, end, events))
+
+    return segments
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+from fractions import Fraction
+
+from ._cache import get_cache_dir, get_file_key
+
+logger = logging.getLogger("bufferer")
+
+# longest loop of output frames that a spinner is cached as
+MAX_SPINNER_LOOP_FRAMES = 1000
+
+# spinners are rendered one at a time, so that concurrent jobs in one process
+# render each spinner only once
+_render_lock = threading.Lock()
+
+
+def _get_spinner_cycle(ffprobe_path: str, spinner: str) -> tuple[int, Fraction]:
+    """
+    Get the number of frames and the frame rate of one spinner cycle
+    """
+    output = subprocess.check_output(
+        [
+            ffprobe_path,
+            "-v",
+            "error",
+            "-count_frames",
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "stream=nb_read_frames,r_frame_rate",
+            "-of",
+            "json",
+            spinner,
+        ]
+    )
+    stream = json.loads(output)["streams"][0]
+    return int(stream["nb_read_frames"]), Fraction(stream["r_frame_rate"])
+
+
+def get_cached_spinner(
+    spinner: str,
+    speed: int,
+    fps: float,
+    ffmpeg_path: str = "ffmpeg",
+    ffprobe_path: str = "ffprobe",
+    cache_dir: str | None = None,
+    exact: bool = False,
+) -> str | None:
+    """
+    Get a pre-rendered version of the spinner, rendering it if it is not cached yet.
+
+    The spinner is rendered once per spinner file, speed and frame rate into a
+    loopable clip of uncompressed RGBA frames, which can be overlaid without
+    decoding, retiming or resampling the original animation. The clip is as long
+    as it takes for the animation to repeat on the output frames, up to
+    MAX_SPINNER_LOOP_FRAMES frames; longer loops are shortened to a whole number
+    of output frames per cycle, which shifts the animation slightly.
+
+    Args:
+        spinner (str): Path to the spinner animation
+        speed (int): Speed of the spinner
+        fps (float): Frame rate of the output video
+        ffmpeg_path (str, optional): Path to ffmpeg executable. Defaults to "ffmpeg".
+        ffprobe_path (str, optional): Path to ffprobe executable. Defaults to "ffprobe".
+        cache_dir (str | None, optional): Base cache directory. Defaults to ~/.cache/bufferer.
+        exact (bool, optional): Only return a clip that repeats exactly. Defaults to False.
+
+    Returns:
+        str | None: Path to the cached spinner clip, or None if exact is set and the
+            clip would be shortened
+    """
+    cache_key = hashlib.sha1(
+        f"{get_file_key(spinner)}:{speed}:{fps}".encode("utf-8")
+    ).hexdigest()
+    cache_file = os.path.join(get_cache_dir("spinner", cache_dir), f"{cache_key}.nut")
+    shortened_file = os.path.join(
+        get_cache_dir("spinner", cache_dir), f"{cache_key}.shortened.nut"
+    )
+    if os.path.isfile(cache_file):
+        return cache_file
+    if not exact and os.path.isfile(shortened_file):
+        return shortened_file
+
+    num_frames, frame_rate = _get_spinner_cycle(ffprobe_path, spinner)
+    # output frames per cycle of the animation, which repeats on the output frames
+    # after as many frames as its numerator
+    cycle_frames = (
+        num_frames * speed / frame_rate * Fraction(fps).limit_denominator(1001)
+    )
+    if cycle_frames.numerator > MAX_SPINNER_LOOP_FRAMES:
+        if exact:
+            return None
+        loop_frames = max(1, round(cycle_frames))
+        cache_file = shortened_file
+    else:
+        loop_frames = cycle_frames.numerator
+
+    with _render_lock:
+        if not os.path.isfile(cache_file):
+            _render_spinner(spinner, speed, fps, loop_frames, cache_file, ffmpeg_path)
+
+    return cache_file
+
+
+def _render_spinner(
+    spinner: str,
+    speed: int,
+    fps: float,
+    loop_frames: int,
+    cache_file: str,
+    ffmpeg_path: str,
+):
+    """
+    Render the loop of a spinner into the cache, see `get_cached_spinner()`
+    """
+    logger.debug(f"rendering spinner {spinner} to {cache_file}")
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp.nut"
+    cmd = [
+        ffmpeg_path,
+        "-nostdin",
+        "-y",
+        "-filter_complex",
+        f"movie=filename={spinner}:loop=0,setpts=N/(FRAME_RATE*TB)*{speed},fps=fps={fps},format=rgba[spinner]",
+        "-map",
+        "[spinner]",
+        "-frames:v",
+        str(loop_frames),
+        "-c:v",
+        "rawvideo",
+        tmp_file,
+    ]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = process.communicate()
+    if process.returncode != 0:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        raise RuntimeError(
+            f"running command: {' '.join(cmd)}: {stderr.decode('utf-8')}"
+        )
+    os.replace(tmp_file, cache_file)
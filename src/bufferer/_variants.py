@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import csv
+import json
+import logging
+import time
+from typing import Any
+
+from ._bufferer import Bufferer
+from ._probe import get_filter_thread_options
+from ._progress import TimingReport
+
+logger = logging.getLogger("bufferer")
+
+REQUIRED_VARIANT_KEYS = ("buflist", "output")
+
+
+def load_variants(variants_file: str) -> list[dict[str, Any]]:
+    """
+    Load a list of variants.
+
+    The file is either a JSON list of objects, or a CSV file with a header row,
+    with the keys "buflist" and "output" for each variant.
+
+    Args:
+        variants_file (str): Path to the variants file (.json or .csv)
+
+    Returns:
+        list[dict[str, Any]]: Variants
+
+    Raises:
+        RuntimeError: Variants file not properly formatted
+    """
+    with open(variants_file) as f:
+        if variants_file.lower().endswith(".csv"):
+            variants = list(csv.DictReader(f))
+        else:
+            variants = json.load(f)
+
+    if not isinstance(variants, list) or not variants:
+        raise RuntimeError("Variants file must contain a non-empty list of variants")
+
+    for index, variant in enumerate(variants):
+        missing_keys = [key for key in REQUIRED_VARIANT_KEYS if not variant.get(key)]
+        if missing_keys:
+            raise RuntimeError(
+                f"Variant {index} is missing keys: {', '.join(missing_keys)}"
+            )
+
+    return variants
+
+
+def _get_shared_input_window(bufferers: list[Bufferer]) -> list[str]:
+    """
+    Get the input window options that cover the input windows of all variants
+    """
+    window_options = [b.input_window_options for b in bufferers]
+    # the start position is a shared option, so it is the same for all variants
+    start_options = window_options[0][:2] if window_options[0][:1] == ["-ss"] else []
+
+    window_lengths = []
+    for options in window_options:
+        if "-t" not in options:
+            return start_options
+        window_lengths.append(float(options[options.index("-t") + 1]))
+    return [*start_options, "-t", str(max(window_lengths))]
+
+
+def get_variants_cmd(bufferers: list[Bufferer]) -> list[str]:
+    """
+    Get the command that renders all variants from a single decode of the input.
+
+    The decoded video and audio are split into one branch per variant, and each
+    branch gets the buffering events of its variant and is encoded to its own output.
+
+    Args:
+        bufferers (list[Bufferer]): Prepared Bufferer of each variant, for the same input
+
+    Returns:
+        list[str]: Command
+    """
+    first = bufferers[0]
+    cmd = [
+        first.ffmpeg_path,
+        "-nostdin",
+        *get_filter_thread_options(first.threads),
+        "-threads",
+        str(first.threads),
+        first.overwrite_spec,
+        *_get_shared_input_window(bufferers),
+        "-i",
+        first.input_file,
+    ]
+
+    for index, b in enumerate(bufferers):
+        b._label_prefix = f"v{index}_"
+
+    filters = []
+    video_bufferers = [b for b in bufferers if b.has_video]
+    if video_bufferers:
+        filters.append(
+            f"[0:v]split={len(video_bufferers)}"
+            + "".join(b._get_label("inv") for b in video_bufferers)
+        )
+    # with skipping, the audio is mapped from the input unchanged
+    audio_bufferers = [b for b in bufferers if b.has_audio and not b.skipping]
+    if audio_bufferers:
+        filters.append(
+            f"[0:a]asplit={len(audio_bufferers)}"
+            + "".join(b._get_label("ina") for b in audio_bufferers)
+        )
+
+    output_options = []
+    for b in bufferers:
+        variant_filters, variant_output_options = b._get_single_pass_output(
+            video_input=b._get_label("inv"), audio_input=b._get_label("ina")
+        )
+        filters.extend(variant_filters)
+        output_options.extend(variant_output_options)
+
+    cmd.extend(first._get_filter_options(filters))
+    cmd.extend(output_options)
+
+    return cmd
+
+
+def insert_buf_variants(
+    input_file: str, variants: list[dict[str, Any]], **options: Any
+) -> TimingReport:
+    """
+    Render several variants of the same input, each with its own buffering list
+    and output file, in a single ffmpeg run.
+
+    The input is probed and decoded only once, so that the decoding cost is paid
+    once instead of once per variant.
+
+    Args:
+        input_file (str): Input file
+        variants (list[dict[str, Any]]): Variants, each with the keys "buflist" and "output"
+        **options: Options shared by all variants, see `Bufferer`
+
+    Returns:
+        TimingReport: Wall time of the run
+
+    Raises:
+        RuntimeError: No variants given, unsupported options, or processing failed
+    """
+    if not variants:
+        raise RuntimeError("No variants given")
+    if options.get("video_engine", "filter") != "filter":
+        raise RuntimeError("Variants can only be rendered with the filter video engine")
+    if options.pop("smart_render", False):
+        logger.warning("Smart rendering is not supported for variants, disabling it")
+    # all variants are written by one ffmpeg run, without intermediate files
+    options["single_pass"] = True
+
+    bufferers: list[Bufferer] = []
+    for variant in variants:
+        if bufferers:
+            # probe only once
+            options["media_info"] = bufferers[0].media_info
+        b = Bufferer(
+            input_file=input_file,
+            output_file=variant["output"],
+            buflist=variant["buflist"],
+            **options,
+        )
+        if b._is_streaming_output():
+            raise RuntimeError(
+                f"Variants cannot be streamed, write them to files: {b.output_file}"
+            )
+        b._prepare_processing()
+        bufferers.append(b)
+
+    logger.info(f"rendering {len(bufferers)} variants from a single decode")
+
+    first = bufferers[0]
+    start_time = time.monotonic()
+    if first._uses_mezzanine() and not first.dry:
+        first.use_mezzanine()
+        for b in bufferers[1:]:
+            b.input_file = first.input_file
+    first.run_command(get_variants_cmd(bufferers), stage="variants")
+    first.timing_report.wall_time = round(time.monotonic() - start_time, 3)
+
+    return first.timing_report
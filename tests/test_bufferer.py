@@ -1,8 +1,18 @@
 #!/usr/bin/env python3
 
+import asyncio
+import io
+import json
 import os
+import socket
+import stat
 import subprocess
+import sys
 import tempfile
+import threading
+from typing import Any
+
+import pytest
 
 import bufferer
 
@@ -51,3 +61,1202 @@ class TestBufferer:
             # Check that output exists and is a valid video
             assert os.path.isfile(output_video)
             assert os.path.getsize(output_video) > 0
+
+    def test_single_pass_command(self, monkeypatch):
+        """Test that single-pass mode runs one command without intermediate files."""
+        b = bufferer.Bufferer(
+            input_file="input.mp4",
+            output_file="output.mkv",
+            buflist="[[0, 1], [3, 2]]",
+            dry=True,
+            single_pass=True,
+        )
+        cmds = []
+        monkeypatch.setattr(b, "run_command", lambda cmd, **kwargs: cmds.append(cmd))
+
+        b.insert_buf_audiovisual()
+
+        assert len(cmds) == 1
+        cmd = cmds[0]
+        assert cmd[-1] == "output.mkv"
+        assert not any(c.endswith(".nut") for c in cmd)
+        assert cmd.count("-map") == 2
+
+    def test_smart_render_segments(self):
+        """Test that only GOPs with buffering events are marked for re-encoding."""
+        from bufferer._smart import plan_segments
+
+        segments = plan_segments([0.0, 2.0, 4.0, 6.0, 8.0], [[0, 1], [5, 2]], 10.0)
+
+        assert segments == [
+            (0.0, 2.0, [[0, 1]]),
+            (2.0, 4.0, None),
+            (4.0, 6.0, [[1.0, 2]]),
+            (6.0, 10.0, None),
+        ]
+
+        # the frozen frame of an event on a keyframe can be the last frame before it
+        segments = plan_segments([0.0, 2.0, 4.0], [[2.0, 1]], 6.0, frame_duration=0.04)
+
+        assert segments == [(0.0, 4.0, [[2.0, 1]]), (4.0, 6.0, None)]
+
+    def test_smart_render(self):
+        """Test that smart rendering gives the frames and timestamps of a full render."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_video = os.path.join(tmpdir, "input.mp4")
+            subprocess.check_output(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-f",
+                    "lavfi",
+                    "-i",
+                    "testsrc=duration=6:size=320x240:rate=25,format=pix_fmts=yuv420p",
+                    "-c:v",
+                    "libx264",
+                    "-g",
+                    "25",
+                    input_video,
+                ],
+                stderr=subprocess.DEVNULL,
+            )
+
+            outputs = {}
+            for smart_render in [False, True]:
+                output_video = os.path.join(tmpdir, f"output_{smart_render}.mkv")
+                b = bufferer.Bufferer(
+                    input_file=input_video,
+                    output_file=output_video,
+                    buflist="[[1, 1], [3, 0.5]]",
+                    disable_spinner=True,
+                    force_overwrite=True,
+                    vcodec="libx264",
+                    smart_render=smart_render,
+                )
+                b.insert_buf_audiovisual()
+                if smart_render:
+                    assert any(t.stage == "smart_split" for t in b.timing_report.stages)
+
+                output = subprocess.check_output(
+                    [
+                        "ffprobe",
+                        "-v",
+                        "error",
+                        "-select_streams",
+                        "v:0",
+                        "-show_entries",
+                        "frame=pts_time:format=duration",
+                        "-of",
+                        "json",
+                        output_video,
+                    ]
+                )
+                outputs[smart_render] = json.loads(output)
+
+        full, smart = outputs[False], outputs[True]
+        pts = [float(frame["pts_time"]) for frame in smart["frames"]]
+        assert len(pts) == len(full["frames"]) == 187
+        assert float(smart["format"]["duration"]) == pytest.approx(
+            float(full["format"]["duration"]), abs=0.001
+        )
+        assert all(
+            b - a == pytest.approx(0.04, abs=0.001) for a, b in zip(pts, pts[1:])
+        )
+
+    def test_load_batch_manifest(self):
+        """Test that CSV manifest values are converted to the Bufferer option types."""
+        from bufferer._batch import load_manifest
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifest = os.path.join(tmpdir, "manifest.csv")
+            with open(manifest, "w") as f:
+                f.write("input,buflist,output,speed,skipping,vcodec,trim\n")
+                f.write('in.mp4,"[[0, 1]]",out.avi,3,true,libx264,\n')
+
+            jobs = load_manifest(manifest)
+
+        assert jobs == [
+            {
+                "input": "in.mp4",
+                "buflist": "[[0, 1]]",
+                "output": "out.avi",
+                "speed": 3,
+                "skipping": True,
+                "vcodec": "libx264",
+            }
+        ]
+
+        # options that are not scalars cannot be set from a manifest
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifest = os.path.join(tmpdir, "manifest.csv")
+            with open(manifest, "w") as f:
+                f.write("input,buflist,output,media_info\n")
+                f.write('in.mp4,"[[0, 1]]",out.avi,info\n')
+
+            with pytest.raises(RuntimeError, match="media_info"):
+                load_manifest(manifest)
+
+    def test_media_info_from_ffprobe(self):
+        """Test that ffprobe JSON output is parsed into a MediaInfo object."""
+        info = bufferer.MediaInfo.from_ffprobe(
+            {
+                "streams": [
+                    {
+                        "codec_type": "video",
+                        "codec_name": "mjpeg",
+                        "disposition": {"attached_pic": 1},
+                    },
+                    {
+                        "codec_type": "video",
+                        "codec_name": "h264",
+                        "width": 640,
+                        "height": 480,
+                        "pix_fmt": "yuv420p",
+                        "r_frame_rate": "60/1",
+                        "avg_frame_rate": "30000/1001",
+                    },
+                    {
+                        "codec_type": "audio",
+                        "codec_name": "aac",
+                        "sample_rate": "48000",
+                        "channels": 2,
+                        "channel_layout": "stereo",
+                    },
+                ],
+                "format": {"duration": "13.000000"},
+            }
+        )
+
+        assert info.has_video and info.has_audio
+        assert info.video_codec == "h264"
+        assert info.video_resolution == "640x480"
+        assert info.fps is not None
+        assert round(info.fps, 3) == 29.97
+        assert info.sample_rate == 48000
+        assert info.duration == 13.0
+
+    def test_progress_parser(self):
+        """Test that ffmpeg -progress blocks are parsed into Progress reports."""
+        parser = bufferer._progress.ProgressParser("video", duration=10.0)
+        lines = [
+            "frame=150",
+            "fps=75.00",
+            "stream_0_0_q=28.0",
+            "out_time_us=5000000",
+            "out_time=00:00:05.000000",
+            "speed=2.5x",
+        ]
+        assert all(parser.feed(line) is None for line in lines)
+        assert not parser.is_progress_line("Stream #0:0: Video: h264")
+
+        progress = parser.feed("progress=continue")
+        assert progress is not None
+        assert progress.stage == "video"
+        assert progress.frame == 150
+        assert progress.out_time == 5.0
+        assert progress.eta == 2.0
+        assert not progress.finished
+        progress = parser.feed("progress=end")
+        assert progress is not None and progress.finished
+
+    def test_async_commands(self, monkeypatch):
+        """Test that the async API runs the same commands as the blocking one."""
+        options: dict[str, Any] = {"dry": True, "disable_spinner": True}
+        buflist = [[1, 2], [5, 1]]
+
+        sync_cmds = []
+        b = bufferer.Bufferer("input.mp4", "output.mkv", buflist, **options)
+        monkeypatch.setattr(
+            b, "run_command", lambda cmd, **kwargs: sync_cmds.append(cmd)
+        )
+        b.insert_buf_audiovisual()
+
+        async_cmds = []
+
+        async def run_command_async(cmd, **kwargs):
+            async_cmds.append(cmd)
+
+        b = asyncio.run(
+            bufferer.Bufferer.create("input.mp4", "output.mkv", buflist, **options)
+        )
+        monkeypatch.setattr(b, "run_command_async", run_command_async)
+        report = asyncio.run(b.insert_buf_audiovisual_async())
+
+        assert len(sync_cmds) == 3
+        assert async_cmds == sync_cmds
+        assert report.wall_time >= 0
+
+    def test_wait_for_process(self):
+        """Test that the resource usage of a finished process is reported."""
+        process = subprocess.Popen(
+            [sys.executable, "-c", "import sys; sys.exit(3)"], stderr=subprocess.PIPE
+        )
+        assert process.stderr is not None
+        process.stderr.read()
+        cpu_time, max_rss = bufferer._progress.wait_for_process(process)
+
+        assert process.returncode == 3
+        if hasattr(os, "wait4"):
+            assert cpu_time is not None and cpu_time >= 0
+            assert max_rss is not None and max_rss > 0
+
+    def test_concurrent_passes(self, monkeypatch):
+        """Test that video and audio share the threads and failures are raised."""
+        b = bufferer.Bufferer(
+            "input.mp4",
+            "output.mkv",
+            buflist=[[1, 2]],
+            dry=True,
+            disable_spinner=True,
+            threads=4,
+        )
+        cmds = []
+
+        def run_command(cmd, stage=None, **kwargs):
+            cmds.append((stage, cmd))
+            if stage == "audio":
+                raise RuntimeError("audio failed")
+
+        monkeypatch.setattr(b, "run_command", run_command)
+        with pytest.raises(RuntimeError, match="audio failed"):
+            b.insert_buf_audiovisual()
+
+        stages = dict(cmds)
+        assert set(stages) == {"video", "audio"}
+        assert stages["video"][stages["video"].index("-threads") + 1] == "3"
+        assert stages["audio"][stages["audio"].index("-threads") + 1] == "1"
+        # the threads limit the filters and the encoder as well as the decoder
+        video_cmd = stages["video"]
+        assert video_cmd[video_cmd.index("-filter_complex_threads") + 1] == "3"
+        assert video_cmd[-3:] == ["-threads", "3", "output.mkv_video.nut"]
+
+        # with the default single thread, the passes run one after the other
+        b.threads = 1
+        assert not b._can_run_passes_concurrently()
+
+    def test_audio_splice_engine(self):
+        """Test that the splice engine cuts the audio once per event position."""
+        b = bufferer.Bufferer(
+            "input.mp4",
+            "output.mkv",
+            buflist=[[0, 1], [2, 0.5], [2, 0.5], [5, 1]],
+            dry=True,
+            audio_engine="splice",
+        )
+        b._generate_loop_cmds()
+        filters = b._get_audio_filters()
+
+        assert filters[0] == "[0:a]asegment=samples=96000|240000[aseg0][aseg1][aseg2]"
+        assert filters.count("anullsrc=r=48000:cl=stereo,atrim=end_sample=48000[asil1]")
+        assert filters[-1] == (
+            "[asil0][aseg0][asil1][aseg1][asil2][aseg2]"
+            "concat=n=6:v=0:a=1,asetpts=N/SR/TB[outa]"
+        )
+
+    def test_raw_engine_frames(self):
+        """Test that the raw engine repeats frozen frames at frame-exact positions."""
+        from fractions import Fraction
+
+        from bufferer._raw import StallRenderer, get_stall_frames, render_video
+
+        # 0.7 * 30 is 20.999... in floating point
+        assert get_stall_frames([[0.7, 0.1], [0, 1]], Fraction(30)) == [
+            (0, 30),
+            (21, 3),
+        ]
+
+        width, height = 4, 2
+        frame_size = width * height * 3
+        frames = b"".join(bytes([index]) * frame_size for index in range(5))
+
+        for skipping, expected in [
+            (False, [0, 1, 1, 1, 2, 3, 4]),
+            (True, [0, 1, 1, 3, 4]),
+        ]:
+            output = io.BytesIO()
+            num_frames = render_video(
+                io.BytesIO(frames),
+                output,
+                width,
+                height,
+                [(1, 2)],
+                StallRenderer(width, height),
+                skipping=skipping,
+            )
+            data = output.getvalue()
+            assert num_frames == len(expected)
+            assert [data[index * frame_size] for index in range(num_frames)] == expected
+
+        class MarkingRenderer(StallRenderer):
+            def iter_frames(self, frozen_frame, num_frames, first_index):
+                for index in range(first_index, first_index + num_frames):
+                    yield bytes([100 + index]) * frame_size
+
+        # the stall frames carry the effects with and without skipping
+        for skipping, expected in [
+            (False, [0, 101, 102, 1, 2, 3, 4]),
+            (True, [0, 101, 102, 3, 4]),
+        ]:
+            output = io.BytesIO()
+            render_video(
+                io.BytesIO(frames),
+                output,
+                width,
+                height,
+                [(1, 2)],
+                MarkingRenderer(width, height),
+                skipping=skipping,
+            )
+            data = output.getvalue()
+            assert data[::frame_size] == bytes(expected)
+
+    def test_raw_engine_skipping(self):
+        """Test that the raw engine draws the stall effects where the filter engine does."""
+        pytest.importorskip("numpy")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_video = os.path.join(tmpdir, "input.mp4")
+            subprocess.check_output(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-f",
+                    "lavfi",
+                    "-i",
+                    "testsrc=duration=5:size=160x120:rate=25",
+                    "-c:v",
+                    "libx264",
+                    input_video,
+                ],
+                stderr=subprocess.DEVNULL,
+            )
+
+            changed_frames = {}
+            for video_engine in ["filter", "raw"]:
+                checksums = []
+                for disable_spinner in [False, True]:
+                    output_video = os.path.join(tmpdir, f"output_{disable_spinner}.mkv")
+                    bufferer.Bufferer(
+                        input_file=input_video,
+                        output_file=output_video,
+                        buflist=[[1, 1], [3, 0.5]],
+                        skipping=True,
+                        disable_spinner=disable_spinner,
+                        force_overwrite=True,
+                        vcodec="ffv1",
+                        video_engine=video_engine,
+                    ).insert_buf_audiovisual()
+                    output = subprocess.check_output(
+                        [
+                            "ffmpeg",
+                            "-v",
+                            "error",
+                            "-i",
+                            output_video,
+                            "-f",
+                            "framemd5",
+                            "-",
+                        ]
+                    ).decode("utf-8")
+                    checksums.append(
+                        [
+                            line.split(",")[-1]
+                            for line in output.splitlines()
+                            if not line.startswith("#")
+                        ]
+                    )
+                with_spinner, without_spinner = checksums
+                assert len(with_spinner) == len(without_spinner) == 125
+                changed_frames[video_engine] = [
+                    index
+                    for index, (a, b) in enumerate(zip(with_spinner, without_spinner))
+                    if a != b
+                ]
+
+        assert changed_frames["filter"] == [*range(25, 50), *range(75, 87)]
+        assert changed_frames["raw"] == changed_frames["filter"]
+
+    def test_intermediate_files(self, monkeypatch):
+        """Test that intermediates go to the scratch directory with their own codec."""
+        b = bufferer.Bufferer(
+            "input.mp4",
+            "out/output.mkv",
+            buflist=[[1, 2]],
+            dry=True,
+            disable_spinner=True,
+            vcodec="libx264",
+            tmp_dir="/dev/shm",
+            intermediate_codec="ffv1",
+        )
+        cmds = []
+        monkeypatch.setattr(b, "run_command", lambda cmd, **kwargs: cmds.append(cmd))
+        b.insert_buf_audiovisual()
+        video_cmd, _, merge_cmd = cmds
+
+        assert video_cmd[-1].startswith("/dev/shm/output.mkv.")
+        assert video_cmd[video_cmd.index("-c:v") + 1] == "ffv1"
+        assert video_cmd[video_cmd.index("-slices") + 1] == "16"
+        assert merge_cmd[merge_cmd.index("-c:v") + 1] == "libx264"
+        assert merge_cmd[-1] == "out/output.mkv"
+
+        # 12 s of 1080p yuv420p at 30 fps, half of it for ffv1, plus 16 bit stereo PCM
+        assert b._estimate_tmp_bytes() == int(
+            1920 * 1080 * 1.5 * 12 * 30 * 0.5 + 48000 * 2 * 2 * 12
+        )
+
+    def test_buflist_compiler(self):
+        """Test that buffering lists are parsed, sorted, merged and validated."""
+        from fractions import Fraction
+
+        from bufferer._buflist import EventTable, normalize_buflist, parse_buflist
+
+        class FakeArray:
+            def tolist(self):
+                return [[5, 1], [0.7, 0.5]]
+
+        assert parse_buflist("position,duration\n5,1\n0.7,0.5\n") == [
+            [5, 1],
+            [0.7, 0.5],
+        ]
+        assert parse_buflist(FakeArray()) == [[5, 1], [0.7, 0.5]]
+        assert parse_buflist("[0, 1], [5, 10]") == [[0, 1], [5, 10]]
+        with pytest.raises(RuntimeError, match="not properly formatted"):
+            parse_buflist("[0, 1")
+
+        # events at 0.7 s and 0.71 s freeze the same frame at 30 fps
+        buflist = normalize_buflist(
+            [[5, 1], [0.71, 0.25], [2, 0], [0.7, 0.5]], Fraction(30), duration=10
+        )
+        assert buflist == [[0.7, 0.75], [5, 1]]
+        with pytest.raises(RuntimeError, match="after the end of the input"):
+            normalize_buflist([[11, 1]], Fraction(30), duration=10)
+
+        events = EventTable.compile(buflist, Fraction(30), 48000)
+        assert list(events.frame_positions) == [21, 150]
+        assert list(events.frame_lengths) == [22, 30]
+        assert list(events.sample_positions) == [33600, 240000]
+        assert list(events.sample_lengths) == [36000, 48000]
+
+        # only zero-length events leave nothing to insert, the input passes through
+        b = bufferer.Bufferer("input.mp4", "output.mkv", buflist=[[5, 0]], dry=True)
+        assert b.buflist == []
+        b._prepare_processing()
+        assert b._get_video_filters()[0] == "[0:v]null[stallvid2]"
+        assert b._get_audio_filters() == ["[0:a]anull,volume=0:enable='0'[outa]"]
+
+    def test_variants(self):
+        """Test that all variants are rendered from a single decode."""
+        from bufferer._variants import get_variants_cmd
+
+        bufferers = []
+        for index, buflist in enumerate([[[0, 1]], [[2, 1], [5, 0.5]]]):
+            b = bufferer.Bufferer(
+                "input.mp4",
+                f"out{index}.mkv",
+                buflist=buflist,
+                dry=True,
+                disable_spinner=True,
+                trim=str(3 + index),
+            )
+            b._prepare_processing()
+            bufferers.append(b)
+
+        cmd = get_variants_cmd(bufferers)
+        filters = cmd[cmd.index("-filter_complex") + 1].split(";")
+
+        assert cmd.count("-i") == 1
+        assert cmd[cmd.index("-i") - 2 : cmd.index("-i")] == ["-t", "3.033333"]
+        assert filters[:2] == [
+            "[0:v]split=2[v0_inv][v1_inv]",
+            "[0:a]asplit=2[v0_ina][v1_ina]",
+        ]
+        assert filters[2].startswith("[v0_inv]loop=loop=30:size=1:start=0,")
+        assert filters[4].startswith("[v1_inv]loop=loop=30:size=1:start=60,")
+        assert cmd.count("-map") == 4
+        assert cmd[-1] == "out1.mkv"
+        assert cmd[cmd.index("out0.mkv") + 1 :][:4] == [
+            "-map",
+            "[v1_outv]",
+            "-map",
+            "[v1_outa]",
+        ]
+
+        report = bufferer.insert_buf_variants(
+            "input.mp4",
+            [{"buflist": [[0, 1]], "output": "out0.mkv"}],
+            dry=True,
+        )
+        assert report.stages == []
+
+    def test_spinner_cache(self, monkeypatch):
+        """Test that the cached spinner is reused and gives the same output."""
+        import bufferer._spinner
+
+        spinner = os.path.join(
+            os.path.dirname(__file__), "..", "spinners", "spinner-64-white.png"
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_video = os.path.join(tmpdir, "input.mp4")
+            subprocess.check_output(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-f",
+                    "lavfi",
+                    "-i",
+                    "testsrc=duration=2:size=320x240:rate=10,format=pix_fmts=yuv420p",
+                    "-c:v",
+                    "libx264",
+                    "-preset",
+                    "ultrafast",
+                    input_video,
+                ],
+                stderr=subprocess.DEVNULL,
+            )
+            cache_dir = os.path.join(tmpdir, "cache")
+
+            def render(output_video, spinner_cache):
+                b = bufferer.Bufferer(
+                    input_file=input_video,
+                    output_file=output_video,
+                    buflist="[[0.5, 1]]",
+                    spinner=spinner,
+                    spinner_cache=spinner_cache,
+                    cache_dir=cache_dir,
+                    force_overwrite=True,
+                )
+                b.insert_buf_audiovisual()
+                return subprocess.check_output(
+                    ["ffmpeg", "-v", "error", "-i", output_video, "-f", "framemd5", "-"]
+                )
+
+            cached = render(os.path.join(tmpdir, "cached.mkv"), True)
+            spinner_files = os.listdir(os.path.join(cache_dir, "spinner"))
+            assert len(spinner_files) == 1
+
+            def render_spinner(*args, **kwargs):
+                raise AssertionError("the spinner was rendered again")
+
+            monkeypatch.setattr(bufferer._spinner, "_render_spinner", render_spinner)
+            reused = render(os.path.join(tmpdir, "reused.mkv"), True)
+            assert os.listdir(os.path.join(cache_dir, "spinner")) == spinner_files
+
+            uncached = render(os.path.join(tmpdir, "uncached.mkv"), False)
+
+        assert reused == cached
+        assert cached == uncached
+
+    def test_mezzanine_cache(self):
+        """Test that mezzanines are keyed by content and evicted by least recent use."""
+        from bufferer._cache import evict_lru
+        from bufferer._mezzanine import get_mezzanine_cmd, get_mezzanine_file
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_file = os.path.join(tmpdir, "input.mp4")
+            copied_file = os.path.join(tmpdir, "copy.mp4")
+            for path in (input_file, copied_file):
+                with open(path, "wb") as f:
+                    f.write(b"source")
+
+            mezzanine_file = get_mezzanine_file(input_file, "yuv420p", tmpdir)
+            assert mezzanine_file == get_mezzanine_file(copied_file, "yuv420p", tmpdir)
+            assert mezzanine_file != get_mezzanine_file(input_file, "yuv422p", tmpdir)
+            cmd = get_mezzanine_cmd(input_file, mezzanine_file, "yuv420p")
+            assert cmd[cmd.index("-g") + 1] == "1"
+
+            cache_dir = os.path.dirname(mezzanine_file)
+            for index in range(3):
+                path = os.path.join(cache_dir, f"{index}.mkv")
+                with open(path, "wb") as f:
+                    f.write(b"x" * 10)
+                os.utime(path, (index, index))
+            removed = evict_lru(cache_dir, 20, keep=os.path.join(cache_dir, "0.mkv"))
+            assert [os.path.basename(path) for path in removed] == ["1.mkv"]
+
+            b = bufferer.Bufferer(
+                input_file,
+                os.path.join(tmpdir, "output.mkv"),
+                buflist=[[0, 1]],
+                media_info=bufferer.MediaInfo(
+                    has_video=True,
+                    has_audio=False,
+                    duration=10.0,
+                    frame_rate="30/1",
+                    width=1920,
+                    height=1080,
+                ),
+                mezzanine_cache=True,
+                cache_dir=tmpdir,
+                single_pass=True,
+            )
+            b._prepare_processing()
+            steps = b._iter_processing_steps([])
+            assert [stage for stage, _, _ in next(steps)] == ["mezzanine"]
+
+            # the mezzanine only holds inputs with video
+            b.has_video = False
+            steps = b._iter_processing_steps([])
+            assert [stage for stage, _, _ in next(steps)] == ["single_pass"]
+
+    def test_job_queue(self):
+        """Test that queued jobs are claimed once, resumed after expiry and recorded."""
+        from bufferer._queue import (
+            JobQueue,
+            get_partial_output,
+            run_queued_job,
+            run_worker,
+        )
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            queue_path = os.path.join(tmpdir, "jobs.db")
+            jobs = [
+                {
+                    "input": "input.mp4",
+                    "buflist": "[[0, 1]]",
+                    "output": f"out{index}.mkv",
+                }
+                for index in range(3)
+            ]
+            queue = JobQueue(queue_path)
+            assert queue.add(jobs) == 3
+            assert queue.add(jobs) == 0
+
+            # a worker that stopped renewing its lease loses the job
+            claimed = queue.claim("worker1", lease=-1)
+            assert claimed is not None
+            job_id, job, expired = claimed
+            assert job["output"] == os.path.abspath("out0.mkv")
+            assert not expired
+            claimed = queue.claim("worker2")
+            assert claimed is not None
+            assert claimed[0] == job_id
+            assert claimed[2]
+            assert not queue.finish(
+                job_id, "worker1", {"status": "done", "error": None}
+            )
+            assert queue.finish(
+                job_id, "worker2", {"status": "failed", "error": "boom"}
+            )
+            assert queue.get_counts() == {
+                "pending": 2,
+                "running": 0,
+                "done": 0,
+                "failed": 1,
+            }
+
+            assert run_worker(queue_path, defaults={"dry": True}) == {
+                "done": 2,
+                "failed": 0,
+            }
+            assert queue.retry_failed() == 1
+            assert queue.get_counts()["pending"] == 1
+            queue.close()
+
+        assert get_partial_output("/out/video.mkv", "1") == "/out/.video.1.partial.mkv"
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # a worker died after renaming its output into place, leaving the
+            # partial output of an even earlier attempt behind
+            output_file = os.path.join(tmpdir, "out.mkv")
+            stale_output = get_partial_output(output_file, "7-123")
+            for path in (output_file, stale_output):
+                with open(path, "wb") as f:
+                    f.write(b"output")
+            job = {"input": "input.mp4", "buflist": "[[0, 1]]", "output": output_file}
+
+            result = run_queued_job(job, 7, expired=True)
+            assert result["status"] == "done"
+            assert not os.path.exists(stale_output)
+            assert run_queued_job(job, 7)["status"] == "failed"
+
+    def test_result_cache(self):
+        """Test that identical renders are restored from the result cache."""
+        from bufferer._result_cache import get_result_key
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_file = os.path.join(tmpdir, "input.mp4")
+            with open(input_file, "wb") as f:
+                f.write(b"source")
+
+            def create_bufferer(output_file, buflist, **kwargs):
+                options: dict[str, Any] = {"disable_spinner": True, **kwargs}
+                return bufferer.Bufferer(
+                    input_file,
+                    os.path.join(tmpdir, output_file),
+                    buflist=buflist,
+                    media_info=bufferer.MediaInfo(
+                        has_video=True,
+                        has_audio=False,
+                        duration=10.0,
+                        frame_rate="30/1",
+                        width=1920,
+                        height=1080,
+                    ),
+                    single_pass=True,
+                    force_overwrite=True,
+                    result_cache=True,
+                    cache_dir=tmpdir,
+                    ffmpeg_path=sys.executable,
+                    **options,
+                )
+
+            b = create_bufferer("out1.mkv", [[1, 1]])
+            b._prepare_processing()
+            steps = b._iter_processing_steps([])
+            [(stage, restore, _)] = next(steps)
+            assert stage == "result_cache"
+            restore()
+            [(stage, cmd, _)] = next(steps)
+            assert stage == "single_pass"
+            assert "+bitexact" in cmd
+            with open(b.output_file, "wb") as f:
+                f.write(b"rendered")
+            [(_, store, _)] = next(steps)
+            store()
+
+            # the same render to another output is restored without running ffmpeg
+            b = create_bufferer("out2.mkv", [[1, 1]])
+            b._prepare_processing()
+            steps = b._iter_processing_steps([])
+            next(steps)[0][1]()
+            assert list(steps) == []
+            assert os.path.samefile(b.output_file, os.path.join(tmpdir, "out1.mkv"))
+
+            b = create_bufferer("out3.mkv", [[2, 1]])
+            b._prepare_processing()
+            steps = b._iter_processing_steps([])
+            next(steps)[0][1]()
+            assert next(steps)[0][0] == "single_pass"
+
+            # skipping still draws the spinner, so another spinner is another result
+            keys = [
+                get_result_key(
+                    create_bufferer(
+                        "out4.mkv",
+                        [[1, 1]],
+                        disable_spinner=False,
+                        skipping=True,
+                        spinner=f"spinners/{spinner}.png",
+                    )._get_result_parameters()
+                )
+                for spinner in ["spinner-256-white", "spinner-64-black"]
+            ]
+            assert keys[0] != keys[1]
+
+    def test_filter_script(self):
+        """Test that large filter graphs are passed in a script file."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+
+            def create_bufferer(buflist):
+                b = bufferer.Bufferer(
+                    os.path.join(tmpdir, "input.mp4"),
+                    os.path.join(tmpdir, "output.mp4"),
+                    buflist=buflist,
+                    media_info=bufferer.MediaInfo(
+                        has_video=True,
+                        has_audio=True,
+                        duration=600.0,
+                        frame_rate="30/1",
+                        width=1920,
+                        height=1080,
+                        sample_rate=48000,
+                    ),
+                    single_pass=True,
+                    tmp_dir=tmpdir,
+                    ffmpeg_path=sys.executable,
+                )
+                b._prepare_processing()
+                return b
+
+            b = create_bufferer([[1, 1], [5, 1]])
+            cmd = b._get_single_pass_cmd()
+            graph = cmd[cmd.index("-filter_complex") + 1]
+            assert "between(t,1.0,1.999)" in graph
+            assert "sendcmd" not in graph
+
+            b = create_bufferer([[pos, 0.5] for pos in range(500)])
+            cmd = b._get_single_pass_cmd()
+            assert "-filter_complex" not in cmd
+            script_file = cmd[cmd.index("-filter_complex_script") + 1]
+            with open(script_file) as f:
+                graph = f.read()
+            # the effects are switched per event instead of testing every event per frame
+            assert "between(" not in graph
+            assert "sendcmd=c='0.0-0.499 [enter] overlay@stall enable 1" in graph
+            assert "asendcmd=c='0.0-0.5 [enter] volume@stall enable 1" in graph
+
+            b.run_command([sys.executable, "-c", "", script_file])
+            assert not os.path.exists(script_file)
+
+    def test_plan(self):
+        """Test the execution plan and its calibration from timing reports."""
+        b = bufferer.Bufferer(
+            "input.mp4",
+            "output.mkv",
+            buflist=[[1, 2]],
+            media_info=bufferer.MediaInfo(
+                has_video=True,
+                has_audio=True,
+                duration=10.0,
+                frame_rate="30/1",
+                width=1920,
+                height=1080,
+                sample_rate=48000,
+                channels=2,
+            ),
+            disable_spinner=True,
+            threads=2,
+        )
+        plan = bufferer.get_plan(b)
+        assert [(stage["stage"], stage["group"]) for stage in plan["stages"]] == [
+            ("video", 0),
+            ("audio", 0),
+            ("merge", 1),
+        ]
+        video, audio, merge = plan["stages"]
+        assert video["command"][0] == "ffmpeg"
+        assert (video["decoded_frames"], video["frames"]) == (300, 360)
+        assert (audio["decoded_samples"], audio["samples"]) == (480000, 576000)
+        assert plan["output_duration"] == 12.0
+        assert plan["tmp_bytes"] == b._estimate_tmp_bytes()
+        # the video and audio stages run concurrently
+        assert plan["wall_time"] == round(video["wall_time"] + merge["wall_time"], 3)
+        assert plan["max_rss"] == video["max_rss"] + audio["max_rss"]
+        assert not video["calibrated"]
+
+        report = bufferer.TimingReport(
+            stages=[
+                bufferer.StageTiming(
+                    "video",
+                    10.0,
+                    max_rss=164 * 1024 * 1024,
+                    work=b._get_stage_work("video"),
+                )
+            ]
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            report_file = os.path.join(tmpdir, "report.json")
+            with open(report_file, "w") as f:
+                json.dump([{"status": "done", "timings": report.to_dict()}], f)
+            cost_model = bufferer.CostModel.from_reports(
+                bufferer.load_timing_reports(report_file)
+            )
+        plan = bufferer.get_plan(b, cost_model)
+        assert plan["stages"][0]["calibrated"]
+        assert plan["stages"][0]["wall_time"] == 10.0
+        assert plan["stages"][0]["max_rss"] == 164 * 1024 * 1024
+        # planning does not write any files
+        assert not os.path.exists("output.mkv_video.nut")
+
+    def test_serve(self):
+        """Test that a server runs the jobs sent to its socket."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            address = os.path.join(tmpdir, "bufferer.sock")
+            job_server = bufferer.JobServer(max_workers=2)
+            server = bufferer._server.create_server(address, job_server)
+            assert stat.S_IMODE(os.stat(address).st_mode) == 0o600
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            try:
+                messages = list(
+                    bufferer.submit_jobs(
+                        address,
+                        [
+                            {
+                                "id": "dry",
+                                "input": "input.mp4",
+                                "buflist": [[1, 1]],
+                                "output": os.path.join(tmpdir, "out.mkv"),
+                                "dry": True,
+                            },
+                            {
+                                "id": "missing",
+                                "input": os.path.join(tmpdir, "missing.mp4"),
+                                "buflist": [[1, 1]],
+                                "output": os.path.join(tmpdir, "out2.mkv"),
+                            },
+                            {"id": "invalid", "input": "input.mp4"},
+                            {
+                                "id": "ffmpeg",
+                                "input": "input.mp4",
+                                "buflist": [[1, 1]],
+                                "output": os.path.join(tmpdir, "out3.mkv"),
+                                "ffmpeg_path": "/tmp/ffmpeg",
+                                "dry": True,
+                            },
+                        ],
+                    )
+                )
+            finally:
+                server.shutdown()
+                server.server_close()
+                job_server.close()
+
+        results = {
+            message["id"]: message
+            for message in messages
+            if message["event"] == "result"
+        }
+        assert results["dry"]["status"] == "done"
+        assert results["missing"]["status"] == "failed"
+        assert "missing keys: buflist, output" in results["invalid"]["error"]
+        assert results["ffmpeg"]["status"] == "failed"
+        assert "ffmpeg_path" in results["ffmpeg"]["error"]
+
+    def test_serve_tcp(self, monkeypatch):
+        """Test that a server on a TCP port only runs the jobs of clients with its token."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            monkeypatch.setenv("XDG_CACHE_HOME", tmpdir)
+            job_server = bufferer.JobServer(max_workers=1)
+            with socket.socket() as free_socket:
+                free_socket.bind(("127.0.0.1", 0))
+                port = free_socket.getsockname()[1]
+            server = bufferer._server.create_server(str(port), job_server)
+            token_file = bufferer._server.get_token_file(port)
+            assert stat.S_IMODE(os.stat(token_file).st_mode) == 0o600
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            job = {
+                "input": "input.mp4",
+                "buflist": [[1, 1]],
+                "output": os.path.join(tmpdir, "out.mkv"),
+                "dry": True,
+            }
+            try:
+                # the token is read from the token file
+                messages = list(bufferer.submit_jobs(str(port), [job]))
+                rejected = list(bufferer.submit_jobs(str(port), [job], token="guess"))
+            finally:
+                server.shutdown()
+                server.server_close()
+                job_server.close()
+
+        assert messages[-1]["event"] == "result"
+        assert messages[-1]["status"] == "done"
+        assert rejected == [{"id": None, "event": "error", "error": "invalid token"}]
+
+    def test_input_window(self):
+        """Test that only the needed part of the input is decoded."""
+        b = bufferer.Bufferer(
+            "input.mp4",
+            "output.mkv",
+            buflist=[[1, 1], [3, 1], [4, 2], [8, 1]],
+            dry=True,
+            start=2,
+            trim="00:00:03.000",
+        )
+
+        # 2 s of input and the first stall fill the output, plus one frame
+        assert b.buflist == [[1, 1], [2, 2]]
+        assert b.input_window_options == ["-ss", "2.0", "-t", "2.033333"]
+
+        b._set_specs()
+        assert b._get_base_cmd()[-6:] == [
+            "-ss",
+            "2.0",
+            "-t",
+            "2.033333",
+            "-i",
+            "input.mp4",
+        ]
+
+    def test_empty_input_window(self):
+        """Test that a window without buffering events passes the input through."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_video = os.path.join(tmpdir, "input.mp4")
+            subprocess.check_output(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-f",
+                    "lavfi",
+                    "-i",
+                    "testsrc=duration=8:size=160x120:rate=25",
+                    "-f",
+                    "lavfi",
+                    "-i",
+                    "sine=duration=8",
+                    "-c:v",
+                    "libx264",
+                    "-c:a",
+                    "aac",
+                    input_video,
+                ],
+                stderr=subprocess.DEVNULL,
+            )
+
+            # the event is after the trimmed output, or before the start; skipping
+            # takes the audio of the window from the input
+            for start, trim, duration, skipping in [
+                (None, "4", 4.0, False),
+                ("6", None, 2.0, False),
+                ("6", None, 2.0, True),
+            ]:
+                output_video = os.path.join(tmpdir, "output.mkv")
+                b = bufferer.Bufferer(
+                    input_file=input_video,
+                    output_file=output_video,
+                    buflist=[[5, 2]],
+                    force_overwrite=True,
+                    start=start,
+                    trim=trim,
+                    skipping=skipping,
+                )
+                assert b.buflist == []
+                b.insert_buf_audiovisual()
+                assert "null" in b.vloop_cmd
+                assert "anull" in b.aloop_cmd or skipping
+
+                output_duration = subprocess.check_output(
+                    [
+                        "ffprobe",
+                        "-v",
+                        "error",
+                        "-show_entries",
+                        "format=duration",
+                        "-of",
+                        "csv=p=0",
+                        output_video,
+                    ]
+                )
+                assert abs(float(output_duration) - duration) < 0.1
+
+    def test_retime_graph_strategy(self):
+        """Test that the retime strategy freezes all events in a single filter."""
+        b = bufferer.Bufferer(
+            input_file="input.mp4",
+            output_file="output.avi",
+            buflist=[[0, 1], [3, 2]],
+            dry=True,
+            graph_strategy="retime",
+        )
+        b._generate_loop_cmds()
+
+        assert "loop=" not in b.vloop_cmd
+        assert b.vloop_cmd.count("setpts") == 1
+        assert "30*gt(N,0)+60*gt(N,90)" in b.vloop_cmd
+
+    def test_retime_skipping_single_pass(self, monkeypatch):
+        """Test that skipping with the retime strategy needs no trimming pass."""
+        b = bufferer.Bufferer(
+            input_file="input.mp4",
+            output_file="output.avi",
+            buflist=[[0, 1], [3, 2]],
+            dry=True,
+            disable_spinner=True,
+            skipping=True,
+            graph_strategy="retime",
+        )
+        cmds = []
+        monkeypatch.setattr(b, "run_command", lambda cmd, **kwargs: cmds.append(cmd))
+
+        b.insert_buf_audiovisual()
+
+        assert len(cmds) == 2
+        filter_complex = cmds[0][cmds[0].index("-filter_complex") + 1]
+        assert "select='not(between(n,1,29)+between(n,91,149))'" in filter_complex
+        assert "output.avi_skipping.nut" not in cmds[1]
+
+    def test_blur_once(self):
+        """Test that the frame repeated during a stall is the blurred frozen frame."""
+        with pytest.raises(RuntimeError, match="retime"):
+            bufferer.Bufferer(
+                "input.mp4", "output.avi", buflist=[[1, 1]], dry=True, blur_once=True
+            )
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_video = os.path.join(tmpdir, "input.mp4")
+            spinner = os.path.join(tmpdir, "spinner.png")
+            output_video = os.path.join(tmpdir, "output.mkv")
+            subprocess.check_output(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-f",
+                    "lavfi",
+                    "-i",
+                    "testsrc=duration=5:size=320x240:rate=25,format=pix_fmts=yuv420p",
+                    "-c:v",
+                    "libx264",
+                    "-preset",
+                    "ultrafast",
+                    input_video,
+                ],
+                stderr=subprocess.DEVNULL,
+            )
+            # a transparent spinner, so that the stalled frames only show the blur
+            subprocess.check_output(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-f",
+                    "lavfi",
+                    "-i",
+                    "color=c=black@0.0:size=16x16,format=rgba",
+                    "-frames:v",
+                    "1",
+                    spinner,
+                ],
+                stderr=subprocess.DEVNULL,
+            )
+
+            b = bufferer.Bufferer(
+                input_file=input_video,
+                output_file=output_video,
+                buflist="[[1, 1], [3, 0.5]]",
+                spinner=spinner,
+                blur=15,
+                blur_once=True,
+                graph_strategy="retime",
+                force_overwrite=True,
+            )
+            b.insert_buf_audiovisual()
+
+            output = subprocess.check_output(
+                ["ffmpeg", "-v", "error", "-i", output_video, "-f", "framemd5", "-"]
+            ).decode("utf-8")
+            checksums = [
+                line.split(",")[-1].strip()
+                for line in output.splitlines()
+                if not line.startswith("#")
+            ]
+
+        # the first stall shows frame 25 for 1 s, i.e. output frames 25 to 49, and
+        # output frame 50 is its repeated copy after the stall
+        assert len(set(checksums[25:51])) == 1
+        assert checksums[24] != checksums[25]
+        assert checksums[51] != checksums[50]
+        # the second stall, at 3 s of the input, starts 1 s later in the output
+        assert len(set(checksums[100:113])) == 1
+
+    def test_stdout_output(self, monkeypatch):
+        """Test that writing to stdout runs a single pass with fragmented MP4."""
+        b = bufferer.Bufferer(
+            input_file="input.mp4",
+            output_file="-",
+            buflist=[[0, 1]],
+            dry=True,
+            output_format="mp4",
+        )
+        cmds = []
+        monkeypatch.setattr(b, "run_command", lambda cmd, **kwargs: cmds.append(cmd))
+
+        b.insert_buf_audiovisual()
+
+        assert len(cmds) == 1
+        assert cmds[0][-5:] == [
+            "-f",
+            "mp4",
+            "-movflags",
+            "+frag_keyframe+empty_moov+default_base_moof",
+            "-",
+        ]
+
+        # without a format, the outputs that ffmpeg cannot guess it for are refused
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fifo = os.path.join(tmpdir, "output.mp4")
+            os.mkfifo(fifo)
+            for output_file in ["-", fifo, os.path.join(tmpdir, "output")]:
+                with pytest.raises(RuntimeError, match="output format is required"):
+                    bufferer.Bufferer(
+                        "input.mp4", output_file, buflist=[[0, 1]], dry=True
+                    )